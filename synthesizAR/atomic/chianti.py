@@ -22,28 +22,153 @@ __all__ = ['Element']
 
 class Element(fiasco.Element):
         
+    def _nearest_temperature_index(self, temperature):
+        """
+        Index of the closest point in the temperature grid for each temperature
+        """
+        grid = self.temperature.to(u.K).value
+        t = temperature.to(u.K).value
+        i = np.clip(np.searchsorted(grid, t), 1, grid.shape[0] - 1)
+        return np.where(np.fabs(t - grid[i-1]) <= np.fabs(grid[i] - t), i - 1, i)
+
+    @staticmethod
+    def _crank_nicolson_step(rates, y, n_0, i_0, n_1, i_1, dt):
+        """
+        Advance the stacked ionization balance equations by a single Crank-Nicolson step
+        """
+        identity = np.eye(rates.shape[-1])
+        term1 = identity - (n_1 * dt / 2.)[:, np.newaxis, np.newaxis] * rates[i_1]
+        term2 = identity + (n_0 * dt / 2.)[:, np.newaxis, np.newaxis] * rates[i_0]
+        rhs = np.einsum('lij,lj->li', term2, y)
+        y_new = np.fabs(np.linalg.solve(term1, rhs[..., np.newaxis])[..., 0])
+        return y_new / y_new.sum(axis=-1, keepdims=True)
+
+    @staticmethod
+    def _interpolate_in_time(time, values, t):
+        """
+        Linearly interpolate ``values``, with time along the first axis, to a single time or
+        to an array of times with a single search
+        """
+        j = np.clip(np.searchsorted(time, t, side='right'), 1, time.shape[0] - 1)
+        w = np.clip((t - time[j-1]) / (time[j] - time[j-1]), 0., 1.)
+        w = np.reshape(w, np.shape(w) + (1,)*(values.ndim - 1))
+        return (1. - w) * values[j-1] + w * values[j]
+
     @u.quantity_input
     def non_equilibrium_ionization(self, time: u.s, temperature: u.K, density: u.cm**(-3),
-                                   rate_matrix=None, initial_condition=None):
+                                   rate_matrix=None, initial_condition=None, adaptive=False,
+                                   rtol=1e-3, max_step=None, min_step=None):
         """
         Compute the ionization fraction in non-equilibrium for a given temperature and density
         timeseries.
+
+        Multiple timeseries sharing the same time array can be advanced at once by passing
+        temperature and density with shape ``(time, n_loops)``. At each step, the stacked
+        Crank-Nicolson systems are solved directly rather than inverted.
+
+        If ``adaptive`` is True, the step size is chosen by step doubling rather than by the
+        spacing of ``time``: long steps are taken while the temperature and density are
+        slowly varying and short steps where they change quickly. Temperature and density are
+        linearly interpolated between the points in ``time`` and the populations are
+        interpolated back onto ``time`` afterwards. Steps may be shorter than the spacing of
+        ``time``, down to ``min_step``. If the error cannot be brought below ``rtol`` with
+        steps of ``min_step``, the step is accepted anyway and a warning is raised. ``time``
+        must be strictly increasing in this case.
+
+        Parameters
+        ----------
+        time : `~astropy.units.Quantity`
+            Shape ``(time,)``
+        temperature : `~astropy.units.Quantity`
+            Shape ``(time,)`` or ``(time, n_loops)``
+        density : `~astropy.units.Quantity`
+            Same shape as ``temperature``
+        rate_matrix : `~astropy.units.Quantity`, optional
+        initial_condition : `~astropy.units.Quantity`, optional
+        adaptive : `bool`, optional
+            If True, use adaptive time steps with error control
+        rtol : `float`, optional
+            Tolerance on the local error of the population fractions per adaptive step
+        max_step : `~astropy.units.Quantity`, optional
+            Longest allowed adaptive step. Defaults to the full time range.
+        min_step : `~astropy.units.Quantity`, optional
+            Shortest allowed adaptive step. Defaults to :math:`10^{-3}` of the smallest
+            spacing of ``time``.
+
+        Returns
+        -------
+        ionization_fraction : `~astropy.units.Quantity`
+            Shape ``(time, Z+1)`` or ``(time, n_loops, Z+1)``
         """
         if rate_matrix is None:
             rate_matrix = self._rate_matrix()
         if initial_condition is None:
             initial_condition = self.equilibrium_ionization(rate_matrix=rate_matrix)
-        interpolate_indices = [np.abs(self.temperature - t).argmin() for t in temperature]
-        y = np.zeros(time.shape + (self.atomic_number + 1,))
-        y[0, :] = initial_condition[interpolate_indices[0], :]
-
-        identity = u.Quantity(np.eye(self.atomic_number + 1))
-        for i in range(1, time.shape[0]):
-            dt = time[i] - time[i-1]
-            term1 = identity - density[i] * dt/2. * rate_matrix[interpolate_indices[i], :, :]
-            term2 = identity + density[i-1] * dt/2. * rate_matrix[interpolate_indices[i-1], :, :]
-            y[i, :] = np.linalg.inv(term1) @ term2 @ y[i-1, :]
-            y[i, :] = np.fabs(y[i, :])
-            y[i, :] /= y[i, :].sum()
-
-        return u.Quantity(y)
+        single = temperature.ndim == 1
+        if single:
+            temperature = temperature[:, np.newaxis]
+            density = density[:, np.newaxis]
+        # NOTE: strip units once up front; the rate matrix has units of cm^3 s^-1
+        rates = rate_matrix.to(u.cm**3/u.s).value
+        n = density.to(u.cm**(-3)).value
+        t = time.to(u.s).value
+        y_0 = u.Quantity(initial_condition).value[self._nearest_temperature_index(temperature[0])]
+
+        if adaptive and t.shape[0] > 1:
+            if np.any(np.diff(t) <= 0):
+                raise ValueError('Time must be strictly increasing for adaptive time steps')
+            max_step = t[-1] - t[0] if max_step is None else max_step.to(u.s).value
+            min_step = 1e-3 * np.diff(t).min() if min_step is None else min_step.to(u.s).value
+            if min_step <= 0:
+                raise ValueError('Minimum adaptive step must be positive')
+            y = self._adaptive_non_equilibrium_ionization(t, temperature, n, rates, y_0, rtol,
+                                                          max_step, min_step)
+        else:
+            indices = self._nearest_temperature_index(temperature)
+            y = np.zeros(temperature.shape + (self.atomic_number + 1,))
+            y[0] = y_0
+            for i in range(1, t.shape[0]):
+                y[i] = self._crank_nicolson_step(rates, y[i-1], n[i-1], indices[i-1], n[i],
+                                                 indices[i], t[i] - t[i-1])
+
+        return u.Quantity(y[:, 0, :] if single else y)
+
+    def _adaptive_non_equilibrium_ionization(self, t, temperature, n, rates, y_0, rtol,
+                                             max_step, min_step):
+        """
+        Integrate with step doubling and interpolate the populations back onto ``t``
+        """
+        temperature = temperature.to(u.K)
+
+        def state(t_now):
+            T_now = self._interpolate_in_time(t, temperature.value, t_now) * u.K
+            return (self._interpolate_in_time(t, n, t_now),
+                    self._nearest_temperature_index(T_now))
+
+        t_now, y_now = t[0], y_0
+        n_now, i_now = state(t_now)
+        dt = np.diff(t).min()
+        t_steps, y_steps = [t_now], [y_now]
+        max_error = 0.
+        while t_now < t[-1]:
+            dt = min(max(dt, min_step), max_step, t[-1] - t_now)
+            n_half, i_half = state(t_now + dt/2.)
+            n_next, i_next = state(t_now + dt)
+            y_full = self._crank_nicolson_step(rates, y_now, n_now, i_now, n_next, i_next, dt)
+            y_half = self._crank_nicolson_step(rates, y_now, n_now, i_now, n_half, i_half, dt/2.)
+            y_two = self._crank_nicolson_step(rates, y_half, n_half, i_half, n_next, i_next,
+                                              dt/2.)
+            # Richardson estimate of the local error of a second-order scheme
+            error = np.fabs(y_two - y_full).max() / 3. / rtol
+            if error <= 1. or dt <= min_step:
+                max_error = max(max_error, error)
+                t_now, y_now, n_now, i_now = t_now + dt, y_two, n_next, i_next
+                t_steps.append(t_now)
+                y_steps.append(y_now)
+            dt *= np.clip(0.9 * (error + 1e-10)**(-1./3.), 0.2, 5.)
+        if max_error > 1.:
+            warnings.warn(f'Local error exceeded rtol={rtol} by up to a factor of '
+                          f'{max_error:.3g} with the minimum step of {min_step:.3g} s')
+
+        y = self._interpolate_in_time(np.array(t_steps), np.stack(y_steps, axis=0), t)
+        return y / y.sum(axis=-1, keepdims=True)
@@ -1,19 +1,54 @@
 """
 Various models for calculating emission from multiple ions
 """
+import os
 import warnings
 import json
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
-from scipy.interpolate import splrep, splev, interp1d
 import astropy.units as u
+import astropy.constants as const
 from astropy.utils.console import ProgressBar
 import h5py
 import fiasco
 
+from synthesizAR.util import linear_lookup, bilinear_lookup
 from .chianti import Element
 
 
+def _database_version(ion):
+    """
+    Identify the atomic database used by an ion from its location, its modification time and
+    the version of fiasco
+    """
+    dbase_root = (getattr(ion, 'hdf5_dbase_root', None)
+                  or getattr(fiasco, 'defaults', {}).get('hdf5_dbase_root', ''))
+    mtime = os.path.getmtime(dbase_root) if os.path.isfile(dbase_root) else ''
+    return f'{getattr(fiasco, "__version__", "")}|{os.path.abspath(dbase_root)}|{mtime}'
+
+
+def _calculate_ion_emissivity(ion, density):
+    """
+    Compute the emissivity of every transition in an ion. This is defined at the module level
+    such that it can be run in a worker process.
+    """
+    pop = ion.level_populations(density)
+    # NOTE: populations not available for every ion
+    if pop is None:
+        return ion.ion_name, None, None
+    upper_level = ion.transitions.upper_level[~ion.transitions.is_twophoton]
+    wavelength = ion.transitions.wavelength[~ion.transitions.is_twophoton]
+    A = ion.transitions.A[~ion.transitions.is_twophoton]
+    i_upper = fiasco.util.vectorize_where(ion._elvlc['level'], upper_level)
+    emissivity = pop[:, :, i_upper] * A * u.photon
+    emissivity = emissivity[:, :, np.argsort(wavelength)]
+    wavelength = np.sort(wavelength)
+    return ion.ion_name, wavelength, emissivity
+
+
 class EmissionModel(fiasco.IonCollection):
     """
     Model for how atomic data is used to calculate emission from coronal plasma.
@@ -25,6 +60,22 @@ class EmissionModel(fiasco.IonCollection):
         self.temperature = self[0].temperature
         self.density = density
         self.resolved_wavelengths = kwargs.get('resolved_wavelengths', {})
+        # Inverse mapping from log-temperature and log-density to fractional mesh indices
+        self._mesh_log_temperature = np.log10(self.temperature.value)
+        self._mesh_log_density = np.log10(self.density.value)
+        self._mesh_indices_memo = None
+        # LRU cache of emissivities read from disk, capped in bytes
+        self.emissivity_cache_size = kwargs.get('emissivity_cache_size', 2**30)
+        self._emissivity_cache = OrderedDict()
+        self._emissivity_cache_nbytes = 0
+        self._emissivity_buffer = None
+        # Emissivities of the resolved transitions, stacked once per set of lines
+        self._resolved_line_tables = {}
+        # Equilibrium ionization tables on a fine grid, uniform in log-temperature
+        self._ioneq_log_temperature = None
+        self._ioneq_tables = {}
+        # Offset and shape of each loop in the columnar ionization fraction layout
+        self._ionization_fraction_index_memo = None
         # Cannot have empty abundances so replace them as needed
         default_abundance = kwargs.get('default_abundance_dataset', 'sun_photospheric_2009_asplund')
         for ion in self._ion_list:
@@ -48,6 +99,8 @@ class EmissionModel(fiasco.IonCollection):
             save_dict['emissivity_savefile'] = self.emissivity_savefile
         if hasattr(self, 'ionization_fraction_savefile'):
             save_dict['ionization_fraction_savefile'] = self.ionization_fraction_savefile
+        if hasattr(self, 'mesh_indices_savefile'):
+            save_dict['mesh_indices_savefile'] = self.mesh_indices_savefile
         with open(savefile, 'w') as f:
             json.dump(save_dict, f, indent=4, sort_keys=True)
 
@@ -67,114 +120,517 @@ class EmissionModel(fiasco.IonCollection):
             emission_model.emissivity_savefile = restore_dict['emissivity_savefile']
         if 'ionization_fraction_savefile' in restore_dict:
             emission_model.ionization_fraction_savefile = restore_dict['ionization_fraction_savefile']
+        if 'mesh_indices_savefile' in restore_dict:
+            emission_model.mesh_indices_savefile = restore_dict['mesh_indices_savefile']
 
         return emission_model
-        
-    def interpolate_to_mesh_indices(self, loop):
+
+    def __getstate__(self):
+        # NOTE: do not ship cached emissivities to workers; memory-mapped buffers are reopened
+        state = self.__dict__.copy()
+        state['_emissivity_cache'] = OrderedDict()
+        state['_emissivity_cache_nbytes'] = 0
+        buffer = state.get('_emissivity_buffer')
+        if buffer is not None and buffer['memmap']:
+            state['_emissivity_buffer'] = dict(buffer, emissivity=None, wavelength=None)
+        return state
+
+    @staticmethod
+    def _fractional_indices(log_grid, log_values):
+        """
+        Map values onto fractional indices of a grid by linear interpolation in log-space
+        """
+        if log_grid.shape[0] == 1:
+            return np.zeros(log_values.shape)
+        return linear_lookup(log_values, log_grid, np.arange(log_grid.shape[0], dtype=float),
+                             fill_value=None)
+
+    def interpolate_to_mesh_indices(self, loop, electron_temperature=None, density=None):
         """
         Return interpolated loop indices to the temperature and density meshes defined for
         the atomic data. For use with `~scipy.ndimage.map_coordinates`.
+
+        If the indices for all loops have been computed with `calculate_mesh_indices`, they are
+        read from disk. The indices for the most recently requested loop are also kept in
+        memory such that they can be reused across channels. Both are validated against the
+        hydrodynamic state of the loop, as given by `_loop_signature`, such that stale indices
+        are never returned after the loop simulations are rerun.
+
+        Parameters
+        ----------
+        loop : `~synthesizAR.Loop`
+        electron_temperature : `~astropy.units.Quantity`, optional
+            If the loop temperature has already been loaded, it can be passed here
+        density : `~astropy.units.Quantity`, optional
+            If the loop density has already been loaded, it can be passed here
         """
-        nots_itemperature = splrep(self.temperature.value, np.arange(self.temperature.shape[0]))
-        nots_idensity = splrep(self.density.value, np.arange(self.density.shape[0]))
-        itemperature = splev(np.ravel(loop.electron_temperature.value), nots_itemperature)
-        idensity = splev(np.ravel(loop.density.value), nots_idensity)
+        signature = self._loop_signature(loop, electron_temperature, density)
+        key = (loop.name, signature)
+        if self._mesh_indices_memo is not None and self._mesh_indices_memo[0] == key:
+            return self._mesh_indices_memo[1]
+        if hasattr(self, 'mesh_indices_savefile'):
+            with h5py.File(self.mesh_indices_savefile, 'r') as hf:
+                if loop.name in hf and hf[loop.name].attrs.get('signature') == signature:
+                    indices = (np.array(hf[loop.name]['temperature']),
+                               np.array(hf[loop.name]['density']))
+                    self._mesh_indices_memo = (key, indices)
+                    return indices
+        if electron_temperature is None:
+            electron_temperature = loop.electron_temperature
+        if density is None:
+            density = loop.density
+        itemperature = self._fractional_indices(
+            self._mesh_log_temperature,
+            np.log10(np.ravel(electron_temperature.to(self.temperature.unit).value)))
+        idensity = self._fractional_indices(
+            self._mesh_log_density, np.log10(np.ravel(density.to(self.density.unit).value)))
+        self._mesh_indices_memo = (key, (itemperature, idensity))
 
         return itemperature, idensity
+
+    @staticmethod
+    def _loop_signature(loop, electron_temperature=None, density=None):
+        """
+        Identify the hydrodynamic state of a loop by the location, modification time and size
+        of the file its results are stored in or, if the results are held in memory, by a hash
+        of its temperature and density
+        """
+        savefile = getattr(loop, 'parameters_savefile', None)
+        if savefile and os.path.isfile(savefile):
+            stat = os.stat(savefile)
+            return f'{os.path.abspath(savefile)}|{stat.st_mtime_ns}|{stat.st_size}'
+        if electron_temperature is None:
+            electron_temperature = loop.electron_temperature
+        if density is None:
+            density = loop.density
+        sha = hashlib.sha256()
+        for q in [electron_temperature, density]:
+            sha.update(q.unit.to_string().encode())
+            sha.update(np.ascontiguousarray(q.value, dtype=np.float64).tobytes())
+        return sha.hexdigest()
+
+    def calculate_mesh_indices(self, field, savefile, **kwargs):
+        """
+        Compute and store the interpolated temperature and density mesh indices for every loop
+        such that they can be reused for every channel and every instrument.
+
+        The indices of each loop are tagged with its signature such that they are recomputed,
+        rather than read, once the loop simulations are rerun.
+
+        Parameters
+        ----------
+        field : `~synthesizAR.Field`
+        savefile : `str`
+        """
+        notebook = kwargs.get('notebook', True)
+        if hasattr(self, 'mesh_indices_savefile'):
+            del self.mesh_indices_savefile
+        self._mesh_indices_memo = None
+        with h5py.File(savefile, 'w') as hf:
+            with ProgressBar(len(field.loops), ipython_widget=notebook) as progress:
+                for loop in field.loops:
+                    itemperature, idensity = self.interpolate_to_mesh_indices(loop)
+                    grp = hf.create_group(loop.name)
+                    grp.attrs['signature'] = self._mesh_indices_memo[0][1]
+                    grp.create_dataset('temperature', data=itemperature)
+                    grp.create_dataset('density', data=idensity)
+                    progress.update()
+        self.mesh_indices_savefile = savefile
         
+    def _emissivity_key(self, ion):
+        """
+        Key identifying the emissivity of an ion by the ion, the temperature and density grids
+        and the atomic database version
+        """
+        sha = hashlib.sha256(ion.ion_name.encode())
+        sha.update(np.asarray(ion.temperature.to(u.K).value, dtype=np.float64).tobytes())
+        sha.update(np.asarray(self.density.to(u.cm**(-3)).value, dtype=np.float64).tobytes())
+        sha.update(_database_version(ion).encode())
+        return sha.hexdigest()
+
     def calculate_emissivity(self, savefile, **kwargs):
         """
         Calculate and store emissivity for every ion in the model
+
+        The level populations of each ion are computed in parallel on a local process pool
+        while the results are written to ``savefile`` by a single writer. Each stored ion is
+        tagged with a key built from the ion, the temperature and density grids and the atomic
+        database version such that only the ions that are missing or out of date are computed
+        when a model is extended or reused.
+
+        Parameters
+        ----------
+        savefile : `str`
+
+        Other Parameters
+        ----------------
+        max_workers : `int`, optional
+            Number of worker processes. If 1, the emissivities are computed serially. Defaults
+            to the number of processors.
+        executor : `~concurrent.futures.Executor`, optional
+            Executor to compute the emissivities on in place of a local process pool. It is
+            not shut down when the calculation is finished.
+        notebook : `bool`, optional
         """
         notebook = kwargs.get('notebook', True)
+        max_workers = kwargs.get('max_workers', None)
+        executor = kwargs.get('executor', None)
         self.emissivity_savefile = savefile
-        with h5py.File(savefile, 'w') as hf:
-            with ProgressBar(len(self._ion_list), ipython_widget=notebook) as progress:
-                for ion in self:
-                    pop = ion.level_populations(self.density)
-                    # NOTE: populations not available for every ion
-                    if pop is None:
-                        warnings.warn(f'Cannot compute level populations for {ion.ion_name}')
-                        continue
-                    upper_level = ion.transitions.upper_level[~ion.transitions.is_twophoton]
-                    wavelength = ion.transitions.wavelength[~ion.transitions.is_twophoton]
-                    A = ion.transitions.A[~ion.transitions.is_twophoton]
-                    i_upper = fiasco.util.vectorize_where(ion._elvlc['level'], upper_level)
-                    emissivity = pop[:, :, i_upper] * A * u.photon
-                    emissivity = emissivity[:, :, np.argsort(wavelength)]
-                    wavelength = np.sort(wavelength)
-                    grp = hf.create_group(ion.ion_name)
+        self.clear_emissivity_cache()
+        keys = {ion.ion_name: self._emissivity_key(ion) for ion in self}
+        with h5py.File(savefile, 'a') as hf:
+            missing = [ion for ion in self if ion.ion_name not in hf
+                       or hf[ion.ion_name].attrs.get('key', '') != keys[ion.ion_name]]
+        with ProgressBar(len(missing), ipython_widget=notebook) as progress:
+            if executor is None and max_workers == 1:
+                results = (_calculate_ion_emissivity(ion, self.density) for ion in missing)
+                self._write_emissivities(savefile, results, keys, progress)
+            else:
+                own_executor = executor is None
+                if own_executor:
+                    executor = ProcessPoolExecutor(max_workers=max_workers)
+                try:
+                    futures = [executor.submit(_calculate_ion_emissivity, ion, self.density)
+                               for ion in missing]
+                    results = (future.result() for future in as_completed(futures))
+                    self._write_emissivities(savefile, results, keys, progress)
+                finally:
+                    if own_executor:
+                        executor.shutdown()
+
+    @staticmethod
+    def _write_emissivities(savefile, results, keys, progress):
+        """
+        Write emissivities to file as they are computed
+        """
+        with h5py.File(savefile, 'a') as hf:
+            for ion_name, wavelength, emissivity in results:
+                if ion_name in hf:
+                    del hf[ion_name]
+                grp = hf.create_group(ion_name)
+                grp.attrs['key'] = keys[ion_name]
+                # NOTE: an empty group records that no populations are available for this ion
+                if wavelength is None:
+                    warnings.warn(f'Cannot compute level populations for {ion_name}')
+                else:
                     ds = grp.create_dataset('wavelength', data=wavelength.value)
                     ds.attrs['units'] = wavelength.unit.to_string()
-                    ds = grp.create_dataset('emissivity', data=emissivity.data)
+                    ds = grp.create_dataset('emissivity', data=emissivity.value)
                     ds.attrs['units'] = emissivity.unit.to_string()
-                    progress.update()
-    
+                progress.update()
+
+    def clear_emissivity_cache(self):
+        """
+        Remove all cached and preloaded emissivities
+        """
+        self._emissivity_cache = OrderedDict()
+        self._emissivity_cache_nbytes = 0
+        self._emissivity_buffer = None
+        self._resolved_line_tables = {}
+
+    def preload_emissivity(self, memmap=True):
+        """
+        Load the emissivities of every ion into a single contiguous buffer.
+
+        Subsequent calls to `get_emissivity` return views into this buffer rather than reading
+        from the emissivity file.
+
+        This is most useful before sending the model to many workers, e.g. by passing
+        ``preload_emissivity=True`` to `~synthesizAR.Observer.flatten_detector_counts` when
+        computing in parallel. The buffer is discarded by `clear_emissivity_cache` and by
+        `calculate_emissivity`.
+
+        Parameters
+        ----------
+        memmap : `bool`, optional
+            If True (default), the buffer is written next to the emissivity file and
+            memory-mapped such that it is shared between processes and only its location is
+            pickled when the model is sent to a worker.
+        """
+        root = f'{os.path.splitext(self.emissivity_savefile)[0]}_preload'
+        index = {}
+        with h5py.File(self.emissivity_savefile, 'r') as hf:
+            n_emissivity, n_wavelength = 0, 0
+            for ion in self:
+                if ion.ion_name not in hf or 'emissivity' not in hf[ion.ion_name]:
+                    continue
+                grp = hf[ion.ion_name]
+                index[ion.ion_name] = {
+                    'offset': n_emissivity,
+                    'shape': grp['emissivity'].shape,
+                    'unit': grp['emissivity'].attrs['units'],
+                    'wavelength_offset': n_wavelength,
+                    'wavelength_unit': grp['wavelength'].attrs['units'],
+                }
+                n_emissivity += int(np.prod(grp['emissivity'].shape))
+                n_wavelength += grp['wavelength'].shape[0]
+            if memmap:
+                emissivity = np.lib.format.open_memmap(f'{root}_emissivity.npy', mode='w+',
+                                                       dtype=np.float64, shape=(n_emissivity,))
+                wavelength = np.lib.format.open_memmap(f'{root}_wavelength.npy', mode='w+',
+                                                       dtype=np.float64, shape=(n_wavelength,))
+            else:
+                emissivity = np.empty((n_emissivity,))
+                wavelength = np.empty((n_wavelength,))
+            for ion_name, i in index.items():
+                n = int(np.prod(i['shape']))
+                emissivity[i['offset']:i['offset']+n] = np.ravel(hf[ion_name]['emissivity'])
+                n = i['shape'][-1]
+                wavelength[i['wavelength_offset']:i['wavelength_offset']+n] = \
+                    hf[ion_name]['wavelength']
+        if memmap:
+            emissivity.flush()
+            wavelength.flush()
+        self.clear_emissivity_cache()
+        self._emissivity_buffer = {'memmap': memmap, 'root': root, 'index': index,
+                                   'emissivity': emissivity, 'wavelength': wavelength}
+
+    def _get_preloaded_emissivity(self, ion):
+        buffer = self._emissivity_buffer
+        if ion.ion_name not in buffer['index']:
+            return (None, None)
+        if buffer['emissivity'] is None:
+            buffer['emissivity'] = np.load(f'{buffer["root"]}_emissivity.npy', mmap_mode='r')
+            buffer['wavelength'] = np.load(f'{buffer["root"]}_wavelength.npy', mmap_mode='r')
+        i = buffer['index'][ion.ion_name]
+        n = int(np.prod(i['shape']))
+        emissivity = buffer['emissivity'][i['offset']:i['offset']+n].reshape(i['shape'])
+        n = i['shape'][-1]
+        wavelength = buffer['wavelength'][i['wavelength_offset']:i['wavelength_offset']+n]
+        return (u.Quantity(wavelength, i['wavelength_unit'], copy=False),
+                u.Quantity(emissivity, i['unit'], copy=False))
+
     def get_emissivity(self, ion):
         """
         Get emissivity for a particular ion
+
+        Emissivities are served from the preloaded buffer if `preload_emissivity` has been
+        called. Otherwise, they are read from disk and kept in a least-recently-used cache
+        holding at most ``emissivity_cache_size`` bytes.
         """
+        if self._emissivity_buffer is not None:
+            return self._get_preloaded_emissivity(ion)
+        if ion.ion_name in self._emissivity_cache:
+            self._emissivity_cache.move_to_end(ion.ion_name)
+            return self._emissivity_cache[ion.ion_name]
         with h5py.File(self.emissivity_savefile, 'r') as hf:
-            if ion.ion_name not in hf:
+            if ion.ion_name not in hf or 'emissivity' not in hf[ion.ion_name]:
                 return (None, None)
             ds = hf['/'.join([ion.ion_name, 'wavelength'])]
             wavelength = u.Quantity(ds, ds.attrs['units'])
             ds = hf['/'.join([ion.ion_name, 'emissivity'])]
             emissivity = u.Quantity(ds,  ds.attrs['units'])
-            
+        nbytes = wavelength.nbytes + emissivity.nbytes
+        if nbytes <= self.emissivity_cache_size:
+            self._emissivity_cache[ion.ion_name] = (wavelength, emissivity)
+            self._emissivity_cache_nbytes += nbytes
+            while self._emissivity_cache_nbytes > self.emissivity_cache_size:
+                _, (w, e) = self._emissivity_cache.popitem(last=False)
+                self._emissivity_cache_nbytes -= w.nbytes + e.nbytes
+
         return wavelength, emissivity
 
+    def _ioneq_temperature(self, log_temperature_dex=0.01):
+        """
+        Sufficiently fine temperature grid for computing ionization fractions
+        """
+        logTmin = np.log10(self.temperature.value.min())
+        logTmax = np.log10(self.temperature.value.max())
+        return u.Quantity(10.**(np.arange(logTmin, logTmax+log_temperature_dex,
+                                          log_temperature_dex)),
+                          self.temperature.unit)
+
+    def _equilibrium_ionization_table(self, element_name):
+        """
+        Equilibrium ionization fractions of an element tabulated in log-temperature
+        """
+        if self._ioneq_log_temperature is None:
+            self._ioneq_log_temperature = np.log10(self._ioneq_temperature().value)
+        if element_name not in self._ioneq_tables:
+            temperature = u.Quantity(10.**self._ioneq_log_temperature, self.temperature.unit)
+            ioneq = Element(element_name, temperature).equilibrium_ionization()
+            self._ioneq_tables[element_name] = ioneq.to(u.dimensionless_unscaled).value
+        return self._ioneq_log_temperature, self._ioneq_tables[element_name]
+
+    def _equilibrium_ionization_fraction(self, element_name, electron_temperature):
+        """
+        Evaluate the tabulated equilibrium ionization fractions at the given temperatures
+        """
+        log_temperature, table = self._equilibrium_ionization_table(element_name)
+        log_t = np.log10(electron_temperature.to(self.temperature.unit).value)
+        ioneq = linear_lookup(log_t, log_temperature, table, fill_value=None)
+        return np.where(ioneq < 0., 0., ioneq)
+
     def calculate_ionization_fraction(self, field, savefile, interface=None, **kwargs):
         """
         Compute population fractions for each ion and for each loop.
 
         Find the fractional ionization for each loop in the model as defined by the loop
         model interface. If no interface is provided, the ionization fractions are calculated
-        assuming ionization equilibrium.
+        assuming ionization equilibrium. In this case, the equilibrium ionization fractions
+        of each element are tabulated once and evaluated on the temperatures of many loops at
+        once. The results of all loops are stored in a single columnar dataset per element,
+        with one row per loop point and chunked by charge state, such that each element is
+        written once per batch of loops. If ``savefile`` is None, nothing is written to disk
+        and the equilibrium ionization fractions are instead computed from the loop temperature
+        whenever they are requested.
 
         Parameters
         ----------
         field : `~synthesizAR.Field`
-        savefile : `str`
+        savefile : `str` or `None`
         interface : optional
             Hydrodynamic model interface
 
         Other Parameters
         ----------------
         log_temperature_dex : `float`, optional
+        max_points : `int`, optional
+            Maximum number of temperature values, summed over time and space for all loops in
+            a batch, evaluated at once in the equilibrium case. A single loop larger than this
+            is evaluated on its own.
         """
         self.ionization_fraction_savefile = savefile
-        # Create sufficiently fine temperature grid
-        dex = kwargs.get('log_temperature_dex', 0.01)
-        logTmin = np.log10(self.temperature.value.min())
-        logTmax = np.log10(self.temperature.value.max())
-        temperature = u.Quantity(10.**(np.arange(logTmin, logTmax+dex, dex)), self.temperature.unit)
-        
+        self._ionization_fraction_index_memo = None
+        temperature = self._ioneq_temperature(kwargs.get('log_temperature_dex', 0.01))
+
         if interface is not None:
+            # NOTE: flag the file such that equilibrium-only shortcuts are not used
+            with h5py.File(savefile, 'a') as hf:
+                hf.attrs['equilibrium'] = False
+                hf.attrs['layout'] = 'loop'
             return interface.calculate_ionization_fraction(field, self, temperature=temperature,
                                                            **kwargs)
+        self._ioneq_log_temperature = np.log10(temperature.value)
+        self._ioneq_tables = {}
         unique_elements = list(set([ion.element_name for ion in self]))
-        # Calculate ionization equilibrium for each element and interpolate to each loop
+        for el_name in unique_elements:
+            self._equilibrium_ionization_table(el_name)
+        if savefile is None:
+            return
+        # Batch loops such that the temperatures of many loops are evaluated at once
+        max_points = kwargs.get('max_points', 2**22)
+        batches, batch, n_points = [], [], 0
+        for loop in field.loops:
+            # NOTE: each loop contributes a value at every time and every point along the loop
+            n_loop = loop.time.shape[0] * loop.field_aligned_coordinate.shape[0]
+            if batch and n_points + n_loop > max_points:
+                batches.append(batch)
+                batch, n_points = [], 0
+            batch.append(loop)
+            n_points += n_loop
+        if batch:
+            batches.append(batch)
         notebook = kwargs.get('notebook', True)
         with h5py.File(self.ionization_fraction_savefile, 'a') as hf:
-            with ProgressBar(len(unique_elements) * len(field.loops), ipython_widget=notebook) as progress:
-                for el_name in unique_elements:
-                    element = Element(el_name, temperature)
-                    ioneq = element.equilibrium_ionization()
-                    f_ioneq = interp1d(temperature, ioneq, axis=0, kind='linear',
-                                       fill_value='extrapolate')
-                    for loop in field.loops:
-                        grp = hf.create_group(loop.name) if loop.name not in hf else hf[loop.name]
-                        tmp = f_ioneq(loop.electron_temperature)
-                        data = u.Quantity(np.where(tmp < 0., 0., tmp), ioneq.unit)
-                        if element.element_name not in grp:
-                            dset = grp.create_dataset(element.element_name, data=data.value)
-                        else:
-                            dset = grp[element.element_name]
-                            dset[:, :, :] = data.value
-                        dset.attrs['units'] = data.unit.to_string()
-                        dset.attrs['description'] = 'equilibrium ionization fractions'
-                        progress.update()
+            hf.attrs['equilibrium'] = True
+            hf.attrs['layout'] = 'columnar'
+            for name in ['columns', 'index']:
+                if name in hf:
+                    del hf[name]
+            columns = hf.create_group('columns')
+            for el_name in unique_elements:
+                n_charge = self._equilibrium_ionization_table(el_name)[1].shape[-1]
+                # NOTE: chunk by charge state so that single-ion reads are contiguous
+                dset = columns.create_dataset(el_name, (0, n_charge), maxshape=(None, n_charge),
+                                              chunks=(2**16, 1))
+                dset.attrs['units'] = ''
+                dset.attrs['description'] = 'equilibrium ionization fractions'
+            names, offsets, shapes = [], [], []
+            offset, n_done = 0, 0
+            with ProgressBar(len(field.loops), ipython_widget=notebook) as progress:
+                for batch in batches:
+                    temperatures = [loop.electron_temperature for loop in batch]
+                    all_temperatures = np.concatenate([np.ravel(t.to(self.temperature.unit))
+                                                       for t in temperatures])
+                    for el_name in unique_elements:
+                        ioneq = self._equilibrium_ionization_fraction(el_name, all_temperatures)
+                        dset = columns[el_name]
+                        dset.resize(offset + ioneq.shape[0], axis=0)
+                        dset[offset:, :] = ioneq
+                    for loop, t in zip(batch, temperatures):
+                        names.append(loop.name)
+                        offsets.append(offset)
+                        shapes.append(t.shape)
+                        offset += t.size
+                    n_done += len(batch)
+                    progress.update(n_done)
+            index = hf.create_group('index')
+            index.create_dataset('name', data=np.array(names, dtype='S'))
+            index.create_dataset('offset', data=np.array(offsets, dtype=np.int64))
+            index.create_dataset('shape', data=np.array(shapes, dtype=np.int64))
+
+    def _ionization_fraction_index(self, hf):
+        """
+        Offset and shape of each loop in the columnar layout, read once per file
+        """
+        memo = self._ionization_fraction_index_memo
+        if memo is None or memo[0] != self.ionization_fraction_savefile:
+            index = {name.decode(): (offset, tuple(shape)) for name, offset, shape
+                     in zip(hf['index/name'][:], hf['index/offset'][:], hf['index/shape'][:])}
+            self._ionization_fraction_index_memo = (self.ionization_fraction_savefile, index)
+        return self._ionization_fraction_index_memo[1]
+
+    def _read_ionization_fraction(self, hf, loop, element_name, charge_state=slice(None)):
+        """
+        Read the ionization fractions of one or all charge states of an element for a
+        particular loop from either the columnar or the per-loop layout
+        """
+        if hf.attrs.get('layout', 'loop') == 'columnar':
+            offset, shape = self._ionization_fraction_index(hf)[loop.name]
+            dset = hf['/'.join(['columns', element_name])]
+            data = dset[offset:offset + int(np.prod(shape)), charge_state]
+            data = data.reshape(shape + data.shape[1:])
+        else:
+            dset = hf['/'.join([loop.name, element_name])]
+            data = dset[..., charge_state]
+        return u.Quantity(data, dset.attrs['units'])
+
+    @staticmethod
+    def _broadcast_along_loop(loop, ionization_fraction, n_trailing=0):
+        """
+        Broadcast spatially uniform ionization fractions along the loop. ``n_trailing`` is the
+        number of axes after the loop coordinate axis, e.g. 1 for all charge states of an
+        element.
+        """
+        if ionization_fraction.ndim == 1 + n_trailing:
+            data = np.expand_dims(ionization_fraction.value, 1)
+            shape = data.shape[:1] + loop.field_aligned_coordinate.shape + data.shape[2:]
+            ionization_fraction = u.Quantity(np.broadcast_to(data, shape),
+                                             ionization_fraction.unit, copy=False)
+        return ionization_fraction
+
+    @property
+    def ionization_equilibrium(self):
+        """
+        True if the ionization fractions were calculated assuming ionization equilibrium
+        """
+        if self.ionization_fraction_savefile is None:
+            return True
+        with h5py.File(self.ionization_fraction_savefile, 'r') as hf:
+            return bool(hf.attrs.get('equilibrium', False))
+
+    def get_equilibrium_ionization_fractions(self, ions):
+        """
+        Get equilibrium ionization fractions of several ions on the temperature grid of the
+        emission model
+
+        Parameters
+        ----------
+        ions : `list`
+
+        Returns
+        -------
+        ionization_fraction : `~astropy.units.Quantity`
+            Shape ``(len(ions),) + temperature.shape``
+        """
+        ionization_fraction = np.zeros((len(ions),) + self.temperature.shape)
+        for element_name in set([ion.element_name for ion in ions]):
+            ioneq = self._equilibrium_ionization_fraction(element_name, self.temperature)
+            for i, ion in enumerate(ions):
+                if ion.element_name == element_name:
+                    ionization_fraction[i] = ioneq[..., ion.charge_state]
+        return u.Quantity(ionization_fraction)
 
     def get_ionization_fraction(self, loop, ion):
         """
@@ -188,11 +644,116 @@ class EmissionModel(fiasco.IonCollection):
         loop : `~synthesizAR.Loop`
         ion : `~synthesizAR.atomic.Ion`
         """
+        if self.ionization_fraction_savefile is None:
+            ioneq = self._equilibrium_ionization_fraction(ion.element_name,
+                                                          loop.electron_temperature)
+            return u.Quantity(ioneq[..., ion.charge_state])
         with h5py.File(self.ionization_fraction_savefile, 'r') as hf:
-            dset = hf['/'.join([loop.name, ion.element_name])]
-            ionization_fraction = u.Quantity(dset[:, :, ion.charge_state], dset.attrs['units'])
+            ionization_fraction = self._read_ionization_fraction(hf, loop, ion.element_name,
+                                                                 ion.charge_state)
 
-        return ionization_fraction
+        return self._broadcast_along_loop(loop, ionization_fraction)
+
+    def get_element_ionization_fraction(self, loop, element_name):
+        """
+        Get the ionization fractions of all charge states of an element for a particular loop
+        with a single read.
+
+        Parameters
+        ----------
+        loop : `~synthesizAR.Loop`
+        element_name : `str`
+
+        Returns
+        -------
+        ionization_fraction : `~astropy.units.Quantity`
+            The last axis corresponds to the charge state
+        """
+        if self.ionization_fraction_savefile is None:
+            return u.Quantity(self._equilibrium_ionization_fraction(element_name,
+                                                                    loop.electron_temperature))
+        with h5py.File(self.ionization_fraction_savefile, 'r') as hf:
+            ionization_fraction = self._read_ionization_fraction(hf, loop, element_name)
+
+        return self._broadcast_along_loop(loop, ionization_fraction, n_trailing=1)
+
+    def get_ionization_fractions(self, loop, ions):
+        """
+        Get ionization fractions of several ions for a particular loop.
+
+        All charge states of an element are read at once with `get_element_ionization_fraction`
+        if more than one ion of that element is requested. Otherwise, only the column for that
+        ion is read with `get_ionization_fraction`.
+
+        Parameters
+        ----------
+        loop : `~synthesizAR.Loop`
+        ions : `list`
+
+        Returns
+        -------
+        ionization_fraction : `~astropy.units.Quantity`
+            The first axis corresponds to each entry in ``ions``
+        """
+        charge_states = {}
+        for i, ion in enumerate(ions):
+            charge_states.setdefault(ion.element_name, []).append((i, ion.charge_state))
+        ionization_fraction = None
+        for element_name, indices in charge_states.items():
+            if len(indices) > 1 or self.ionization_fraction_savefile is None:
+                data = self.get_element_ionization_fraction(loop, element_name)
+                columns = [(i, data[..., charge_state]) for i, charge_state in indices]
+            else:
+                i, _ = indices[0]
+                columns = [(i, self.get_ionization_fraction(loop, ions[i]))]
+            for i, column in columns:
+                if ionization_fraction is None:
+                    unit = column.unit
+                    ionization_fraction = np.zeros((len(ions),) + column.shape)
+                ionization_fraction[i] = column.to_value(unit)
+
+        return u.Quantity(ionization_fraction, unit)
+
+    @property
+    def resolved_lines(self):
+        """
+        Ion and wavelength of each transition in ``resolved_wavelengths``, sorted by wavelength
+        """
+        ions = {ion.ion_name: ion for ion in self}
+        lines = []
+        for ion_name, wavelengths in self.resolved_wavelengths.items():
+            for wavelength in np.atleast_1d(u.Quantity(wavelengths, u.angstrom)):
+                lines.append((ions[ion_name], wavelength))
+        return sorted(lines, key=lambda l: l[1])
+
+    def _resolved_line_table(self, energy_unit='photon'):
+        """
+        Stack the emissivities of all resolved transitions into a single table
+
+        The table is built once for each set of resolved transitions and energy unit and reused
+        by every subsequent call until the emissivities are cleared.
+        """
+        lines = self.resolved_lines
+        key = (energy_unit, tuple([(ion.ion_name, wavelength.value) for ion, wavelength in lines]))
+        if key not in self._resolved_line_tables:
+            self._resolved_line_tables[key] = self._stack_resolved_lines(lines, energy_unit)
+        return self._resolved_line_tables[key]
+
+    def _stack_resolved_lines(self, lines, energy_unit):
+        table = np.zeros(self.temperature.shape + self.density.shape + (len(lines),))
+        unit = None
+        for i, (ion, wavelength) in enumerate(lines):
+            wavelength_all, emissivity = self.get_emissivity(ion)
+            if wavelength_all is None or emissivity is None:
+                warnings.warn(f'No emissivity available for {ion.ion_name}')
+                continue
+            emissivity = emissivity[:, :, np.argmin(np.fabs(wavelength_all - wavelength))]
+            if energy_unit == 'erg':
+                energy = (const.h * const.c / wavelength).to(u.erg) / u.photon
+                emissivity = emissivity * energy
+            unit = emissivity.unit if unit is None else unit
+            table[..., i] = emissivity.to(unit).value
+        return table, (u.photon / u.s if unit is None else unit)
 
     def calculate_emission(self, loop, **kwargs):
         """
@@ -208,5 +769,44 @@ class EmissionModel(fiasco.IonCollection):
         :math:`P_{\lambda}` is in units of erg cm\ :sup:`-3` s\ :sup:`-1` sr\ :sup:`-1` if
         `energy_unit` is set to `erg` and in units of photons
         cm\ :sup:`-3` s\ :sup:`-1` sr\ :sup:`-1` if `energy_unit` is set to `photon`.
+
+        The power is computed for all transitions in ``resolved_wavelengths`` at once. The
+        emissivities of all transitions are stacked into a single table which is interpolated
+        in a single pass over all points in the loop.
+
+        Parameters
+        ----------
+        loop : `~synthesizAR.Loop`
+
+        Other Parameters
+        ----------------
+        energy_unit : `str`, optional
+            Either ``'photon'`` (default) or ``'erg'``
+
+        Returns
+        -------
+        emission : `~astropy.units.Quantity`
+            Power per unit volume with the last axis corresponding to each transition in
+            `resolved_lines`
+        lines : `list`
+            Ion and wavelength of each transition
         """
-        raise NotImplementedError('Have not yet reimplemented emission calculation.')
\ No newline at end of file
+        energy_unit = kwargs.get('energy_unit', 'photon')
+        lines = self.resolved_lines
+        table, unit = self._resolved_line_table(energy_unit=energy_unit)
+        density = loop.density
+        if not lines:
+            return u.Quantity(np.zeros(density.shape + (0,)), unit), lines
+        ions = [ion for ion, _ in lines]
+        abundance = u.Quantity([ion.abundance for ion in ions]).to(u.dimensionless_unscaled).value
+        ionization_fraction = self.get_ionization_fractions(loop, ions)
+        ionization_fraction = ionization_fraction.to(u.dimensionless_unscaled).value
+        itemperature, idensity = self.interpolate_to_mesh_indices(loop, density=density)
+        emission = bilinear_lookup(table, itemperature, idensity, scale=np.ravel(density.value))
+        # NOTE: multiply in place such that no second full-size array is made
+        emission *= ionization_fraction.reshape(len(ions), -1).T
+        emission *= abundance
+        emission = np.reshape(emission, density.shape + (len(lines),))
+
+        return (u.Quantity(emission * 0.83 / (4*np.pi), unit * density.unit / u.steradian),
+                lines)
@@ -1,18 +1,25 @@
 """
 Field extrapolation methods for computing 3D vector magnetic fields from LOS magnetograms
 """
+import os
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize
-from scipy.interpolate import griddata
+from scipy.ndimage import map_coordinates
+from scipy.signal import fftconvolve
 import astropy.units as u
 import numba
-from sunpy.coordinates.frames import Heliocentric
-from astropy.utils.console import ProgressBar
+from sunpy.coordinates.frames import Heliocentric, HeliographicStonyhurst
 
 from synthesizAR.util import SpatialPair
 
-from .helpers import from_local, to_local, magnetic_field_to_yt_dataset
+from .helpers import (from_local, from_local_batch, to_local, magnetic_field_to_yt_dataset,
+                      UniformVectorField)
 from .fieldlines import trace_fieldlines, peek_fieldlines
 
 __all__ = ['PotentialField', 'peek_projections']
@@ -31,6 +38,9 @@ class PotentialField(object):
     magnetogram : `~sunpy.map.Map`
     width_z : `~astropy.units.Quantity`
     shape_z : `~astropy.units.Quantity`
+    cache_dir : `str`, optional
+        If given, the potential and vector field computed by `extrapolate` are saved here and
+        reused by later extrapolations of the same magnetogram on the same grid
 
     References
     ----------
@@ -38,8 +48,9 @@ class PotentialField(object):
     """
 
     @u.quantity_input
-    def __init__(self, magnetogram, width_z: u.cm, shape_z: u.pixel):
+    def __init__(self, magnetogram, width_z: u.cm, shape_z: u.pixel, cache_dir=None):
         self.magnetogram = magnetogram
+        self.cache_dir = cache_dir
         self.shape = SpatialPair(x=magnetogram.dimensions.x, y=magnetogram.dimensions.y, z=shape_z)
         range_x, range_y = self._calculate_range(magnetogram)
         range_z = u.Quantity([0*u.cm, width_z])
@@ -49,6 +60,7 @@ class PotentialField(object):
         self.width = SpatialPair(x=width_x.to(u.cm), y=width_y.to(u.cm), z=width_z.to(u.cm))
         self.delta = SpatialPair(x=self.width.x/self.shape.x, y=self.width.y/self.shape.y,
                                  z=self.width.z/self.shape.z)
+        self._boundary_cache = {}
 
     @u.quantity_input
     def as_yt(self, B_field):
@@ -59,7 +71,7 @@ class PotentialField(object):
                                             self.range.y, self.range.z)
 
     @u.quantity_input
-    def trace_fieldlines(self, B_field, number_fieldlines, **kwargs):
+    def trace_fieldlines(self, B_field, number_fieldlines, method='numba', **kwargs):
         """
         Trace fieldlines through vector magnetic field.
         
@@ -71,27 +83,34 @@ class PotentialField(object):
         ----------
         B_field : `~synthesizAR.util.SpatialPair`
         number_fieldlines : `int`
+        method : `str`, optional
+            Use 'numba' to trace with the compiled tracer or 'yt' to trace with yt
 
         Returns
         -------
         fieldlines : `list`
             Fieldline coordinates transformed into HEEQ
         """
-        ds = self.as_yt(B_field)
+        if method == 'yt':
+            ds = self.as_yt(B_field)
+            unit = str(ds.r['Bz'].units)
+        elif method == 'numba':
+            ds = UniformVectorField(B_field.x, B_field.y, B_field.z, self.range.x, self.range.y,
+                                    self.range.z)
+            unit = ds.unit
+        else:
+            raise ValueError(f'Unrecognized method {method}')
         lower_boundary = self.project_boundary(self.range.x, self.range.y).value
         lines = trace_fieldlines(ds, number_fieldlines, lower_boundary=lower_boundary, **kwargs)
-        fieldlines = []
-        with ProgressBar(len(lines), ipython_widget=kwargs.get('notebook', True)) as progress:
-            for l, b in lines:
-                l = u.Quantity(l, self.range.x.unit)
-                l_heeq = from_local(l[:, 0], l[:, 1], l[:, 2], self.magnetogram.center)
-                m = u.Quantity(b, str(ds.r['Bz'].units))
-                fieldlines.append((l_heeq, m))
-                # NOTE: Optionally suppress progress bar for tests
-                if kwargs.get('verbose', True):
-                    progress.update()
-
-        return fieldlines
+        if not lines:
+            return []
+        # Transform all lines to HEEQ at once
+        offsets = np.insert(np.cumsum([l.shape[0] for l, _ in lines]), 0, 0)
+        lines_local = u.Quantity(np.concatenate([l for l, _ in lines], axis=0),
+                                 self.range.x.unit)
+        lines_heeq = from_local_batch(lines_local, offsets, self.magnetogram.center)
+
+        return [(l_heeq, u.Quantity(b, unit)) for l_heeq, (_, b) in zip(lines_heeq, lines)]
         
     def _calculate_range(self, magnetogram):
         left_corner = to_local(magnetogram.bottom_left_coord, magnetogram.center)
@@ -104,23 +123,40 @@ class PotentialField(object):
         """
         Project the magnetogram onto a plane defined by the surface normal at the center of the
         magnetogram.
+
+        Rather than scattering every magnetogram pixel onto the plane and triangulating, each
+        point of the regular grid on the plane is lifted onto the solar surface, mapped back to
+        a fractional pixel in the magnetogram in a single coordinate transformation and the
+        magnetogram is then bilinearly interpolated at these pixels. The result is cached
+        such that repeated calls are free.
         """
-        # Get all points in local, rotated coordinate system
-        p_y, p_x = np.indices((int(self.shape.x.value), int(self.shape.y.value)))
-        pixels = u.Quantity([(i_x, i_y) for i_x, i_y in zip(p_x.flatten(), p_y.flatten())], 'pixel')
-        world_coords = self.magnetogram.pixel_to_world(pixels[:, 0], pixels[:, 1])
-        local_x, local_y, _ = to_local(world_coords, self.magnetogram.center)
-        # Flatten
-        points = np.stack([local_x.to(u.cm).value, local_y.to(u.cm).value], axis=1)
-        values = u.Quantity(self.magnetogram.data, self.magnetogram.meta['bunit']).value.flatten()
-        # Interpolate
-        x_new = np.linspace(range_x[0], range_x[1], int(self.shape.x.value))
-        y_new = np.linspace(range_y[0], range_y[1], int(self.shape.y.value))
-        x_grid, y_grid = np.meshgrid(x_new.to(u.cm).value, y_new.to(u.cm).value)
-        boundary_interp = griddata(points, values, (x_grid, y_grid), fill_value=0.)
-        
-        return u.Quantity(boundary_interp, self.magnetogram.meta['bunit'])
-    
+        key = (tuple(range_x.to(u.cm).value), tuple(range_y.to(u.cm).value))
+        if key in self._boundary_cache:
+            return self._boundary_cache[key]
+        x_new = np.linspace(range_x[0], range_x[1], int(self.shape.x.value)).to(u.cm).value
+        y_new = np.linspace(range_y[0], range_y[1], int(self.shape.y.value)).to(u.cm).value
+        x_grid, y_grid = np.meshgrid(x_new, y_new)
+        # Height of the solar surface above the plane tangent to the surface at the center
+        radius = self.magnetogram.center.transform_to(HeliographicStonyhurst).radius
+        radius = radius.to(u.cm).value
+        z_grid = np.sqrt(np.clip(radius**2 - x_grid**2 - y_grid**2, 0, None)) - radius
+        world_coords = from_local(x_grid.flatten()*u.cm, y_grid.flatten()*u.cm,
+                                  z_grid.flatten()*u.cm, self.magnetogram.center)
+        # NOTE: transform explicitly to the frame of the magnetogram as the local coordinates
+        # are HEEQ and must first be converted to a polar HGS frame
+        world_coords = world_coords.transform_to(HeliographicStonyhurst).transform_to(
+            self.magnetogram.coordinate_frame)
+        p_x, p_y = self.magnetogram.world_to_pixel(world_coords)
+        pixels = np.stack([p_y.value, p_x.value], axis=0)
+        pixels = np.where(np.isfinite(pixels), pixels, -1.)
+        values = u.Quantity(self.magnetogram.data, self.magnetogram.meta['bunit']).value
+        boundary_interp = map_coordinates(values, pixels, order=1, mode='constant', cval=0.)
+        boundary_interp = boundary_interp.reshape(x_grid.shape)
+
+        boundary = u.Quantity(boundary_interp, self.magnetogram.meta['bunit'])
+        self._boundary_cache[key] = boundary
+        return boundary
+
     @property
     def line_of_sight(self):
         """
@@ -129,14 +165,30 @@ class PotentialField(object):
         los = to_local(self.magnetogram.observer_coordinate, self.magnetogram.center)
         return np.squeeze(u.Quantity(los))
         
-    def calculate_phi(self):
+    def calculate_phi(self, method='fft', **kwargs):
         """
         Calculate potential
+
+        .. note:: The default method is now 'fft'. Previously, the potential was always
+                  computed with the direct sum. Pass ``method='direct'`` to reproduce earlier
+                  results exactly.
+
+        Parameters
+        ----------
+        method : `str`, optional
+            If 'fft', each layer of the potential is computed as a 2D convolution of the boundary
+            with the Green's function using FFTs. If 'direct', the Green's function is summed
+            over every boundary pixel for every point in the volume. The latter is much slower
+            and is mostly useful for validation. If 'parallel', the same direct sum is computed
+            on all available cores.
+
+        Other Parameters
+        ----------------
+        max_workers : `int`, optional
+            Number of threads used to compute the layers when ``method='fft'``
+        tile_size : `int`, optional
+            Width of the blocks of boundary pixels summed at once when ``method='parallel'``
         """
-        # Set up grid
-        y_grid, x_grid = np.indices((int(self.shape.x.value), int(self.shape.y.value)))
-        x_grid = x_grid*self.delta.x.value
-        y_grid = y_grid*self.delta.y.value
         z_depth = -self.delta.z.value/np.sqrt(2.*np.pi)
         # Project lower boundary
         boundary = self.project_boundary(self.range.x, self.range.y).value
@@ -146,13 +198,22 @@ class PotentialField(object):
         delta = SpatialPair(x=self.delta.x.value, y=self.delta.y.value, z=self.delta.z.value)
         shape = SpatialPair(x=int(self.shape.x.value), y=int(self.shape.y.value),
                             z=int(self.shape.z.value))
-        phi = np.zeros((shape.x, shape.y, shape.z))
-        phi = calculate_phi(phi, boundary, delta, shape, z_depth, l_hat)
+        if method == 'fft':
+            phi = calculate_phi_fft(boundary, delta, shape, z_depth, l_hat,
+                                    max_workers=kwargs.get('max_workers', None))
+        elif method == 'direct':
+            phi = np.zeros((shape.y, shape.x, shape.z))
+            phi = calculate_phi(phi, boundary, delta, shape, z_depth, l_hat)
+        elif method == 'parallel':
+            phi = calculate_phi_parallel(boundary, delta, shape, z_depth, l_hat,
+                                         kwargs.get('tile_size', 64))
+        else:
+            raise ValueError(f'Unrecognized method {method}')
                     
         return phi * u.Unit(self.magnetogram.meta['bunit']) * self.delta.x.unit * (1. * u.pixel)
 
     @u.quantity_input
-    def calculate_field(self, phi: u.G * u.cm):
+    def calculate_field(self, phi: u.G * u.cm, method='stencil', dtype=np.float64):
         """
         Compute vector magnetic field.
 
@@ -166,44 +227,148 @@ class PotentialField(object):
         .. math::
             \\frac{\partial B}{\partial x_i} \\approx -\left(\\frac{-B_{x_i}(x_i + 2\Delta x_i) + 8B_{x_i}(x_i + \Delta x_i) - 8B_{x_i}(x_i - \Delta x_i) + B_{x_i}(x_i - 2\Delta x_i)}{12\Delta x_i}\\right)
 
+        The two outermost layers on each side of the volume are set equal to the nearest layer
+        where the stencil is defined. Each component is written to its own contiguous array
+        without intermediate `~astropy.units.Quantity` objects.
+
         Parameters
         ----------
         phi : `~astropy.units.Quantity`
+        method : `str`, optional
+            Use 'stencil' for the five-point stencil or 'gradient' for `numpy.gradient` with
+            second-order accurate edges
+        dtype : `~numpy.dtype`, optional
+            Use `numpy.float32` to halve the memory needed for the field
 
         Returns
         -------
         B_field : `~synthesizAR.util.SpatialPair`
             x, y, and z components of the vector magnetic field in 3D
         """
-        Bfield = u.Quantity(np.zeros(phi.shape + (3,)), self.magnetogram.meta['bunit'])
-        # Take gradient--indexed as x,y,z in 4th dimension
-        Bfield[2:-2, 2:-2, 2:-2, 0] = -(phi[:-4, 2:-2, 2:-2] - 8.*phi[1:-3, 2:-2, 2:-2] 
-                                        + 8.*phi[3:-1, 2:-2, 2:-2]
-                                        - phi[4:, 2:-2, 2:-2])/12./(self.delta.x * 1. * u.pixel)
-        Bfield[2:-2, 2:-2, 2:-2, 1] = -(phi[2:-2, :-4, 2:-2] - 8.*phi[2:-2, 1:-3, 2:-2]
-                                        + 8.*phi[2:-2, 3:-1, 2:-2] 
-                                        - phi[2:-2, 4:, 2:-2])/12./(self.delta.y * 1. * u.pixel)
-        Bfield[2:-2, 2:-2, 2:-2, 2] = -(phi[2:-2, 2:-2, :-4] - 8.*phi[2:-2, 2:-2, 1:-3]
-                                        + 8.*phi[2:-2, 2:-2, 3:-1]
-                                        - phi[2:-2, 2:-2, 4:])/12./(self.delta.z * 1. * u.pixel)
-        # Set boundary conditions
-        for i in range(3):
-            for j in [0, 1]:
-                Bfield[j, :, :, i] = Bfield[2, :, :, i]
-                Bfield[:, j, :, i] = Bfield[:, 2, :, i]
-                Bfield[:, :, j, i] = Bfield[:, :, 2, i]
-            for j in [-2, -1]:
-                Bfield[j, :, :, i] = Bfield[-3, :, :, i]
-                Bfield[:, j, :, i] = Bfield[:, -3, :, i]
-                Bfield[:, :, j, i] = Bfield[:, :, -3, i]
-                
-        return SpatialPair(x=Bfield[:, :, :, 1], y=Bfield[:, :, :, 0], z=Bfield[:, :, :, 2])
+        unit = u.Unit(self.magnetogram.meta['bunit'])
+        phi = np.asarray(phi.to_value(unit * u.cm), dtype=dtype)
+        # NOTE: the gradient along the first (second) axis is scaled by delta.x (delta.y)
+        deltas = [(d * 1. * u.pixel).to_value(u.cm) for d in self.delta]
+        components = [self._derivative(phi, axis, h, method) for axis, h in enumerate(deltas)]
+
+        return SpatialPair(x=u.Quantity(components[1], unit, copy=False),
+                           y=u.Quantity(components[0], unit, copy=False),
+                           z=u.Quantity(components[2], unit, copy=False))
+
+    @staticmethod
+    def _derivative(phi, axis, h, method):
+        """
+        Negative derivative of ``phi`` along ``axis`` with spacing ``h``
+        """
+        if method == 'gradient':
+            out = np.gradient(phi, h, axis=axis, edge_order=2)
+            out *= -1.
+            return out
+        elif method != 'stencil':
+            raise ValueError(f'Unrecognized method {method}')
+
+        def shifted(shift):
+            index = [slice(2, -2)] * 3
+            index[axis] = slice(2 + shift, phi.shape[axis] - 2 + shift)
+            return phi[tuple(index)]
+
+        out = np.zeros(phi.shape, dtype=phi.dtype)
+        interior = out[2:-2, 2:-2, 2:-2]
+        tmp = np.empty(interior.shape, dtype=phi.dtype)
+        np.subtract(shifted(1), shifted(-1), out=tmp)
+        tmp *= 8.
+        np.subtract(shifted(-2), shifted(2), out=interior)
+        interior += tmp
+        interior *= -1. / (12. * h)
+        # Extend the interior to the two outermost layers along each axis
+        for ax in range(3):
+            index = [slice(None)] * 3
+            for j, j_nearest in [(0, 2), (1, 2), (-2, -3), (-1, -3)]:
+                index[ax] = j
+                target = tuple(index)
+                index[ax] = j_nearest
+                out[target] = out[tuple(index)]
+
+        return out
     
-    def extrapolate(self):
-        phi = self.calculate_phi()
-        bfield = self.calculate_field(phi)
+    def extrapolate(self, method='fft', dtype=np.float64, **kwargs):
+        """
+        Compute the potential and the vector magnetic field
+
+        If ``cache_dir`` is set, the results are looked up by a key combining the magnetogram
+        data and header, the grid and ``method``. The field is additionally keyed by ``dtype``
+        such that the potential is shared between fields of different precision. On a hit, the
+        arrays are memory-mapped from disk rather than recomputed. On a miss, they are computed
+        and saved.
+
+        .. note:: The potential is now computed with ``method='fft'`` by default rather than
+                  with the direct sum. Pass ``method='direct'`` to reproduce earlier results
+                  exactly.
+
+        Parameters
+        ----------
+        method : `str`, optional
+            Passed to `calculate_phi`. Defaults to 'fft'.
+        dtype : `~numpy.dtype`, optional
+            Passed to `calculate_field`. Defaults to `numpy.float64`.
+
+        Returns
+        -------
+        B_field : `~synthesizAR.util.SpatialPair`
+        """
+        cache_root = self._cache_root(method) if self.cache_dir is not None else None
+        names = [f'B_{c}_{np.dtype(dtype).name}' for c in ['x', 'y', 'z']]
+        if cache_root is not None and self._in_cache(cache_root, names):
+            return SpatialPair(*[self._load_cached(cache_root, n) for n in names])
+        if cache_root is not None and self._in_cache(cache_root, ['phi']):
+            phi = self._load_cached(cache_root, 'phi')
+        else:
+            phi = self.calculate_phi(method=method, **kwargs)
+            if cache_root is not None:
+                self._save_cached(cache_root, 'phi', phi)
+        bfield = self.calculate_field(phi, dtype=dtype)
+        if cache_root is not None:
+            for n, b in zip(names, bfield):
+                self._save_cached(cache_root, n, b)
         return bfield
 
+    def _cache_root(self, method):
+        """
+        Content-addressed path of the cached results for this magnetogram, grid and method
+        """
+        sha = hashlib.sha256(np.ascontiguousarray(self.magnetogram.data).tobytes())
+        header = json.dumps({k: str(v) for k, v in self.magnetogram.meta.items()},
+                            sort_keys=True)
+        sha.update(header.encode())
+        sha.update(f'{self.width.z.to(u.cm).value}|{self.shape.z.value}|{method}'.encode())
+        return os.path.join(self.cache_dir, sha.hexdigest()[:16])
+
+    @staticmethod
+    def _in_cache(cache_root, names):
+        return all([os.path.isfile(f'{cache_root}_{n}.npy')
+                    and os.path.isfile(f'{cache_root}_{n}.json') for n in names])
+
+    @staticmethod
+    def _load_cached(cache_root, name):
+        with open(f'{cache_root}_{name}.json', 'r') as f:
+            unit = json.load(f)['unit']
+        return u.Quantity(np.load(f'{cache_root}_{name}.npy', mmap_mode='r'), unit, copy=False)
+
+    @staticmethod
+    def _save_cached(cache_root, name, quantity):
+        cache_dir = os.path.dirname(cache_root)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        # NOTE: each writer uses its own temporary file such that concurrent runs never
+        # interleave their writes or read partial arrays
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npy.tmp', delete=False) as f:
+            np.save(f, np.ascontiguousarray(quantity.value))
+        os.replace(f.name, f'{cache_root}_{name}.npy')
+        with tempfile.NamedTemporaryFile(mode='w', dir=cache_dir, suffix='.json.tmp',
+                                         delete=False) as f:
+            json.dump({'unit': quantity.unit.to_string()}, f)
+        os.replace(f.name, f'{cache_root}_{name}.json')
+
     def peek(self, fieldlines, **kwargs):
         peek_fieldlines(self.magnetogram, [l for l, m in fieldlines], **kwargs)
 
@@ -223,7 +388,91 @@ def calculate_phi(phi, boundary, delta, shape, z_depth, l_hat):
     return phi
 
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True, parallel=True)
+def calculate_phi_parallel(boundary, delta, shape, z_depth, l_hat, tile_size):
+    """
+    Multithreaded direct sum of the Green's function over the boundary
+
+    The volume is split into square blocks of ``tile_size`` points in each horizontal
+    direction in each layer and each block is handled by a single thread. The boundary is
+    summed over in square tiles of the same size and each tile is applied to every point in
+    the block before moving to the next such that the same block of the boundary stays in
+    cache. The result is identical to `calculate_phi` up to rounding.
+    """
+    x_prime = np.arange(shape.x) * delta.x
+    y_prime = np.arange(shape.y) * delta.y
+    phi = np.zeros((shape.y, shape.x, shape.z))
+    n_tiles_x = (shape.x + tile_size - 1) // tile_size
+    n_tiles_y = (shape.y + tile_size - 1) // tile_size
+    for n in numba.prange(n_tiles_y * n_tiles_x * shape.z):
+        j_block = (n // (n_tiles_x * shape.z)) * tile_size
+        i_block = ((n // shape.z) % n_tiles_x) * tile_size
+        k = n % shape.z
+        j_end, i_end = min(j_block + tile_size, shape.y), min(i_block + tile_size, shape.x)
+        z = k * delta.z
+        block = np.zeros((j_end - j_block, i_end - i_block))
+        for j_tile in range(0, shape.y, tile_size):
+            for i_tile in range(0, shape.x, tile_size):
+                for j in range(j_block, j_end):
+                    for i in range(i_block, i_end):
+                        total = 0.
+                        for j_prime in range(j_tile, min(j_tile + tile_size, shape.y)):
+                            for i_prime in range(i_tile, min(i_tile + tile_size, shape.x)):
+                                green = greens_function(x_prime[i], y_prime[j], z,
+                                                        x_prime[i_prime], y_prime[j_prime],
+                                                        z_depth, l_hat)
+                                total += boundary[j_prime, i_prime] * green
+                        block[j - j_block, i - i_block] += total
+        phi[j_block:j_end, i_block:i_end, k] = block * delta.x * delta.y
+
+    return phi
+
+
+def calculate_phi_fft(boundary, delta, shape, z_depth, l_hat, max_workers=None):
+    """
+    Compute the potential by convolving the boundary with the Green's function in each layer
+
+    Because the Green's function depends only on the horizontal separation between the volume
+    point and the boundary pixel, each layer is a 2D linear convolution of the boundary with
+    the Green's function tabulated on all separations. This is equivalent to the direct sum
+    in `calculate_phi` but scales as :math:`N\log N` per layer. The layers are independent
+    and are computed in parallel.
+
+    Parameters
+    ----------
+    boundary : `~numpy.ndarray`
+        Lower boundary with shape ``(shape.y, shape.x)``
+    delta : `~synthesizAR.util.SpatialPair`
+    shape : `~synthesizAR.util.SpatialPair`
+    z_depth : `float`
+    l_hat : `~numpy.ndarray`
+    max_workers : `int`, optional
+
+    Returns
+    -------
+    phi : `~numpy.ndarray`
+        Potential with shape ``(shape.y, shape.x, shape.z)``
+    """
+    # Separations between every volume point and every boundary pixel in each direction
+    dx = np.arange(-(shape.x - 1), shape.x) * delta.x
+    dy = np.arange(-(shape.y - 1), shape.y) * delta.y
+    dx_grid, dy_grid = np.meshgrid(dx, dy)
+    phi = np.zeros((shape.y, shape.x, shape.z))
+
+    def layer(k):
+        # NOTE: x' = y' = 0 such that the Green's function is evaluated at the separation
+        green = greens_function(dx_grid, dy_grid, k*delta.z, 0., 0., z_depth, l_hat)
+        # 'valid' mode of the full kernel against the boundary is the zero-padded convolution
+        phi[:, :, k] = fftconvolve(green, boundary, mode='valid') * delta.x * delta.y
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(layer, range(shape.z)))
+
+    return phi
+
+
+# NOTE: release the GIL such that the layers in calculate_phi_fft are computed concurrently
+@numba.jit(nopython=True, nogil=True)
 def greens_function(x, y, z, x_grid, y_grid, z_depth, l_hat):
     Rx = x - x_grid
     Ry = y - y_grid
@@ -5,6 +5,7 @@ import warnings
 import functools
 
 import numpy as np
+import numba
 from scipy.interpolate import RegularGridInterpolator
 import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize
@@ -14,9 +15,13 @@ from astropy.coordinates import SkyCoord
 from sunpy.coordinates import HeliographicStonyhurst, HeliographicCarrington
 from sunpy.image.rescale import resample
 import sunpy.time
-import yt
+try:
+    import yt
+except ImportError:
+    warnings.warn('yt library required for tracing fieldlines with yt')
 
 from synthesizAR.util import is_visible
+from .helpers import UniformVectorField
 
 __all__ = ['filter_streamlines', 'find_seed_points', 'trace_fieldlines', 'peek_fieldlines',
            'from_pfsspack']
@@ -48,7 +53,8 @@ def filter_streamlines(streamline, domain_width, close_threshold=0.05,
 
 
 def find_seed_points(ds, number_fieldlines, lower_boundary=None, preexisting_seeds=None,
-                     mask_threshold=0.1, safety=2, max_failures=1000):
+                     mask_threshold=0.1, safety=2, max_failures=None, seed=None,
+                     flux_weighted=False):
     """
     Given a 3D extrapolated field and the corresponding magnetogram, estimate the locations of the
     seed points for the fieldline tracing through the extrapolated 3D volume.
@@ -69,10 +75,22 @@ def find_seed_points(ds, number_fieldlines, lower_boundary=None, preexisting_see
         positive (negative) field.
     safety : `float`
         Ensures the boundary is not resampled to impossibly small resolutions
-    max_failures : `int`
+    max_failures : `int`, optional
+        Deprecated and ignored. Seed points are drawn without replacement such that no draw
+        can fail.
+    seed : `int` or `~numpy.random.Generator`, optional
+        Seed for the random number generator, for reproducible seed points
+    flux_weighted : `bool`, optional
+        If True, sample points with probability proportional to the absolute field strength
+        rather than uniformly
     """
+    if max_failures is not None:
+        warnings.warn('max_failures is deprecated and ignored since seed points are drawn '
+                      'without replacement', DeprecationWarning)
     # Get lower boundary slice
-    if lower_boundary is None:
+    if lower_boundary is None and isinstance(ds, UniformVectorField):
+        boundary = ds.lower_boundary
+    elif lower_boundary is None:
         boundary = ds.r[:, :, 0]['Bz'].reshape(ds.domain_dimensions[:2]).value.T
     else:
         boundary = lower_boundary
@@ -94,36 +112,34 @@ def find_seed_points(ds, number_fieldlines, lower_boundary=None, preexisting_see
     masked_boundary_resampled = np.ma.masked_invalid(mask_func(boundary_resampled, mask_val))
 
     # find the unmasked indices
-    unmasked_indices = [(ix, iy) for iy, ix in zip(*np.where(masked_boundary_resampled.mask == 0))]
-
-    if len(unmasked_indices) < number_fieldlines:
-        raise ValueError('Requested number of seed points too large. Increase safety factor.')
+    iy, ix = np.nonzero(~np.ma.getmaskarray(masked_boundary_resampled))
 
     x_pos = np.linspace(ds.domain_left_edge[0].value, ds.domain_right_edge[0].value,
                         resample_resolution)
     y_pos = np.linspace(ds.domain_left_edge[1].value, ds.domain_right_edge[1].value,
                         resample_resolution)
-
-    # choose seed points
-    seed_points = []
-    if preexisting_seeds is None:
-        preexisting_seeds = []
-    i_fail = 0
     z_pos = ds.domain_left_edge.value[2]
-    while len(seed_points) < number_fieldlines and i_fail < max_failures:
-        choice = np.random.randint(0, len(unmasked_indices))
-        ix, iy = unmasked_indices[choice]
-        _tmp = [x_pos[ix], y_pos[iy], z_pos]
-        if _tmp not in preexisting_seeds:
-            seed_points.append(_tmp)
-            i_fail = 0
-        else:
-            i_fail += 1
-        del unmasked_indices[choice]
+    candidates = np.stack([x_pos[ix], y_pos[iy], np.full(ix.shape, z_pos)], axis=1)
 
-    if i_fail == max_failures:
-        raise ValueError(f'''Could not find desired number of seed points within failure tolerance of
-                             {max_failures}. Try increasing safety factor or the mask threshold''')
+    # throw out any points that have already been used
+    if preexisting_seeds is not None and len(preexisting_seeds) > 0:
+        preexisting_seeds = set(map(tuple, np.asarray(preexisting_seeds).tolist()))
+        unused = np.array([tuple(c) not in preexisting_seeds for c in candidates.tolist()],
+                          dtype=bool)
+        candidates = candidates[unused]
+        iy, ix = iy[unused], ix[unused]
+
+    if candidates.shape[0] < number_fieldlines:
+        raise ValueError('Requested number of seed points too large. Increase safety factor.')
+
+    # choose seed points
+    weights = None
+    if flux_weighted:
+        weights = np.fabs(np.asarray(boundary_resampled)[iy, ix])
+        weights = weights / weights.sum()
+    rng = np.random.default_rng(seed)
+    choice = rng.choice(candidates.shape[0], size=number_fieldlines, replace=False, p=weights)
+    seed_points = candidates[choice].tolist()
 
     return seed_points
 
@@ -133,14 +149,19 @@ def trace_fieldlines(ds, number_fieldlines, max_tries=100, get_seed_points=None,
     """
     Trace lines of constant potential through a 3D magnetic field volume.
 
-    Given a YT dataset containing a 3D vector magnetic field, trace a number of streamlines
-    through the volume. This function also accepts any of the keyword arguments that can
-    be passed to `~synthesizAR.extrapolate.find_seed_points` and
+    Given a 3D vector magnetic field, trace a number of streamlines through the volume. This
+    function also accepts any of the keyword arguments that can be passed to
+    `~synthesizAR.extrapolate.find_seed_points` and
     `~synthesizAR.extrapolate.filter_streamlines`.
 
+    If the field is a `~synthesizAR.extrapolate.UniformVectorField`, the streamlines are
+    integrated with a compiled fourth-order Runge-Kutta tracer in parallel over all seed
+    points and are filtered as they are traced. Otherwise, the field must be a yt dataset and
+    the streamlines are integrated with yt.
+
     Parameters
     ----------
-    ds : `~yt.frontends.stream.data_structures.StreamDataset`
+    ds : `~synthesizAR.extrapolate.UniformVectorField` or yt dataset
         Dataset containing the 3D extrapolated vector field
     number_fieldlines : `int`
     max_tries : `int`, optional
@@ -150,16 +171,33 @@ def trace_fieldlines(ds, number_fieldlines, max_tries=100, get_seed_points=None,
         Use +1 to trace from positive to negative field and -1 to trace from negative to positive
         field
 
+    Other Parameters
+    ----------------
+    seed : `int`, optional
+        Seed for choosing reproducible seed points
+    flux_weighted : `bool`, optional
+        If True, choose seed points in proportion to the field strength at the boundary
+    step_size : `float`, optional
+        Integration step as a fraction of the smallest cell width, only used for a
+        `~synthesizAR.extrapolate.UniformVectorField`
+    batch_size : `int`, optional
+        Number of streamlines traced at once, only used for a
+        `~synthesizAR.extrapolate.UniformVectorField`
+
     Returns
     -------
     fieldlines : `list`
     """
     get_seed_points = find_seed_points if get_seed_points is None else get_seed_points
+    if isinstance(ds, UniformVectorField):
+        return _trace_fieldlines_compiled(ds, number_fieldlines, max_tries, get_seed_points,
+                                          direction, **kwargs)
     # wrap the streamline filter method so we can pass a loop length range to it
     streamline_filter_wrapper = np.vectorize(filter_streamlines,
                                              excluded=[1]+list(kwargs.keys()))
     fieldlines = []
     seed_points = []
+    seed_kwargs = {k: kwargs[k] for k in ('seed', 'flux_weighted') if k in kwargs}
     i_tries = 0
     while len(fieldlines) < number_fieldlines and i_tries < max_tries:
         remaining_fieldlines = number_fieldlines - len(fieldlines)
@@ -167,7 +205,8 @@ def trace_fieldlines(ds, number_fieldlines, max_tries=100, get_seed_points=None,
                                       lower_boundary=kwargs.get('lower_boundary', None),
                                       preexisting_seeds=seed_points,
                                       mask_threshold=kwargs.get('mask_threshold', 0.1),
-                                      safety=kwargs.get('safety', 2.))
+                                      safety=kwargs.get('safety', 2.),
+                                      **seed_kwargs)
         yt_unit = ds.domain_width / ds.domain_width.value
         streamlines = yt.visualization.api.Streamlines(ds, seed_points * yt_unit,
                                                        xfield='Bx', yfield='By', zfield='Bz',
@@ -203,6 +242,137 @@ def trace_fieldlines(ds, number_fieldlines, max_tries=100, get_seed_points=None,
     return fieldlines
 
 
+def _trace_fieldlines_compiled(ds, number_fieldlines, max_tries, get_seed_points, direction,
+                               **kwargs):
+    """
+    Trace fieldlines through a uniform grid with the compiled tracer
+    """
+    close_threshold = kwargs.get('close_threshold', 0.05)
+    loop_length_range = u.Quantity(kwargs.get('loop_length_range', [2.e+9, 5.e+10]*u.cm))
+    loop_length_range = loop_length_range.to(u.cm).value
+    left_edge = ds.domain_left_edge.to(u.cm).value
+    right_edge = ds.domain_right_edge.to(u.cm).value
+    cell_width = ds.cell_width.to(u.cm).value
+    step = kwargs.get('step_size', 0.5) * cell_width.min()
+    # NOTE: lines longer than the maximum length are rejected anyway
+    max_steps = int(np.ceil(loop_length_range[1] / step)) + 2
+    batch_size = kwargs.get('batch_size', 1024)
+    fieldlines = []
+    seed_points = []
+    seed_kwargs = {k: kwargs[k] for k in ('seed', 'flux_weighted') if k in kwargs}
+    i_tries = 0
+    while len(fieldlines) < number_fieldlines and i_tries < max_tries:
+        remaining_fieldlines = number_fieldlines - len(fieldlines)
+        seed_points = get_seed_points(ds, remaining_fieldlines,
+                                      lower_boundary=kwargs.get('lower_boundary', None),
+                                      preexisting_seeds=seed_points,
+                                      mask_threshold=kwargs.get('mask_threshold', 0.1),
+                                      safety=kwargs.get('safety', 2.),
+                                      **seed_kwargs)
+        seeds = np.array(seed_points, dtype=np.float64).reshape((-1, 3))
+        n_kept = 0
+        for start in range(0, seeds.shape[0], batch_size):
+            batch = seeds[start:start + batch_size]
+            lines = np.zeros((batch.shape[0], max_steps, 3))
+            magnitudes = np.zeros((batch.shape[0], max_steps))
+            n_points = np.zeros(batch.shape[0], dtype=np.int64)
+            keep = np.zeros(batch.shape[0], dtype=np.bool_)
+            _trace_streamlines(ds.Bx, ds.By, ds.Bz, left_edge, right_edge, cell_width, batch,
+                               float(direction), step, max_steps, close_threshold,
+                               loop_length_range[0], loop_length_range[1], lines, magnitudes,
+                               n_points, keep)
+            for i in np.where(keep)[0]:
+                fieldlines.append((lines[i, :n_points[i]].copy(),
+                                   magnitudes[i, :n_points[i]].copy()))
+                n_kept += 1
+        if n_kept == 0:
+            i_tries += 1
+            warnings.warn(f'No acceptable streamlines found. Tries left = {max_tries - i_tries}')
+        else:
+            i_tries = 0
+
+    if i_tries == max_tries:
+        warnings.warn(f'Maxed out number of tries with {len(fieldlines)} acceptable streamlines')
+
+    return fieldlines[:number_fieldlines]
+
+
+@numba.jit(nopython=True)
+def _interpolate_vector(Bx, By, Bz, left_edge, cell_width, point):
+    """
+    Trilinear interpolation of a cell-centered vector field indexed as (y, x, z)
+    """
+    shape = (Bx.shape[1], Bx.shape[0], Bx.shape[2])
+    index = np.zeros(3, dtype=np.int64)
+    weight = np.zeros(3)
+    for d in range(3):
+        f = (point[d] - left_edge[d]) / cell_width[d] - 0.5
+        f = min(max(f, 0.), shape[d] - 1.)
+        i = min(int(f), max(shape[d] - 2, 0))
+        index[d] = i
+        weight[d] = f - i
+    b = np.zeros(3)
+    for c in range(8):
+        ix = index[0] + (c & 1)
+        iy = index[1] + ((c >> 1) & 1)
+        iz = index[2] + ((c >> 2) & 1)
+        if ix >= shape[0] or iy >= shape[1] or iz >= shape[2]:
+            continue
+        w = ((weight[0] if c & 1 else 1. - weight[0])
+             * (weight[1] if (c >> 1) & 1 else 1. - weight[1])
+             * (weight[2] if (c >> 2) & 1 else 1. - weight[2]))
+        b[0] += w * Bx[iy, ix, iz]
+        b[1] += w * By[iy, ix, iz]
+        b[2] += w * Bz[iy, ix, iz]
+    return b
+
+
+@numba.jit(nopython=True)
+def _field_direction(Bx, By, Bz, left_edge, cell_width, point, direction):
+    b = _interpolate_vector(Bx, By, Bz, left_edge, cell_width, point)
+    magnitude = np.sqrt((b**2).sum())
+    if magnitude == 0.:
+        return b
+    return direction * b / magnitude
+
+
+@numba.jit(nopython=True, parallel=True)
+def _trace_streamlines(Bx, By, Bz, left_edge, right_edge, cell_width, seeds, direction, step,
+                       max_steps, close_threshold, min_length, max_length, lines, magnitudes,
+                       n_points, keep):
+    """
+    Integrate streamlines from each seed point with RK4 until they leave the domain
+    """
+    for s in numba.prange(seeds.shape[0]):
+        point = seeds[s].copy()
+        length = 0.
+        n = 0
+        while n < max_steps:
+            if np.any(point < left_edge) or np.any(point > right_edge):
+                break
+            if n > 0:
+                length += np.sqrt(((point - lines[s, n-1])**2).sum())
+            b = _interpolate_vector(Bx, By, Bz, left_edge, cell_width, point)
+            lines[s, n] = point
+            magnitudes[s, n] = np.sqrt((b**2).sum())
+            n += 1
+            if magnitudes[s, n-1] == 0. or length > max_length:
+                break
+            k1 = _field_direction(Bx, By, Bz, left_edge, cell_width, point, direction)
+            k2 = _field_direction(Bx, By, Bz, left_edge, cell_width, point + step/2.*k1,
+                                  direction)
+            k3 = _field_direction(Bx, By, Bz, left_edge, cell_width, point + step/2.*k2,
+                                  direction)
+            k4 = _field_direction(Bx, By, Bz, left_edge, cell_width, point + step*k3,
+                                  direction)
+            point = point + step/6.*(k1 + 2.*k2 + 2.*k3 + k4)
+        n_points[s] = n
+        # Same criteria as filter_streamlines
+        closed = (np.fabs(lines[s, 0, 2] - lines[s, n-1, 2])
+                  <= close_threshold * (right_edge[2] - left_edge[2]))
+        keep[s] = n > 1 and closed and min_length <= length <= max_length
+
+
 def peek_fieldlines(magnetogram, fieldlines, **kwargs):
     """
     Quick plot of streamlines overplotted on magnetogram
@@ -242,61 +412,56 @@ def peek_fieldlines(magnetogram, fieldlines, **kwargs):
     plt.show()
 
 
-def from_pfsspack(pfss_fieldlines):
+def from_pfsspack(pfss_fieldlines, ragged=False):
     """
     Convert fieldline coordinates output from the SSW package `pfss <http://www.lmsal.com/~derosa/pfsspack/>`_ 
     into `~astropy.coordinates.SkyCoord` objects.
 
+    The valid points of all fieldlines are gathered into a single set of arrays and the field
+    strength is interpolated at all of them at once.
+
     Parameters
     ----------
     pfss_fieldlines : `~numpy.recarray`
         Structure produced by reading pfss output with `~scipy.io.readsav`
+    ragged : `bool`, optional
+        If True, return the coordinates and field strengths of all fieldlines concatenated
+        together along with the index at which each fieldline starts
 
     Returns
     -------
     fieldlines : `list`
         Each entry is a `tuple` containing a `~astropy.coordinates.SkyCoord` object and a
         `~astropy.units.Quantity` object listing the coordinates and field strength along the loop.
+        If ``ragged`` is True, a `tuple` of the concatenated coordinates, the concatenated field
+        strengths and the offsets of each fieldline is returned instead.
     """
+    # NOTE: For an unknown reason, there are a number of invalid points for each line output
+    # by pfss
+    n_valid = np.asarray(pfss_fieldlines['nstep']).astype(int)
+    ptr = np.asarray(pfss_fieldlines['ptr'])
+    valid = np.arange(ptr.shape[1])[np.newaxis, :] < n_valid[:, np.newaxis]
+    offsets = np.insert(np.cumsum(n_valid), 0, 0)
     # Fieldline coordinates
-    num_fieldlines = pfss_fieldlines['ptr'].shape[0]
-    fieldlines = []
-    for i in range(num_fieldlines):
-        # NOTE: For an unknown reason, there are a number of invalid points for each line output
-        # by pfss
-        n_valid = pfss_fieldlines['nstep'][i]
-        lon = (pfss_fieldlines['ptph'][i, :] * u.radian).to(u.deg)[:n_valid]
-        lat = 90 * u.deg - (pfss_fieldlines['ptth'][i, :] * u.radian).to(u.deg)[:n_valid]
-        radius = ((pfss_fieldlines['ptr'][i, :]) * const.R_sun.to(u.cm))[:n_valid]
-        coord = SkyCoord(
-            lon=lon, lat=lat, radius=radius,
-            frame=HeliographicCarrington(
-                obstime=sunpy.time.parse_time(pfss_fieldlines['now'].decode('utf-8'))))
-        fieldlines.append(coord)
-        
+    lon = np.mod(np.rad2deg(np.asarray(pfss_fieldlines['ptph'])[valid]), 360.)
+    lat = 90. - np.rad2deg(np.asarray(pfss_fieldlines['ptth'])[valid])
+    radius = ptr[valid] * const.R_sun.to(u.cm).value
+    coords = SkyCoord(
+        lon=lon * u.deg, lat=lat * u.deg, radius=radius * u.cm,
+        frame=HeliographicCarrington(
+            obstime=sunpy.time.parse_time(pfss_fieldlines['now'].decode('utf-8'))))
+
     # Magnetic field strengths
     lon_grid = (pfss_fieldlines['phi'] * u.radian - np.pi * u.radian).to(u.deg).value
     lat_grid = (np.pi / 2. * u.radian - pfss_fieldlines['theta'] * u.radian).to(u.deg).value
     radius_grid = pfss_fieldlines['rix'] * const.R_sun.to(u.cm).value
-    B_radius = pfss_fieldlines['br']
-    B_lat = pfss_fieldlines['bth']
-    B_lon = pfss_fieldlines['bph']
-    # Create interpolators
-    B_radius_interpolator = RegularGridInterpolator((radius_grid, lat_grid, lon_grid), B_radius,
-                                                    bounds_error=False, fill_value=None)
-    B_lat_interpolator = RegularGridInterpolator((radius_grid, lat_grid, lon_grid), B_lat,
-                                                 bounds_error=False, fill_value=None)
-    B_lon_interpolator = RegularGridInterpolator((radius_grid, lat_grid, lon_grid), B_lon,
-                                                 bounds_error=False, fill_value=None)
-    # Interpolate values through each line
-    field_strengths = []
-    for f in fieldlines:
-        points = np.stack([f.spherical.distance.to(u.cm).value,
-                           f.spherical.lat.to(u.deg).value,
-                           f.spherical.lon.to(u.deg).value], axis=1)
-        b_r = B_radius_interpolator(points)
-        b_lat = B_lat_interpolator(points)
-        b_lon = B_lon_interpolator(points)
-        field_strengths.append(np.sqrt(b_r**2 + b_lat**2 + b_lon**2) * u.Gauss)
-    
-    return [(l, b) for l, b in zip(fieldlines, field_strengths)]
+    B_components = np.stack([pfss_fieldlines['br'], pfss_fieldlines['bth'],
+                             pfss_fieldlines['bph']], axis=-1)
+    B_interpolator = RegularGridInterpolator((radius_grid, lat_grid, lon_grid), B_components,
+                                             bounds_error=False, fill_value=None)
+    b = B_interpolator(np.stack([radius, lat, lon], axis=1))
+    field_strengths = np.sqrt((b**2).sum(axis=1)) * u.Gauss
+
+    if ragged:
+        return coords, field_strengths, offsets
+    return [(coords[i:j], field_strengths[i:j]) for i, j in zip(offsets[:-1], offsets[1:])]
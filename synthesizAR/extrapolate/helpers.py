@@ -1,17 +1,23 @@
 """
 Helper routines for field extrapolation routines and dealing with vector field data
 """
+import warnings
+
 import numpy as np
 import astropy.time
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 import astropy.constants as const
-import yt
+try:
+    import yt
+except ImportError:
+    warnings.warn('yt library required for converting fields to yt datasets')
 import sunpy.coordinates
 from sunpy.util.metadata import MetaDict
 from sunpy.map import GenericMap
 
-__all__ = ['synthetic_magnetogram', 'magnetic_field_to_yt_dataset', 'from_local', 'to_local']
+__all__ = ['synthetic_magnetogram', 'magnetic_field_to_yt_dataset', 'UniformVectorField',
+           'from_local', 'from_local_batch', 'to_local']
 
 
 @u.quantity_input
@@ -119,6 +125,49 @@ def magnetic_field_to_yt_dataset(Bx: u.gauss, By: u.gauss, Bz: u.gauss, range_x:
                                 geometry=('cartesian', ('x', 'y', 'z')))
 
 
+class UniformVectorField(object):
+    """
+    Vector magnetic field on a uniform, cell-centered Cartesian grid
+
+    This is a lightweight alternative to `magnetic_field_to_yt_dataset` that holds the field
+    components as contiguous arrays such that they can be passed directly to compiled
+    routines, e.g. for tracing fieldlines. The components are indexed as ``(y, x, z)``, the
+    same as those returned by `~synthesizAR.extrapolate.PotentialField.calculate_field`.
+    Contiguous components in Gauss, e.g. memory-mapped from the extrapolation cache, are
+    used without copying.
+
+    Parameters
+    ----------
+    Bx,By,Bz : `~astropy.units.Quantity`
+        3D arrays holding the x,y,z components of the extrapolated field
+    range_x, range_y, range_z : `~astropy.units.Quantity`
+        Spatial range in the x,y,z dimensions of the grid
+    """
+
+    @u.quantity_input
+    def __init__(self, Bx: u.gauss, By: u.gauss, Bz: u.gauss, range_x: u.cm, range_y: u.cm,
+                 range_z: u.cm):
+        self.unit = u.gauss
+        self.Bx = np.ascontiguousarray(Bx.to_value(self.unit), dtype=np.float64)
+        self.By = np.ascontiguousarray(By.to_value(self.unit), dtype=np.float64)
+        self.Bz = np.ascontiguousarray(Bz.to_value(self.unit), dtype=np.float64)
+        self.domain_left_edge = u.Quantity([range_x[0], range_y[0], range_z[0]]).to(u.cm)
+        self.domain_right_edge = u.Quantity([range_x[1], range_y[1], range_z[1]]).to(u.cm)
+        self.domain_width = self.domain_right_edge - self.domain_left_edge
+        self.domain_dimensions = np.array([Bx.shape[1], Bx.shape[0], Bx.shape[2]])
+
+    @property
+    def cell_width(self):
+        return self.domain_width / self.domain_dimensions
+
+    @property
+    def lower_boundary(self):
+        """
+        z-component of the field in the lowest layer, indexed as ``(y, x)``
+        """
+        return self.Bz[:, :, 0]
+
+
 @u.quantity_input
 def from_local(x_local: u.cm, y_local: u.cm, z_local: u.cm, center):
     """
@@ -149,6 +198,42 @@ def from_local(x_local: u.cm, y_local: u.cm, z_local: u.cm, center):
                     frame=sunpy.coordinates.HeliographicStonyhurst, representation='cartesian')
 
 
+def from_local_batch(xyz_local, offsets, center):
+    """
+    Transform many lines from the local Cartesian frame centered on the active region at once.
+
+    The lines are passed as a single concatenated array. The rotation is built once and
+    applied to all points in a single matrix multiplication and a single
+    `~astropy.coordinates.SkyCoord` is created for all points. The coordinates of each line
+    are slices of this object.
+
+    Parameters
+    ----------
+    xyz_local : `~astropy.units.Quantity`
+        Coordinates of all lines with shape ``(N, 3)``
+    offsets : array-like
+        Index of the first point of each line, followed by ``N``
+    center : `~astropy.coordinates.SkyCoord`
+        Center of the active region
+
+    Returns
+    -------
+    coords : `list`
+        `~astropy.coordinates.SkyCoord` for each line in HEEQ coordinates
+    """
+    center = center.transform_to(sunpy.coordinates.frames.HeliographicStonyhurst)
+    xyz_center = center.cartesian.xyz.to(u.cm).value
+    rotation = np.array(rotate_z(center.lon) @ rotate_y(-center.lat), dtype=np.float64)
+    xyz_local = u.Quantity(xyz_local).to(u.cm).value
+    # NOTE: the coordinates are permuted because the local z-axis is parallel to the surface normal
+    xyz_heeq = rotation @ xyz_local[:, [2, 0, 1]].T + np.reshape(xyz_center, (3, 1))
+    coords = SkyCoord(x=xyz_heeq[0, :]*u.cm, y=xyz_heeq[1, :]*u.cm, z=xyz_heeq[2, :]*u.cm,
+                      frame=sunpy.coordinates.HeliographicStonyhurst,
+                      representation='cartesian')
+    offsets = np.asarray(offsets)
+    return [coords[i:j] for i, j in zip(offsets[:-1], offsets[1:])]
+
+
 @u.quantity_input
 def to_local(coord, center):
     """
@@ -140,7 +140,7 @@ Magnetogram Info:
         """
         Load in loop parameters from hydrodynamic results.
         """
-        notebook = kwargs.get('notebook', True)
+        notebook = kwargs.pop('notebook', True)
         with h5py.File(savefile, 'w') as hf:
             with ProgressBar(len(self.loops), ipython_widget=notebook) as progress:
                 for loop in self.loops:
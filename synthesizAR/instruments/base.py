@@ -4,9 +4,10 @@ Base class for instrument objects.
 
 import os
 import pickle
+import hashlib
 
 import numpy as np
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, splev
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 import h5py
@@ -14,7 +15,79 @@ from sunpy.util.metadata import MetaDict
 from sunpy.sun import constants
 from sunpy.coordinates.frames import Heliocentric, Helioprojective, HeliographicStonyhurst
 
-from synthesizAR.util import SpatialPair
+from synthesizAR.util import SpatialPair, read_frame, linear_lookup
+
+# NOTE: hashing large emissivity files is expensive so only do it once per file version
+_FILE_HASHES = {}
+
+
+def _file_hash(filename, block_size=2**20):
+    """
+    SHA-256 hash of the contents of a file, memoized on the path, size and modification time
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if key not in _FILE_HASHES:
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        _FILE_HASHES[key] = sha.hexdigest()
+    return _FILE_HASHES[key]
+
+
+class ChannelEmissivityTable(object):
+    """
+    Channel-weighted emissivities for every ion in an emission model.
+
+    The emissivities of all ions are stored in a single ``(n_ion, n_T, n_n)`` array. Indexing or
+    iterating over the table yields the emissivity of each ion as a `~astropy.units.Quantity`,
+    or `None` if no emissivity is available for that ion. When the table is backed by a file,
+    the array is memory-mapped and only the filename is pickled such that the table can be
+    shared between worker processes rather than copied into every task.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray` or `str`
+        Emissivity array or path to a ``.npy`` file holding it
+    unit : `~astropy.units.Unit`
+    valid : array-like
+        Boolean mask of ions with an emissivity
+    """
+
+    def __init__(self, data, unit, valid):
+        if isinstance(data, str):
+            self.filename = data
+            self._data = None
+        else:
+            self.filename = None
+            self._data = data
+        self.unit = u.Unit(unit)
+        self.valid = np.array(valid, dtype=bool)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(self.filename, mmap_mode='r')
+        return self._data
+
+    def __len__(self):
+        return self.valid.shape[0]
+
+    def __getitem__(self, index):
+        if not self.valid[index]:
+            return None
+        return u.Quantity(self.data[index], self.unit, copy=False)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.filename is not None:
+            state['_data'] = None
+        return state
 
 
 class InstrumentBase(object):
@@ -45,6 +118,44 @@ class InstrumentBase(object):
         """
         raise NotImplementedError('No detect method implemented.')
 
+    def _setup_temperature_response_table(self, log_temperature_dex=1e-3):
+        """
+        Tabulate the temperature response of every channel on a single grid, uniform in
+        :math:`\log_{10}T`, such that all channels can be evaluated with one lookup.
+        """
+        knots = [channel['temperature_response_spline'][0] for channel in self.channels]
+        log_t_min = np.log10(min([k[0] for k in knots]))
+        log_t_max = np.log10(max([k[-1] for k in knots]))
+        n_temperature = int(np.ceil((log_t_max - log_t_min) / log_temperature_dex)) + 1
+        log_temperature = np.linspace(log_t_min, log_t_max, n_temperature)
+        # NOTE: the response is set to zero outside of the range each channel is defined on
+        response = np.stack([splev(10.**log_temperature, channel['temperature_response_spline'],
+                                   ext=1)
+                             for channel in self.channels], axis=1)
+        self.temperature_response_table = (log_temperature, response)
+        for i, channel in enumerate(self.channels):
+            channel['temperature_response_table'] = (log_temperature, response[:, i])
+
+    def calculate_counts_simple_channels(self, loop, *args, **kwargs):
+        """
+        Calculate the intensity in every channel at once using only the tabulated temperature
+        response functions.
+
+        Parameters
+        ----------
+        loop : `~synthesizAR.Loop`
+
+        Returns
+        -------
+        counts : `~astropy.units.Quantity`
+            The last axis corresponds to the channels in ``self.channels``
+        """
+        log_temperature = np.log10(loop.electron_temperature.to(u.K).value)
+        response = linear_lookup(log_temperature, *self.temperature_response_table)
+        density = loop.density
+        return ((density**2)[..., np.newaxis] * response
+                * u.count * u.cm**5 / u.s / u.pixel)
+
     def build_detector_file(self, file_template, dset_shape, chunks, *args, **kwargs):
         """
         Allocate space for counts data.
@@ -118,6 +229,23 @@ class InstrumentBase(object):
         else:
             return interpolated_y * y.unit
 
+    def interpolate_and_store_channels(self, y, loop, interp_s, start_index, save_dir,
+                                       dset_names):
+        """
+        Interpolate several quantities at once in time and space and write each to its own
+        file to be assembled by `assemble_arrays`. The last axis of ``y`` corresponds to each
+        entry in ``dset_names``.
+        """
+        interpolated_y = self.interpolate_and_store(y, loop, interp_s)
+        save_paths = []
+        for i, dset_name in enumerate(dset_names):
+            save_path = os.path.join(save_dir, f'{loop.name}_{self.name}_{dset_name}.pkl')
+            with open(save_path, 'wb') as f:
+                pickle.dump((interpolated_y.value[..., i], interpolated_y.unit.to_string(),
+                             start_index, dset_name), f)
+            save_paths.append(save_path)
+        return save_paths
+
     @staticmethod
     def assemble_arrays(interp_files, savefile):
         """
@@ -142,9 +270,8 @@ class InstrumentBase(object):
         """
         Turn flattened quantity into 2D weighted histogram
         """
+        weights, units = read_frame(counts_filename, dset_name, i_time)
         with h5py.File(counts_filename, 'r') as hf:
-            weights = np.array(hf[dset_name][i_time, :])
-            units = u.Unit(hf[dset_name].attrs['units'])
             coordinates = np.array(hf['coordinates'][:, :2])
         hc, _ = np.histogramdd(coordinates, bins=bins[:2], range=bin_range[:2])
         h, _ = np.histogramdd(coordinates, bins=bins[:2], range=bin_range[:2], weights=weights)
@@ -6,6 +6,8 @@ and other instrument-specific information.
 import os
 import json
 import pkg_resources
+import warnings
+import toolz
 
 import numpy as np
 from scipy.interpolate import splrep, splev, interp1d
@@ -18,8 +20,12 @@ import astropy.convolution
 import h5py
 import plasmapy
 import dask
+try:
+    import distributed
+except ImportError:
+    warnings.warn('Dask distributed scheduler required for parallel execution')
 
-from synthesizAR.util import SpatialPair
+from synthesizAR.util import SpatialPair, read_frame, linear_lookup
 from synthesizAR.instruments import InstrumentBase
 from synthesizAR.maps import EISCube
 
@@ -88,35 +94,93 @@ class InstrumentHinodeEIS(InstrumentBase):
         header['cdelt3'] = np.fabs(np.diff(channel['response']['x']).value[0])
         return header
 
-    def build_detector_file(self, file_template, chunks, field):
+    def build_detector_file(self, file_template, dset_shape, chunks, *args, emission_model=None,
+                            parallel=False, **kwargs):
         """
         Build HDF5 files to store detector counts
-        """
-        additional_fields = ['{}'.format(line.value) for line in field.loops[0].resolved_wavelengths]
-        super().build_detector_file(file_template, chunks, additional_fields=additional_fields)
 
-    def flatten(self, loop, interp_s, hf, start_index):
+        One dataset is allocated for each transition in the ``resolved_wavelengths`` of the
+        emission model and each channel is told which of these transitions fall within it.
+
+        .. note:: The transitions are no longer read from the loops such that the emission
+                  model must be passed, e.g. through `~synthesizAR.Observer.build_detector_files`.
         """
-        Flatten loop emission to HDF5 file for given number of wavelengths
+        if emission_model is None:
+            raise ValueError('An emission model is required to allocate the transitions for EIS')
+        wavelengths = [w for _, w in emission_model.resolved_lines]
+        for channel in self.channels:
+            channel['model_wavelengths'] = [w for w in wavelengths
+                                            if channel['wavelength_range'][0] <= w
+                                            <= channel['wavelength_range'][-1]]
+            if channel['model_wavelengths']:
+                channel['model_wavelengths'] = u.Quantity(channel['model_wavelengths'])
+        additional_fields = ['{}'.format(w.value) for w in wavelengths]
+        super().build_detector_file(file_template, dset_shape, chunks, *args,
+                                    additional_fields=additional_fields, parallel=parallel)
+
+    def flatten_serial(self, loops, interpolated_loop_coordinates, hf, emission_model=None,
+                       **kwargs):
         """
-        for wavelength in loop.resolved_wavelengths:
-            emiss, ion_name = loop.get_emission(wavelength, return_ion_name=True)
-            dset = hf['{}'.format(str(wavelength.value))]
-            dset.attrs['ion_name'] = ion_name
-            self.interpolate_and_store(emiss, loop, interp_s, dset, start_index)
+        Interpolate the emission in each resolved transition to the temporal resolution of the
+        instrument and appropriate spatial scale.
+
+        All transitions are computed together for each loop such that the loop hydrodynamics
+        are only loaded and interpolated once.
+        """
+        if emission_model is None:
+            raise ValueError('An emission model is required to compute line emission for EIS')
+        start_index = 0
+        for loop, interp_s in zip(loops, interpolated_loop_coordinates):
+            emission, lines = emission_model.calculate_emission(loop)
+            # NOTE: interpolate all transitions at once; the last axis is carried through
+            y = self.interpolate_and_store(emission, loop, interp_s)
+            for i, (ion, wavelength) in enumerate(lines):
+                dset = hf['{}'.format(wavelength.value)]
+                dset.attrs['ion_name'] = f'{ion.atomic_symbol} {ion.ionization_stage}'
+                self.commit(y[..., i], dset, start_index)
+            start_index += interp_s.shape[0]
 
     @staticmethod
-    def compute_emission():
+    def calculate_emission(loop, emission_model):
         """
-        Compute intensity for transitions observed by EIS
+        Emission in each resolved transition, without the list of transitions
         """
-        pass
-    
-    def flatten_parallel(self, loops, interpolated_loop_coordinates, save_path, emission_model):
+        emission, _ = emission_model.calculate_emission(loop)
+        return emission
+
+    def flatten_parallel(self, loops, interpolated_loop_coordinates, tmp_dir, emission_model=None,
+                         **kwargs):
         """
-        Build task graph for computing EIS spectra
+        Interpolate the emission in each resolved transition to the temporal resolution of the
+        instrument and appropriate spatial scale. Returns a list of the files the results are
+        written to.
+
+        All transitions are computed together for each loop. The emission model is sent to
+        each worker only once.
         """
-        pass
+        if emission_model is None:
+            raise ValueError('An emission model is required to compute line emission for EIS')
+        # Setup scheduler
+        client = distributed.get_client()
+        start_indices = np.insert(np.array(
+            [s.shape[0] for s in interpolated_loop_coordinates]).cumsum()[:-1], 0, 0)
+        lines = emission_model.resolved_lines
+        with h5py.File(self.counts_file, 'a') as hf:
+            for ion, wavelength in lines:
+                hf['{}'.format(wavelength.value)].attrs['ion_name'] = (
+                    f'{ion.atomic_symbol} {ion.ionization_stage}')
+        # NOTE: wrap in a list such that the model is scattered as a single object
+        emission_model, = client.scatter([emission_model], broadcast=True)
+        emission_futures = client.map(self.calculate_emission, loops,
+                                      emission_model=emission_model)
+        partial_interp = toolz.curry(self.interpolate_and_store_channels)(
+            save_dir=tmp_dir, dset_names=['{}'.format(w.value) for _, w in lines])
+        loop_futures = client.map(partial_interp, emission_futures, loops,
+                                  interpolated_loop_coordinates, start_indices)
+        # Block until complete
+        distributed.client.wait(loop_futures)
+
+        return list(toolz.concat(client.gather(loop_futures)))
 
     def detect(self, hf, channel, i_time, header, temperature, los_velocity):
         """
@@ -207,6 +271,7 @@ class InstrumentHinodeXRT(InstrumentBase):
                 'temperature_response_spline': splrep(x, y),
                 'wavelength_range': None,
             })
+        self._setup_temperature_response_table()
 
     def make_fits_header(self, field, channel):
         """
@@ -216,7 +281,8 @@ class InstrumentHinodeXRT(InstrumentBase):
         header['EC_FW1_'], header['EC_FW2_'] = channel['name'].split('-')
         return header
 
-    def build_detector_file(self, file_template, dset_shape, chunks, *args, parallel=False):
+    def build_detector_file(self, file_template, dset_shape, chunks, *args, parallel=False,
+                            **kwargs):
         """
         Allocate space for counts data.
         """
@@ -229,12 +295,13 @@ class InstrumentHinodeXRT(InstrumentBase):
         """
         Use temperature response to calculate XRT intensity
         """
-        response_function = (splev(np.ravel(loop.electron_temperature), channel['temperature_response_spline'])
+        response_function = (linear_lookup(np.log10(loop.electron_temperature.to(u.K).value),
+                                           *channel['temperature_response_table'])
                              * u.count*u.cm**5/u.s/u.pixel)
-        counts = np.reshape(np.ravel(loop.density**2)*response_function, loop.density.shape)
-        return counts
+        return loop.density**2 * response_function
 
-    def flatten_parallel(self, loops, interpolated_loop_coordinates, save_path, emission_model=None):
+    def flatten_parallel(self, loops, interpolated_loop_coordinates, save_path, emission_model=None,
+                         **kwargs):
         """
         Interpolate intensity in each channel to temporal resolution of the instrument
         and appropriate spatial scale. Returns a dask task.
@@ -272,9 +339,7 @@ class InstrumentHinodeXRT(InstrumentBase):
         -------
         XRT data product : `~sunpy.Map`
         """
-        with h5py.File(counts_filename, 'r') as hf:
-            weights = np.array(hf[channel['name']][i_time, :])
-            units = u.Unit(hf[channel['name']].attrs['units'])
+        weights, units = read_frame(counts_filename, channel['name'], i_time)
 
         hpc_coordinates = self.total_coordinates
         dz = np.diff(bin_range.z).cgs[0] / bins.z * (1. * u.pixel)
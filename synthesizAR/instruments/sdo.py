@@ -5,13 +5,14 @@ spatial and spectroscopic resolution.
 
 import os
 import json
+import hashlib
+import tempfile
 import pkg_resources
 import warnings
 import toolz
 
 import numpy as np
 from scipy.interpolate import splrep, splev, interp1d
-from scipy.ndimage import map_coordinates
 from scipy.ndimage.filters import gaussian_filter
 import astropy.units as u
 from sunpy.map import Map
@@ -24,8 +25,10 @@ except ImportError:
     warnings.warn('Dask distributed scheduler required for parallel execution')
 
 import synthesizAR
-from synthesizAR.util import SpatialPair, is_visible
+from synthesizAR.util import (SpatialPair, is_visible, read_frame, linear_lookup,
+                              bilinear_lookup)
 from synthesizAR.instruments import InstrumentBase
+from synthesizAR.instruments.base import ChannelEmissivityTable, _file_hash
 
 
 class InstrumentSDOAIA(InstrumentBase):
@@ -90,8 +93,10 @@ class InstrumentSDOAIA(InstrumentBase):
             x = aia_info[channel['name']]['response_x']
             y = aia_info[channel['name']]['response_y']
             channel['wavelength_response_spline'] = splrep(x, y)
+        self._setup_temperature_response_table()
 
-    def build_detector_file(self, file_template, dset_shape, chunks, *args, parallel=False):
+    def build_detector_file(self, file_template, dset_shape, chunks, *args, parallel=False,
+                            **kwargs):
         """
         Allocate space for counts data.
         """
@@ -104,30 +109,79 @@ class InstrumentSDOAIA(InstrumentBase):
         """
         Calculate the AIA intensity using only the temperature response functions.
         """
-        response_function = (splev(np.ravel(loop.electron_temperature),
-                                   channel['temperature_response_spline'])
+        response_function = (linear_lookup(np.log10(loop.electron_temperature.to(u.K).value),
+                                           *channel['temperature_response_table'])
                              * u.count * u.cm**5 / u.s / u.pixel)
-        counts = np.reshape(np.ravel(loop.density**2)*response_function, loop.density.shape)
-        return counts
+        return loop.density**2 * response_function
 
     @staticmethod
-    def flatten_emissivities(channel, emission_model):
+    def flatten_emissivities(channel, emission_model, cache=True):
         """
         Compute product between wavelength response and emissivity for all ions
+
+        The resulting table is cached next to the emissivity file of the emission model, keyed
+        by the contents of that file, the ions in the model and the channel wavelength response.
+        Subsequent calls memory-map the cached table rather than recomputing it.
+
+        Parameters
+        ----------
+        channel : `dict`
+        emission_model : `~synthesizAR.atomic.EmissionModel`
+        cache : `bool`, optional
+            If False, always recompute the table and do not write it to disk
+
+        Returns
+        -------
+        flattened_emissivities : `~synthesizAR.instruments.base.ChannelEmissivityTable`
         """
-        flattened_emissivities = []
-        for ion in emission_model:
+        if cache:
+            cache_dir = os.path.join(
+                os.path.dirname(os.path.abspath(emission_model.emissivity_savefile)),
+                'flattened_emissivity_cache')
+            t, c, k = channel['wavelength_response_spline']
+            sha = hashlib.sha256(_file_hash(emission_model.emissivity_savefile).encode())
+            sha.update(np.asarray(t, dtype=np.float64).tobytes())
+            sha.update(np.asarray(c, dtype=np.float64).tobytes())
+            sha.update(f'{k}|{"|".join([ion.ion_name for ion in emission_model])}'.encode())
+            cache_root = os.path.join(cache_dir, f'{channel["name"]}_{sha.hexdigest()[:16]}')
+            if os.path.isfile(f'{cache_root}.npy') and os.path.isfile(f'{cache_root}.json'):
+                with open(f'{cache_root}.json', 'r') as f:
+                    meta = json.load(f)
+                return ChannelEmissivityTable(f'{cache_root}.npy', meta['unit'], meta['valid'])
+
+        flattened_emissivities = np.zeros((len(emission_model._ion_list),)
+                                          + emission_model.temperature.shape
+                                          + emission_model.density.shape)
+        valid = np.zeros(flattened_emissivities.shape[0], dtype=bool)
+        unit = None
+        for i, ion in enumerate(emission_model):
             wavelength, emissivity = emission_model.get_emissivity(ion)
             if wavelength is None or emissivity is None:
-                flattened_emissivities.append(None)
                 continue
             interpolated_response = splev(wavelength.value, channel['wavelength_response_spline'],
                                           ext=1)
-            em_summed = np.dot(emissivity.value, interpolated_response)
-            unit = emissivity.unit*u.count/u.photon*u.steradian/u.pixel*u.cm**2
-            flattened_emissivities.append(u.Quantity(em_summed, unit))
+            em_summed = u.Quantity(np.dot(emissivity.value, interpolated_response),
+                                   emissivity.unit*u.count/u.photon*u.steradian/u.pixel*u.cm**2)
+            unit = em_summed.unit if unit is None else unit
+            flattened_emissivities[i, :, :] = em_summed.to(unit).value
+            valid[i] = True
+        unit = u.dimensionless_unscaled if unit is None else unit
 
-        return flattened_emissivities
+        if not cache:
+            return ChannelEmissivityTable(flattened_emissivities, unit, valid)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        # NOTE: each writer uses its own temporary file such that concurrent runs never
+        # interleave their writes or read partial tables
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npy.tmp', delete=False) as f:
+            np.save(f, flattened_emissivities)
+        os.replace(f.name, f'{cache_root}.npy')
+        with tempfile.NamedTemporaryFile(mode='w', dir=cache_dir, suffix='.json.tmp',
+                                         delete=False) as f:
+            json.dump({'unit': unit.to_string(), 'valid': valid.tolist()}, f)
+        os.replace(f.name, f'{cache_root}.json')
+
+        return ChannelEmissivityTable(f'{cache_root}.npy', unit, valid)
 
     @staticmethod
     def calculate_counts_full(channel, loop, emission_model, flattened_emissivities):
@@ -135,80 +189,233 @@ class InstrumentSDOAIA(InstrumentBase):
         Calculate the AIA intensity using the wavelength response functions and a
         full emission model.
         """
+        table = InstrumentSDOAIA.stack_emissivities(emission_model, [flattened_emissivities])
+        counts = InstrumentSDOAIA.calculate_counts_full_channels(loop, emission_model, table)
+        return counts[..., 0]
+
+    @staticmethod
+    def stack_emissivities(emission_model, flattened_emissivities):
+        """
+        Stack the abundance-weighted emissivity tables of all ions and channels into a single
+        contiguous array.
+
+        This only needs to be done once for all loops. Only ions with an emissivity in at
+        least one channel are included.
+
+        Parameters
+        ----------
+        emission_model : `~synthesizAR.atomic.EmissionModel`
+        flattened_emissivities : `list`
+            `~synthesizAR.instruments.base.ChannelEmissivityTable` for each channel, as
+            computed by `flatten_emissivities`
+
+        Returns
+        -------
+        ions : `list`
+            Ions included in the table
+        table : `~numpy.ndarray`
+            Shape ``temperature.shape + density.shape + (len(ions), len(flattened_emissivities))``
+        unit : `~astropy.units.Unit`
+        """
+        valid = np.any([fe.valid for fe in flattened_emissivities], axis=0)
+        ions = [ion for ion, v in zip(emission_model, valid) if v]
+        abundance = u.Quantity([ion.abundance for ion in ions]).to(u.dimensionless_unscaled).value
+        unit = flattened_emissivities[0].unit
+        shape = emission_model.temperature.shape + emission_model.density.shape
+        table = np.empty(shape + (len(ions), len(flattened_emissivities)))
+        # NOTE: copy one ion at a time such that no intermediate copy of the full table is made
+        for j, fe in enumerate(flattened_emissivities):
+            scale = fe.unit.to(unit)
+            for k, i in enumerate(np.flatnonzero(valid)):
+                np.multiply(fe.data[i], scale * abundance[k], out=table[:, :, k, j])
+
+        return ions, table, unit
+
+    @staticmethod
+    def calculate_counts_full_channels(loop, emission_model, table):
+        """
+        Calculate the AIA intensity in several channels at once using the wavelength response
+        functions and a full emission model.
+
+        The ionization fractions of all ions are read at once. The counts are then computed in
+        a single bilinear interpolation of the stacked emissivity tables, contracted against
+        the ionization fractions and scaled by the density in chunks of points, on plain
+        arrays. Units are only attached to the final result.
+
+        Parameters
+        ----------
+        loop : `~synthesizAR.Loop`
+        emission_model : `~synthesizAR.atomic.EmissionModel`
+        table : `tuple`
+            Stacked emissivity tables of all ions and channels, as computed by
+            `stack_emissivities`
+
+        Returns
+        -------
+        counts : `~astropy.units.Quantity`
+            The last axis corresponds to the last axis of the stacked table
+        """
+        ions, table, unit = table
         density = loop.density
-        electron_temperature = loop.electron_temperature
-        counts = np.zeros(electron_temperature.shape)
-        itemperature, idensity = emission_model.interpolate_to_mesh_indices(loop)
-        for ion, flat_emiss in zip(emission_model, flattened_emissivities):
-            if flat_emiss is None:
-                continue
-            ionization_fraction = emission_model.get_ionization_fraction(loop, ion)
-            tmp = np.reshape(map_coordinates(flat_emiss.value, np.vstack([itemperature, idensity])),
-                             electron_temperature.shape)
-            tmp = u.Quantity(np.where(tmp < 0., 0., tmp), flat_emiss.unit)
-            counts_tmp = ion.abundance*0.83/(4*np.pi*u.steradian)*ionization_fraction*density*tmp
-            if not hasattr(counts, 'unit'):
-                counts = counts*counts_tmp.unit
-            counts += counts_tmp
-
-        return counts
-    
-    def flatten_serial(self, loops, interpolated_loop_coordinates, hf, emission_model=None):
+        shape = density.shape
+        if not ions:
+            return u.Quantity(np.zeros(shape + table.shape[-1:]),
+                              unit * density.unit / u.steradian)
+        ionization_fraction = emission_model.get_ionization_fractions(loop, ions)
+        ionization_fraction = ionization_fraction.to(u.dimensionless_unscaled).value
+        itemperature, idensity = emission_model.interpolate_to_mesh_indices(loop, density=density)
+        # NOTE: the coefficients are a view of the ionization fractions and the density is
+        # applied one chunk of points at a time such that no second full-size array is made
+        counts = bilinear_lookup(table, itemperature, idensity,
+                                 coefficients=ionization_fraction.reshape(len(ions), -1).T,
+                                 scale=np.ravel(density.value))
+        counts = np.reshape(counts, shape + table.shape[-1:])
+
+        return u.Quantity(counts * 0.83 / (4*np.pi), unit * density.unit / u.steradian)
+
+    @staticmethod
+    def contribution_function_table(emission_model, flattened_emissivities):
+        """
+        Precompute the counts per unit density in several channels as a function of temperature
+        and density, assuming ionization equilibrium.
+
+        The abundance, equilibrium ionization fraction and channel-weighted emissivity are
+        summed over all ions such that the counts for any loop can be computed with a single
+        table lookup.
+
+        Parameters
+        ----------
+        emission_model : `~synthesizAR.atomic.EmissionModel`
+        flattened_emissivities : `list`
+            `~synthesizAR.instruments.base.ChannelEmissivityTable` for each channel, as
+            computed by `flatten_emissivities`
+
+        Returns
+        -------
+        table : `~astropy.units.Quantity`
+            Shape ``temperature.shape + density.shape + (len(flattened_emissivities),)``
+        """
+        valid = np.any([fe.valid for fe in flattened_emissivities], axis=0)
+        unit = flattened_emissivities[0].unit
+        shape = emission_model.temperature.shape + emission_model.density.shape
+        table = np.zeros(shape + (len(flattened_emissivities),))
+        if not valid.any():
+            return u.Quantity(table, unit)
+        ions = [ion for ion, v in zip(emission_model, valid) if v]
+        abundance = u.Quantity([ion.abundance for ion in ions]).to(u.dimensionless_unscaled).value
+        ioneq = emission_model.get_equilibrium_ionization_fractions(ions)
+        ioneq = ioneq.to(u.dimensionless_unscaled).value
+        weights = abundance[:, np.newaxis] * ioneq
+        for i, fe in enumerate(flattened_emissivities):
+            table[..., i] = np.einsum('itn,it->tn', np.asarray(fe.data)[valid],
+                                      weights) * fe.unit.to(unit)
+
+        return u.Quantity(table, unit)
+
+    @staticmethod
+    def calculate_counts_contribution_function(loop, emission_model, table):
+        """
+        Calculate the AIA intensity in several channels at once from a precomputed contribution
+        function table
+
+        Parameters
+        ----------
+        loop : `~synthesizAR.Loop`
+        emission_model : `~synthesizAR.atomic.EmissionModel`
+        table : `~astropy.units.Quantity`
+            As computed by `contribution_function_table`
+
+        Returns
+        -------
+        counts : `~astropy.units.Quantity`
+            The last axis corresponds to the last axis of ``table``
+        """
+        density = loop.density
+        itemperature, idensity = emission_model.interpolate_to_mesh_indices(loop, density=density)
+        counts = bilinear_lookup(table.value, itemperature, idensity)
+        counts = np.reshape(counts, density.shape + table.shape[-1:])
+        counts *= density.value[..., np.newaxis]
+
+        return u.Quantity(counts * 0.83 / (4*np.pi), table.unit * density.unit / u.steradian)
+
+    def flatten_serial(self, loops, interpolated_loop_coordinates, hf, emission_model=None,
+                       use_contribution_function=False):
         """
         Interpolate intensity in each channel to temporal resolution of the instrument
         and appropriate spatial scale.
+
+        The counts in all channels are computed together for each loop such that the loop
+        hydrodynamics are only loaded and interpolated once. If ``use_contribution_function``
+        is True and the ionization fractions of the emission model are in equilibrium, the
+        counts are computed from a precomputed contribution function table rather than summing
+        over ions for every loop. This is faster, but interpolates the product of the
+        ionization fraction and emissivity on the temperature grid of the emission model
+        rather than each separately, such that the counts differ slightly.
         """
-        if emission_model is None:
-            calculate_counts = self.calculate_counts_simple
-            flattened_emissivities = None
-        else:
-            calculate_counts = self.calculate_counts_full
+        table, contribution_table = None, None
+        if emission_model is not None:
+            flattened_emissivities = [self.flatten_emissivities(channel, emission_model)
+                                      for channel in self.channels]
+            if use_contribution_function and emission_model.ionization_equilibrium:
+                contribution_table = self.contribution_function_table(emission_model,
+                                                                      flattened_emissivities)
+            else:
+                table = self.stack_emissivities(emission_model, flattened_emissivities)
 
-        for channel in self.channels:
-            start_index = 0
-            dset = hf[channel['name']]
-            if emission_model is not None:
-                flattened_emissivities = self.flatten_emissivities(channel, emission_model)
-            for loop, interp_s in zip(loops, interpolated_loop_coordinates):
-                c = calculate_counts(channel, loop, emission_model, flattened_emissivities)
-                y = self.interpolate_and_store(c, loop, interp_s)
-                self.commit(y, dset, start_index)
-                start_index += interp_s.shape[0]
-
-    def flatten_parallel(self, loops, interpolated_loop_coordinates, tmp_dir, emission_model=None):
+        start_index = 0
+        for loop, interp_s in zip(loops, interpolated_loop_coordinates):
+            if emission_model is None:
+                c = self.calculate_counts_simple_channels(loop)
+            elif contribution_table is not None:
+                c = self.calculate_counts_contribution_function(loop, emission_model,
+                                                                contribution_table)
+            else:
+                c = self.calculate_counts_full_channels(loop, emission_model, table)
+            # NOTE: interpolate all channels at once; the last axis is carried through
+            y = self.interpolate_and_store(c, loop, interp_s)
+            for i, channel in enumerate(self.channels):
+                self.commit(y[..., i], hf[channel['name']], start_index)
+            start_index += interp_s.shape[0]
+
+    def flatten_parallel(self, loops, interpolated_loop_coordinates, tmp_dir, emission_model=None,
+                         use_contribution_function=False):
         """
         Interpolate intensity in each channel to temporal resolution of the instrument
-        and appropriate spatial scale. Returns a dask task.
+        and appropriate spatial scale. Returns a list of the files the results are written to.
+
+        The counts in all channels are computed together for each loop. The stacked emissivity
+        table, or the contribution function table if ``use_contribution_function`` is True and
+        the emission model is in ionization equilibrium, is built once. It is sent to each
+        worker only once, as is the emission model.
         """
         # Setup scheduler
         client = distributed.get_client()
         start_indices = np.insert(np.array(
             [s.shape[0] for s in interpolated_loop_coordinates]).cumsum()[:-1], 0, 0)
         if emission_model is None:
-            calculate_counts = self.calculate_counts_simple
-            flat_emiss = None
+            counts_futures = client.map(self.calculate_counts_simple_channels, loops)
         else:
-            calculate_counts = self.calculate_counts_full
+            flattened_emissivities = [self.flatten_emissivities(channel, emission_model)
+                                      for channel in self.channels]
+            if use_contribution_function and emission_model.ionization_equilibrium:
+                table = self.contribution_function_table(emission_model, flattened_emissivities)
+                calculate_counts = self.calculate_counts_contribution_function
+            else:
+                table = self.stack_emissivities(emission_model, flattened_emissivities)
+                calculate_counts = self.calculate_counts_full_channels
+            # NOTE: wrap in a list such that each is scattered as a single object
+            table, = client.scatter([table], broadcast=True)
+            emission_model, = client.scatter([emission_model], broadcast=True)
+            counts_futures = client.map(calculate_counts, loops, emission_model=emission_model,
+                                        table=table)
+        partial_interp = toolz.curry(self.interpolate_and_store_channels)(
+            save_dir=tmp_dir, dset_names=[channel['name'] for channel in self.channels])
+        loop_futures = client.map(partial_interp, counts_futures, loops,
+                                  interpolated_loop_coordinates, start_indices)
+        # Block until complete
+        distributed.client.wait(loop_futures)
 
-        futures = []
-        for channel in self.channels:
-            # Flatten emissivities for appropriate channel
-            if emission_model is not None:
-                flat_emiss = self.flatten_emissivities(channel, emission_model)
-            # Create partial functions
-            partial_counts = toolz.curry(calculate_counts)(
-                channel, emission_model=emission_model, flattened_emissivities=flat_emiss)
-            partial_interp = toolz.curry(self.interpolate_and_store)(
-                save_dir=tmp_dir, dset_name=channel['name'])
-            # Map functions to iterables
-            y_futures = client.map(partial_counts, loops)
-            loop_futures = client.map(partial_interp, y_futures, loops,
-                                      interpolated_loop_coordinates, start_indices)
-            # Block until complete
-            distributed.client.wait([loop_futures])
-            futures += loop_futures
-
-        return futures
+        return list(toolz.concat(client.gather(loop_futures)))
 
     def detect(self, channel, i_time, header, bins, bin_range):
         """
@@ -227,9 +434,7 @@ class InstrumentSDOAIA(InstrumentBase):
         -------
         AIA data product : `~sunpy.map.Map`
         """
-        with h5py.File(self.counts_file, 'r') as hf:
-            weights = np.array(hf[channel['name']][i_time, :])
-            units = u.Unit(hf[channel['name']].attrs['units'])
+        weights, units = read_frame(self.counts_file, channel['name'], i_time)
 
         hpc_coordinates = self.total_coordinates
         dz = np.diff(bin_range.z)[0].cgs / bins.z * (1. * u.pixel)
@@ -3,17 +3,12 @@ Interface between loop object and ebtel++ simulation
 """
 import os
 import copy
-import warnings
-import toolz
-import pickle
+from concurrent.futures import (ProcessPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED)
 
 import numpy as np
 import h5py
 import astropy.units as u
-try:
-    import distributed
-except ImportError:
-    warnings.warn('Dask library required for NEI calculation')
 
 from synthesizAR.util import write_xml
 from synthesizAR.atomic import Element
@@ -75,6 +70,11 @@ class EbtelInterface(object):
         """
         Load EBTEL output for a given loop object.
 
+        Because EBTEL is a 0D model, the temperature and density are uniform along the loop
+        and are returned only as a function of time. They are broadcast along the loop when
+        read back through the `~synthesizAR.Loop` properties. The velocity is returned as a
+        function of time and coordinate since its sign is flipped at the loop apex.
+
         Parameters
         ----------
         loop : `synthesizAR.Loop` object
@@ -85,9 +85,9 @@ class EbtelInterface(object):
 
         # reshape into a 1D loop structure with units
         time = _tmp[:, 0]*u.s
-        electron_temperature = np.outer(_tmp[:, 1], np.ones(N_s))*u.K
-        ion_temperature = np.outer(_tmp[:, 2], np.ones(N_s))*u.K
-        density = np.outer(_tmp[:, 3], np.ones(N_s))*(u.cm**(-3))
+        electron_temperature = _tmp[:, 1]*u.K
+        ion_temperature = _tmp[:, 2]*u.K
+        density = _tmp[:, 3]*(u.cm**(-3))
         velocity = np.outer(_tmp[:, -2], np.ones(N_s))*u.cm/u.s
         # flip sign of velocity where the radial distance from center is maximum
         # FIXME: this is probably not the best way to do this...
@@ -107,12 +107,13 @@ class EbtelInterface(object):
         """
         Solve the time-dependent ionization balance equation for all loops and all elements
 
-        This method computes the time dependent ion population fractions for each element in 
+        This method computes the time dependent ion population fractions for each element in
         the emission model and each loop in the active region and compiles the results to a single
-        HDF5 file. To do this efficiently, it uses the dask.distributed library to take advantage of
-        multiple processes/cores/machines and compute the population fractions in parallel. It returns
-        an asynchronous `~distributed.client.Future` object which holds the state of the submitted
-        tasks.
+        HDF5 file. Loops that share a time grid are grouped such that the populations of many
+        loops are advanced at once by a single task. The tasks run in parallel on an executor and
+        the results are written to the file by a single writer as soon as each one finishes.
+        Populations that are already in the file are not recomputed such that an interrupted
+        calculation can be resumed.
 
         Parameters
         ----------
@@ -122,74 +123,130 @@ class EbtelInterface(object):
         Other Parameters
         ---------------------
         temperature : `~astropy.units.Quantity`
-
-        Returns
-        --------
-        future : `~distributed.client.Future`
+        executor : `~concurrent.futures.Executor`, optional
+            Any `concurrent.futures` executor, e.g. a
+            `~concurrent.futures.ThreadPoolExecutor`. If not given, a local process pool is used
+            and the rate matrices are sent to each worker process only once. Otherwise, they are
+            sent along with each task.
+        max_workers : `int`, optional
+            Number of processes in the default pool
+        batch_size : `int`, optional
+            Maximum number of loops advanced at once by a single task
+        max_pending : `int`, optional
+            Maximum number of submitted calculations waiting to be written
+        adaptive : `bool`, optional
+            If True, use adaptive time stepping to solve the ionization balance equations
         """
-        client = distributed.get_client()
-        tmpdir = os.path.join(os.path.dirname(emission_model.ionization_fraction_savefile),
-                              'tmp_nei')
-        if not os.path.exists(tmpdir):
-            os.makedirs(tmpdir)
-        unique_elements = list(set([ion.element_name for ion in emission_model]))
+        savefile = emission_model.ionization_fraction_savefile
+        unique_elements = sorted(set([ion.element_name for ion in emission_model]))
         temperature = kwargs.get('temperature', emission_model.temperature)
-   
-        el_futures = []
+        nei_kwargs = {'adaptive': kwargs.get('adaptive', False)}
+        if 'rtol' in kwargs:
+            nei_kwargs['rtol'] = kwargs['rtol']
+        batch_size = kwargs.get('batch_size', 100)
+        # Skip populations already written by a previous, possibly interrupted, calculation
+        completed = set()
+        if os.path.isfile(savefile):
+            with h5py.File(savefile, 'r') as hf:
+                for loop_name, grp in hf.items():
+                    completed |= {(loop_name, el_name) for el_name, dset in grp.items()
+                                  if dset.attrs.get('complete', False)}
+        # Group loops by time grid such that each group can be advanced at once
+        time_groups = {}
+        for loop in field.loops:
+            key = loop.time.to(u.s).value.tobytes()
+            time_groups.setdefault(key, []).append(loop)
+
+        tables = {}
         for el_name in unique_elements:
             el = Element(el_name, temperature)
             rate_matrix = el._rate_matrix()
-            ioneq = el.equilibrium_ionization(rate_matrix)
-            partial_nei = toolz.curry(EbtelInterface.compute_and_save_nei)(
-                el, rate_matrix=rate_matrix, initial_condition=ioneq, save_dir=tmpdir)
-            loop_futures = client.map(partial_nei, field.loops)
-            distributed.wait(loop_futures)
-            el_futures += loop_futures
-
-        store_future = client.submit(EbtelInterface.slice_and_store, el_futures,
-                                     emission_model.ionization_fraction_savefile)
-        future = client.submit(EbtelInterface._cleanup, store_future)
-
-        return future
+            tables[el_name] = (el, rate_matrix, el.equilibrium_ionization(rate_matrix))
+        executor = kwargs.get('executor', None)
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=kwargs.get('max_workers', None),
+                                           initializer=_initialize_nei_worker,
+                                           initargs=(tables,))
+        max_pending = kwargs.get('max_pending', 4 * (os.cpu_count() or 1))
+        try:
+            with h5py.File(savefile, 'a') as hf:
+                pending = set()
+                for el_name in unique_elements:
+                    for loops in time_groups.values():
+                        loops = [l for l in loops if (l.name, el_name) not in completed]
+                        for i in range(0, len(loops), batch_size):
+                            batch = loops[i:i+batch_size]
+                            # NOTE: EBTEL results are uniform along the loop
+                            pending.add(executor.submit(
+                                EbtelInterface.compute_nei, el_name, batch[0].time,
+                                u.Quantity([l.electron_temperature[:, 0] for l in batch]).T,
+                                u.Quantity([l.density[:, 0] for l in batch]).T,
+                                [l.name for l in batch], tables=None if own_executor else tables,
+                                **nei_kwargs))
+                            if len(pending) >= max_pending:
+                                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                                EbtelInterface._store_nei(hf, done)
+                EbtelInterface._store_nei(hf, as_completed(pending))
+        finally:
+            if own_executor:
+                executor.shutdown()
 
     @staticmethod
-    def compute_and_save_nei(element, loop, rate_matrix, initial_condition, save_dir):
+    def compute_nei(element_name, time, temperature, density, loop_names, tables=None,
+                    **kwargs):
         """
-        Compute and save NEI populations for a given element and loop
-        """
-        y_nei = element.non_equilibrium_ionization(loop.time, loop.electron_temperature[:, 0],
-                                                   loop.density[:, 0], rate_matrix,
-                                                   initial_condition)
-        save_path = os.path.join(save_dir, f'{element.element_name}_{loop.name}.pkl')
-        with open(save_path, 'wb') as f:
-            pickle.dump((y_nei.value, loop.field_aligned_coordinate.shape[0],
-                         element.element_name, loop.name), f)
+        Compute NEI populations for a given element and several loops sharing a time grid
 
-        return save_path
+        Parameters
+        ----------
+        element_name : `str`
+        time : `~astropy.units.Quantity`
+            Shape ``(time,)``
+        temperature : `~astropy.units.Quantity`
+            Shape ``(time, len(loop_names))``
+        density : `~astropy.units.Quantity`
+            Shape ``(time, len(loop_names))``
+        loop_names : `list`
+        tables : `dict`, optional
+            Element, rate matrix and equilibrium populations for each element name. If not
+            given, the tables set up when the worker process was started are used.
+        """
+        tables = _NEI_TABLES if tables is None else tables
+        element, rate_matrix, initial_condition = tables[element_name]
+        y_nei = element.non_equilibrium_ionization(time, temperature, density,
+                                                   rate_matrix=rate_matrix,
+                                                   initial_condition=initial_condition, **kwargs)
+        return y_nei.value, element_name, loop_names
 
     @staticmethod
-    def slice_and_store(filenames, savefile):
+    def _store_nei(hf, futures):
         """
-        Collect and store all NEI populations in a single HDF5 file
+        Write NEI populations to the ionization fraction file as each calculation finishes
+
+        The populations are spatially uniform and so are stored only as a function of time and
+        charge state. They are broadcast along the loop on read by the emission model.
         """
-        with h5py.File(savefile, 'a') as hf:
-            for fn in filenames:
-                with open(fn, 'rb') as f:
-                    y_nei, n_s, element_name, loop_name = pickle.load(f)
+        for future in futures:
+            data, element_name, loop_names = future.result()
+            for i, loop_name in enumerate(loop_names):
                 grp = hf.create_group(loop_name) if loop_name not in hf else hf[loop_name]
-                data = np.repeat(y_nei[:, np.newaxis, :], n_s, axis=1)
-                if element_name not in grp:
-                    dset = grp.create_dataset(element_name, data=data)
-                else:
-                    dset = grp[element_name]
-                    dset[:, :, :] = data
+                if element_name in grp:
+                    del grp[element_name]
+                # NOTE: chunk by charge state so that single-ion reads are contiguous
+                dset = grp.create_dataset(element_name, data=data[:, i, :],
+                                          chunks=data.shape[:1] + (1,))
                 dset.attrs['units'] = ''
                 dset.attrs['description'] = 'non-equilibrium ionization fractions'
+                # NOTE: flag written last such that partially written results are recomputed
+                dset.attrs['complete'] = True
+            hf.flush()
 
-        return filenames
 
-    @staticmethod
-    def _cleanup(filenames):
-        for f in filenames:
-            os.remove(f)
-        os.rmdir(os.path.dirname(f))
+# NOTE: rate matrices are sent to each worker process once when it starts rather than with
+# every task
+_NEI_TABLES = {}
+
+
+def _initialize_nei_worker(tables):
+    _NEI_TABLES.update(tables)
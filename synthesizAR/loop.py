@@ -91,35 +91,41 @@ Maximum field strength : {np.max(self.field_strength):.2f}'''
             time = u.Quantity(dset, dset.attrs['units'])
         return time
 
+    def _read_spatially_resolved(self, name):
+        """
+        Read a loop quantity as a function of time and coordinate. Quantities that are uniform
+        along the loop are stored only as a function of time and are broadcast along the
+        loop coordinate on read.
+        """
+        with h5py.File(self.parameters_savefile, 'r') as hf:
+            dset = hf['/'.join([self.name, name])]
+            quantity = u.Quantity(dset, dset.attrs['units'])
+        if quantity.ndim == 1:
+            shape = quantity.shape + self.field_aligned_coordinate.shape
+            quantity = u.Quantity(np.broadcast_to(quantity.value[:, np.newaxis], shape),
+                                  quantity.unit, copy=False)
+        return quantity
+
     @property
     def electron_temperature(self):
         """
         Loop electron temperature as function of coordinate and time.
         """
-        with h5py.File(self.parameters_savefile, 'r') as hf:
-            dset = hf['/'.join([self.name, 'electron_temperature'])]
-            temperature = u.Quantity(dset, dset.attrs['units'])
-        return temperature
+        return self._read_spatially_resolved('electron_temperature')
 
     @property
     def ion_temperature(self):
         """
         Loop ion temperature as function of coordinate and time.
         """
-        with h5py.File(self.parameters_savefile, 'r') as hf:
-            dset = hf['/'.join([self.name, 'ion_temperature'])]
-            temperature = u.Quantity(dset, dset.attrs['units'])
-        return temperature
+        return self._read_spatially_resolved('ion_temperature')
 
     @property
     def density(self):
         """
         Loop density as a function of coordinate and time.
         """
-        with h5py.File(self.parameters_savefile, 'r') as hf:
-            dset = hf['/'.join([self.name, 'density'])]
-            density = u.Quantity(dset, dset.attrs['units'])
-        return density
+        return self._read_spatially_resolved('density')
 
     @property
     def velocity(self):
@@ -127,37 +133,25 @@ Maximum field strength : {np.max(self.field_strength):.2f}'''
         Velcoity in the field-aligned direction of the loop as a function of loop coordinate and
         time.
         """
-        with h5py.File(self.parameters_savefile, 'r') as hf:
-            dset = hf['/'.join([self.name, 'velocity'])]
-            velocity = u.Quantity(dset, dset.attrs['units'])
-        return velocity
+        return self._read_spatially_resolved('velocity')
 
     @property
     def velocity_x(self):
         """
         X-component of velocity in the HEEQ Cartesian coordinate system as a function of time.
         """
-        with h5py.File(self.parameters_savefile, 'r') as hf:
-            dset = hf['/'.join([self.name, 'velocity_x'])]
-            velocity = u.Quantity(dset, dset.attrs['units'])
-        return velocity
+        return self._read_spatially_resolved('velocity_x')
 
     @property
     def velocity_y(self):
         """
         Y-component of velocity in the HEEQ Cartesian coordinate system as a function of time.
         """
-        with h5py.File(self.parameters_savefile, 'r') as hf:
-            dset = hf['/'.join([self.name, 'velocity_y'])]
-            velocity = u.Quantity(dset, dset.attrs['units'])
-        return velocity
+        return self._read_spatially_resolved('velocity_y')
 
     @property
     def velocity_z(self):
         """
         Z-component of velocity in the HEEQ Cartesian coordinate system as a function of time.
         """
-        with h5py.File(self.parameters_savefile, 'r') as hf:
-            dset = hf['/'.join([self.name, 'velocity_z'])]
-            velocity = u.Quantity(dset, dset.attrs['units'])
-        return velocity
+        return self._read_spatially_resolved('velocity_z')
@@ -7,7 +7,7 @@ import astropy.units as u
 from matplotlib import cm, colors
 from sunpy.map import GenericMap
 
-from synthesizAR.util import is_visible
+from synthesizAR.util import is_visible, read_frame
 from .cube import EMCube
 
 __all__ = ['make_los_velocity_map', 'make_temperature_map', 'make_emission_measure_map']
@@ -34,10 +34,10 @@ def make_los_velocity_map(time: u.s, field, instr, **kwargs):
             i_time = np.where(np.array(hf['time'])*u.Unit(hf['time'].attrs['units']) == time)[0][0]
         except IndexError:
             raise IndexError(f'{time} is not a valid time in observing time for {instr.name}')
-        v_x = u.Quantity(hf['velocity_x'][i_time, :], hf['velocity_x'].attrs['units'])
-        v_y = u.Quantity(hf['velocity_y'][i_time, :], hf['velocity_y'].attrs['units'])
-        v_z = u.Quantity(hf['velocity_z'][i_time, :], hf['velocity_z'].attrs['units'])
-        v_los = instr.los_velocity(v_x, v_y, v_z)
+    v_x = u.Quantity(*read_frame(instr.counts_file, 'velocity_x', i_time))
+    v_y = u.Quantity(*read_frame(instr.counts_file, 'velocity_y', i_time))
+    v_z = u.Quantity(*read_frame(instr.counts_file, 'velocity_z', i_time))
+    v_los = instr.los_velocity(v_x, v_y, v_z)
 
     hist, _, _ = np.histogram2d(instr.total_coordinates.Tx.value,
                                 instr.total_coordinates.Ty.value,
@@ -75,8 +75,7 @@ def make_temperature_map(time: u.s, field, instr, **kwargs):
             i_time = np.where(np.array(hf['time'])*u.Unit(hf['time'].attrs['units']) == time)[0][0]
         except IndexError:
             raise IndexError(f'{time} is not a valid time in observing time for {instr.name}')
-        weights = np.array(hf['electron_temperature'][i_time, :])
-        units = u.Unit(hf['electron_temperature'].attrs['units'])
+    weights, units = read_frame(instr.counts_file, 'electron_temperature', i_time)
     hist, _, _ = np.histogram2d(instr.total_coordinates.Tx.value,
                                 instr.total_coordinates.Ty.value,
                                 bins=(bins.x.value, bins.y.value),
@@ -123,10 +122,9 @@ def make_emission_measure_map(time: u.s, field, instr, temperature_bin_edges=Non
             i_time = np.where(np.array(hf['time'])*u.Unit(hf['time'].attrs['units']) == time)[0][0]
         except IndexError:
             raise IndexError(f'{time} is not a valid time in observing time for {instr.name}')
-        unbinned_temperature = np.array(hf['electron_temperature'][i_time, :])
-        temperature_unit = u.Unit(hf['electron_temperature'].attrs['units'])
-        unbinned_density = np.array(hf['density'][i_time, :])
-        density_unit = u.Unit(hf['density'].attrs['units'])
+    unbinned_temperature, temperature_unit = read_frame(instr.counts_file, 'electron_temperature',
+                                                        i_time)
+    unbinned_density, density_unit = read_frame(instr.counts_file, 'density', i_time)
 
     # setup bin edges and weights
     if temperature_bin_edges is None:
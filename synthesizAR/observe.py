@@ -48,7 +48,7 @@ class Observer(object):
             for channel in instr.channels:
                 if channel['wavelength_range'] is not None:
                     channel['model_wavelengths'] = []
-                    for wvl in self.field.loops[0].resolved_wavelengths:
+                    for wvl in getattr(self.field.loops[0], 'resolved_wavelengths', []):
                         if channel['wavelength_range'][0] <= wvl <= channel['wavelength_range'][-1]:
                             channel['model_wavelengths'].append(wvl)
                     if channel['model_wavelengths']:
@@ -82,12 +82,22 @@ class Observer(object):
 
         .. note:: After creating the instrument objects and passing them to the observer,
                   it is always necessary to call this method.
+
+        .. note:: For spectrometers, pass the ``emission_model`` here such that a dataset is
+                  allocated for each of its resolved transitions.
+
+        .. note:: Passing ``chunks=None`` stores the flattened quantities contiguously such that
+                  they can be memory-mapped by `~synthesizAR.util.read_frame` when binning.
         """
         file_template = os.path.join(savedir, '{}_counts.h5')
         total_coordinates, self._interpolated_loop_coordinates = self._interpolate_loops(ds)
         interp_s_shape = (int(np.median([s.shape for s in self._interpolated_loop_coordinates])),)
+        # NOTE: chunks is passed positionally so it must not also be forwarded in kwargs
+        default_chunks = 'chunks' not in kwargs
+        chunks = kwargs.pop('chunks', None)
         for instr in self.instruments:
-            chunks = kwargs.get('chunks', instr.observing_time.shape + interp_s_shape)
+            if default_chunks:
+                chunks = instr.observing_time.shape + interp_s_shape
             dset_shape = instr.observing_time.shape + (len(total_coordinates),)
             instr.build_detector_file(file_template, dset_shape, chunks, self.field,
                                       parallel=self.parallel, **kwargs)
@@ -100,6 +110,18 @@ class Observer(object):
         """
         Calculate intensity for each loop, interpolate it to the appropriate spatial and temporal
         resolution, and store it. This is done either in serial or parallel.
+
+        Other Parameters
+        ----------------
+        emission_model : `~synthesizAR.atomic.EmissionModel`, optional
+        interpolate_hydro_quantities : `bool`, optional
+        use_contribution_function : `bool`, optional
+            If True, instruments that support it compute counts from a precomputed contribution
+            function table when the emission model is in ionization equilibrium
+        preload_emissivity : `bool`, optional
+            If True and computing in parallel, the emissivities are preloaded into a
+            memory-mapped buffer before the emission model is sent to the workers. See
+            `~synthesizAR.atomic.EmissionModel.preload_emissivity`.
         """
         if self.parallel:
             return self._flatten_detector_counts_parallel(**kwargs)
@@ -109,6 +131,7 @@ class Observer(object):
     def _flatten_detector_counts_serial(self, **kwargs):
         emission_model = kwargs.get('emission_model', None)
         interpolate_hydro_quantities = kwargs.get('interpolate_hydro_quantities', True)
+        use_contribution_function = kwargs.get('use_contribution_function', False)
         for instr in self.instruments:
             with h5py.File(instr.counts_file, 'a', driver=kwargs.get('hdf5_driver', None)) as hf:
                 start_index = 0
@@ -120,7 +143,8 @@ class Observer(object):
                             instr.commit(val, hf[q], start_index)
                         start_index += interp_s.shape[0]
                 instr.flatten_serial(self.field.loops, self._interpolated_loop_coordinates, hf,
-                                     emission_model=emission_model)
+                                     emission_model=emission_model,
+                                     use_contribution_function=use_contribution_function)
 
     def _flatten_detector_counts_parallel(self, **kwargs):
         """
@@ -129,6 +153,9 @@ class Observer(object):
         client = distributed.get_client()
         emission_model = kwargs.get('emission_model', None)
         interpolate_hydro_quantities = kwargs.get('interpolate_hydro_quantities', True)
+        use_contribution_function = kwargs.get('use_contribution_function', False)
+        if emission_model is not None and kwargs.get('preload_emissivity', False):
+            emission_model.preload_emissivity(memmap=True)
         futures = {}
         start_indices = np.insert(np.array(
             [s.shape[0] for s in self._interpolated_loop_coordinates]).cumsum()[:-1], 0, 0)
@@ -150,9 +177,9 @@ class Observer(object):
                     interp_futures += loop_futures
 
             # Calculate and interpolate channel counts for instrument
-            counts_futures = instr.flatten_parallel(self.field.loops,
-                                                    self._interpolated_loop_coordinates,
-                                                    tmp_dir, emission_model=emission_model)
+            counts_futures = instr.flatten_parallel(
+                self.field.loops, self._interpolated_loop_coordinates, tmp_dir,
+                emission_model=emission_model, use_contribution_function=use_contribution_function)
             # Assemble into file and clean up
             assemble_future = client.submit(instr.assemble_arrays, interp_futures+counts_futures,
                                             instr.counts_file)
@@ -0,0 +1,161 @@
+"""
+Tests for atomic calculations that do not need an atomic database
+"""
+import pytest
+import numpy as np
+import astropy.units as u
+
+from synthesizAR.atomic import Element
+
+
+class SyntheticElement(Element):
+    """
+    Element defined only by its temperature grid and atomic number
+    """
+    # NOTE: shadow the properties of the ion collection
+    temperature = None
+    atomic_number = None
+
+    def __init__(self, temperature, atomic_number):
+        self.temperature = temperature
+        self.atomic_number = atomic_number
+
+
+def random_rate_matrix(n_temperature, n_charge):
+    # Ionization out of each charge state and recombination into it, such that each column
+    # sums to zero and populations are conserved
+    ionization = np.random.uniform(1e-11, 1e-9, size=(n_temperature, n_charge))
+    recombination = np.random.uniform(1e-11, 1e-9, size=(n_temperature, n_charge))
+    ionization[:, -1] = 0.
+    recombination[:, 0] = 0.
+    rates = np.zeros((n_temperature, n_charge, n_charge))
+    for i in range(n_charge):
+        rates[:, i, i] = -(ionization[:, i] + recombination[:, i])
+        if i > 0:
+            rates[:, i, i-1] = ionization[:, i-1]
+        if i < n_charge - 1:
+            rates[:, i, i+1] = recombination[:, i+1]
+    return rates
+
+
+def inverse_step(rates, y, n_0, i_0, n_1, i_1, dt):
+    # Single step as originally computed, by inverting the left-hand side
+    identity = np.eye(rates.shape[-1])
+    term1 = identity - n_1 * dt/2. * rates[i_1]
+    term2 = identity + n_0 * dt/2. * rates[i_0]
+    y_new = np.fabs(np.linalg.inv(term1) @ term2 @ y)
+    return y_new / y_new.sum()
+
+
+@pytest.fixture
+def element():
+    return SyntheticElement(10.**np.linspace(5, 8, 31) * u.K, 8)
+
+
+@pytest.fixture
+def rate_matrix(element):
+    return random_rate_matrix(element.temperature.shape[0],
+                              element.atomic_number + 1) * u.cm**3 / u.s
+
+
+@pytest.fixture
+def initial_condition(element):
+    y = np.random.uniform(size=element.temperature.shape + (element.atomic_number + 1,))
+    return y / y.sum(axis=1, keepdims=True)
+
+
+def test_crank_nicolson_step_matches_inverse():
+    rates = random_rate_matrix(5, 9)
+    y = np.random.uniform(size=(4, 9))
+    y /= y.sum(axis=1, keepdims=True)
+    n_0, n_1 = np.random.uniform(1e8, 1e10, size=(2, 4))
+    i_0, i_1 = np.random.randint(0, 5, size=(2, 4))
+    y_new = Element._crank_nicolson_step(rates, y, n_0, i_0, n_1, i_1, 0.5)
+    assert y_new.shape == y.shape
+    assert np.allclose(y_new.sum(axis=1), 1.)
+    for l in range(y.shape[0]):
+        assert np.allclose(y_new[l], inverse_step(rates, y[l], n_0[l], i_0[l], n_1[l], i_1[l],
+                                                  0.5))
+
+
+def test_non_equilibrium_ionization_stacked(element, rate_matrix, initial_condition):
+    time = np.linspace(0, 100, 51) * u.s
+    temperature = 10.**np.random.uniform(5.5, 7.5, size=(51, 3)) * u.K
+    density = 10.**np.random.uniform(8, 10, size=(51, 3)) * u.cm**(-3)
+    y = element.non_equilibrium_ionization(time, temperature, density, rate_matrix=rate_matrix,
+                                           initial_condition=initial_condition)
+    assert y.shape == (51, 3, 9)
+    rates = rate_matrix.value
+    indices = element._nearest_temperature_index(temperature)
+    for l in range(3):
+        y_single = element.non_equilibrium_ionization(time, temperature[:, l], density[:, l],
+                                                      rate_matrix=rate_matrix,
+                                                      initial_condition=initial_condition)
+        assert u.allclose(y[:, l, :], y_single)
+        y_inverse = np.zeros((51, 9))
+        y_inverse[0] = initial_condition[indices[0, l]]
+        for i in range(1, 51):
+            y_inverse[i] = inverse_step(rates, y_inverse[i-1], density[i-1, l].value,
+                                        indices[i-1, l], density[i, l].value, indices[i, l],
+                                        (time[i] - time[i-1]).value)
+        assert np.allclose(y_single.value, y_inverse)
+
+
+def test_adaptive_non_equilibrium_ionization(element, rate_matrix, initial_condition):
+    # Impulsive heating sampled far more coarsely than the ionization timescale
+    time = np.linspace(0, 100, 11) * u.s
+    temperature = np.where(time < 25*u.s, 1e5, 1e7) * np.ones((3,))[:, np.newaxis] * u.K
+    temperature = temperature.T
+    density = np.ones(temperature.shape) * 1e9 * u.cm**(-3)
+    y_adaptive = element.non_equilibrium_ionization(time, temperature, density,
+                                                    rate_matrix=rate_matrix,
+                                                    initial_condition=initial_condition,
+                                                    adaptive=True, rtol=1e-5)
+    # Reference is a fixed-step solution on a fine grid with the same linear interpolation
+    time_fine = np.linspace(0, 100, 20001) * u.s
+    temperature_fine = np.stack([np.interp(time_fine.value, time.value, temperature[:, l].value)
+                                 for l in range(3)], axis=1) * u.K
+    density_fine = np.ones(temperature_fine.shape) * 1e9 * u.cm**(-3)
+    y_fine = element.non_equilibrium_ionization(time_fine, temperature_fine, density_fine,
+                                                rate_matrix=rate_matrix,
+                                                initial_condition=initial_condition)[::2000]
+    y_coarse = element.non_equilibrium_ionization(time, temperature, density,
+                                                  rate_matrix=rate_matrix,
+                                                  initial_condition=initial_condition)
+    assert y_adaptive.shape == y_coarse.shape
+    assert np.fabs(y_adaptive - y_fine).max() < 1e-3
+    assert np.fabs(y_adaptive - y_fine).max() < np.fabs(y_coarse - y_fine).max()
+
+
+def test_adaptive_non_equilibrium_ionization_edge_cases(element, rate_matrix,
+                                                        initial_condition):
+    time = np.linspace(0, 100, 11) * u.s
+    temperature = np.where(time < 25*u.s, 1e5, 1e7) * u.K
+    density = np.ones(time.shape) * 1e9 * u.cm**(-3)
+    with pytest.warns(UserWarning, match='rtol'):
+        element.non_equilibrium_ionization(time, temperature, density, rate_matrix=rate_matrix,
+                                           initial_condition=initial_condition, adaptive=True,
+                                           rtol=1e-10, min_step=5*u.s)
+    y = element.non_equilibrium_ionization(time[:1], temperature[:1], density[:1],
+                                           rate_matrix=rate_matrix,
+                                           initial_condition=initial_condition, adaptive=True)
+    assert y.shape == (1, 9)
+
+
+@pytest.mark.parametrize('time', [
+    [0, 10, 10, 20, 30] * u.s,
+    [0, 10, 20, 15, 30] * u.s,
+])
+def test_adaptive_non_equilibrium_ionization_time_not_increasing(element, rate_matrix,
+                                                                 initial_condition, time):
+    temperature = np.ones(time.shape) * 1e6 * u.K
+    density = np.ones(time.shape) * 1e9 * u.cm**(-3)
+    with pytest.raises(ValueError, match='strictly increasing'):
+        element.non_equilibrium_ionization(time, temperature, density, rate_matrix=rate_matrix,
+                                           initial_condition=initial_condition, adaptive=True)
+    # A zero minimum step would also never advance
+    with pytest.raises(ValueError, match='positive'):
+        element.non_equilibrium_ionization(np.linspace(0, 30, 5) * u.s, temperature, density,
+                                           rate_matrix=rate_matrix,
+                                           initial_condition=initial_condition, adaptive=True,
+                                           min_step=0*u.s)
@@ -0,0 +1,159 @@
+"""
+Tests for the EBTEL interface that do not need an atomic database
+"""
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from sunpy.coordinates import HeliographicStonyhurst
+import h5py
+
+from synthesizAR import Loop, Field
+from synthesizAR.atomic import Element
+from synthesizAR.interfaces.ebtel import ebtel
+from synthesizAR.interfaces.ebtel import EbtelInterface
+
+
+class SyntheticElement(Element):
+    """
+    Element with made-up rates defined only by its temperature grid and name
+    """
+    # NOTE: shadow the properties of the ion collection
+    temperature = None
+    atomic_number = None
+    element_name = None
+
+    def __init__(self, element_name, temperature):
+        self.element_name = element_name
+        self.temperature = temperature
+        self.atomic_number = {'oxygen': 8, 'neon': 10}[element_name]
+
+    def _rate_matrix(self):
+        # Ionization out of each charge state and recombination into it, such that each column
+        # sums to zero and populations are conserved
+        n_charge = self.atomic_number + 1
+        charge_state = np.arange(n_charge)
+        log_temperature = np.log10(self.temperature.value)[:, np.newaxis]
+        ionization = 1e-10 * np.exp(-(charge_state / n_charge * 3. + 5. - log_temperature)**2)
+        recombination = 1e-11 * np.ones(ionization.shape)
+        ionization[:, -1] = 0.
+        recombination[:, 0] = 0.
+        rates = np.zeros(self.temperature.shape + (n_charge, n_charge))
+        for i in range(n_charge):
+            rates[:, i, i] = -(ionization[:, i] + recombination[:, i])
+            if i > 0:
+                rates[:, i, i-1] = ionization[:, i-1]
+            if i < n_charge - 1:
+                rates[:, i, i+1] = recombination[:, i+1]
+        return rates * u.cm**3 / u.s
+
+    def equilibrium_ionization(self, rate_matrix=None):
+        return np.ones(self.temperature.shape + (self.atomic_number + 1,)) / (
+            self.atomic_number + 1)
+
+
+class SyntheticLoop(object):
+
+    def __init__(self, name, time, electron_temperature, density):
+        self.name = name
+        self.time = time
+        # NOTE: EBTEL results are uniform along the loop
+        self.electron_temperature = electron_temperature[:, np.newaxis] * np.ones((4,))
+        self.density = density[:, np.newaxis] * np.ones((4,))
+
+
+@pytest.fixture
+def loops():
+    np.random.seed(42)
+    loops = []
+    for i in range(5):
+        # NOTE: two different time grids such that loops are grouped
+        time = np.linspace(0, 100, 21 if i % 2 else 41) * u.s
+        temperature = 10.**np.random.uniform(5.5, 7.5, size=time.shape) * u.K
+        density = 10.**np.random.uniform(8, 10, size=time.shape) * u.cm**(-3)
+        loops.append(SyntheticLoop(f'loop{i:06d}', time, temperature, density))
+    return loops
+
+
+@pytest.fixture
+def emission_model(tmpdir):
+    ion = type('SyntheticIon', (object,), {'element_name': 'oxygen'})
+    other_ion = type('SyntheticIon', (object,), {'element_name': 'neon'})
+    model = type('SyntheticEmissionModel', (object,), {
+        'ionization_fraction_savefile': str(tmpdir.join('ionization_fraction.h5')),
+        'temperature': 10.**np.linspace(5, 8, 31) * u.K,
+        '__iter__': lambda self: iter([ion, other_ion, ion]),
+    })
+    return model()
+
+
+def test_calculate_ionization_fraction_resume(emission_model, loops, monkeypatch):
+    monkeypatch.setattr(ebtel, 'Element', SyntheticElement)
+    field = type('SyntheticField', (object,), {'loops': loops})
+    savefile = emission_model.ionization_fraction_savefile
+    # Partially written file: one complete result, which is kept, and one interrupted result,
+    # which is recomputed
+    with h5py.File(savefile, 'w') as hf:
+        dset = hf.create_group(loops[0].name).create_dataset('oxygen',
+                                                             data=-np.ones((41, 9)))
+        dset.attrs['complete'] = True
+        hf.create_group(loops[1].name).create_dataset('neon', data=-np.ones((21, 11)))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        EbtelInterface.calculate_ionization_fraction(field, emission_model, executor=executor,
+                                                     batch_size=2)
+    with h5py.File(savefile, 'r') as hf:
+        assert np.all(hf[loops[0].name]['oxygen'][:] == -1)
+        for loop in loops:
+            for el_name in ['oxygen', 'neon']:
+                dset = hf[loop.name][el_name]
+                assert dset.attrs['complete']
+                if loop is loops[0] and el_name == 'oxygen':
+                    continue
+                el = SyntheticElement(el_name, emission_model.temperature)
+                rate_matrix = el._rate_matrix()
+                expected = el.non_equilibrium_ionization(
+                    loop.time, loop.electron_temperature[:, 0], loop.density[:, 0],
+                    rate_matrix=rate_matrix,
+                    initial_condition=el.equilibrium_ionization(rate_matrix))
+                assert np.allclose(dset[:], expected.value)
+
+
+def test_load_results_round_trip(tmpdir):
+    angle = np.linspace(0, np.pi, 9)
+    coordinates = SkyCoord(x=(10 + np.sin(angle))*u.Mm, y=np.cos(angle)*u.Mm,
+                           z=np.zeros(angle.shape)*u.Mm, frame=HeliographicStonyhurst,
+                           representation='cartesian')
+    loop = Loop('loop000000', coordinates, np.ones(angle.shape)*u.G)
+    np.random.seed(42)
+    time = np.linspace(0, 100, 11)
+    results = np.stack([time, 10.**np.random.uniform(5.5, 7.5, size=time.shape),
+                        10.**np.random.uniform(5.5, 7.5, size=time.shape),
+                        10.**np.random.uniform(8, 10, size=time.shape),
+                        np.random.uniform(-1e6, 1e6, size=time.shape), np.zeros(time.shape)],
+                       axis=1)
+    loop.hydro_configuration = {'output_filename': str(tmpdir.join('loop000000.txt'))}
+    np.savetxt(loop.hydro_configuration['output_filename'], results)
+    interface = EbtelInterface({}, SimpleNamespace(), str(tmpdir.join('config')),
+                               str(tmpdir.join('results')))
+    savefile = str(tmpdir.join('parameters.h5'))
+    Field.load_loop_simulations(SimpleNamespace(loops=[loop]), interface, savefile,
+                                notebook=False)
+    with h5py.File(savefile, 'r') as hf:
+        # Uniform quantities are stored without repeating them along the loop
+        for name in ['electron_temperature', 'ion_temperature', 'density']:
+            assert hf[loop.name][name].shape == time.shape
+        assert hf[loop.name]['velocity'].shape == time.shape + angle.shape
+    # Previously, the uniform quantities were stored as the outer product with the coordinate
+    ones = np.ones(angle.shape)
+    for name, i, unit in [('electron_temperature', 1, u.K), ('ion_temperature', 2, u.K),
+                          ('density', 3, u.cm**(-3))]:
+        quantity = getattr(loop, name)
+        assert quantity.shape == time.shape + angle.shape
+        assert u.allclose(quantity, np.outer(results[:, i], ones) * unit)
+    assert u.allclose(loop.time, time * u.s)
+    velocity = loop.velocity
+    assert velocity.shape == time.shape + angle.shape
+    assert u.allclose(np.fabs(velocity), np.outer(np.fabs(results[:, 4]), ones) * u.cm / u.s)
@@ -0,0 +1,276 @@
+"""
+Tests for field extrapolation
+"""
+import os
+
+import pytest
+import numba
+import numpy as np
+import astropy.units as u
+import astropy.constants as const
+from scipy.interpolate import griddata, RegularGridInterpolator
+from astropy.coordinates import SkyCoord
+from sunpy.coordinates import HeliographicStonyhurst, Helioprojective
+
+from synthesizAR.util import SpatialPair
+from synthesizAR.extrapolate import (PotentialField, UniformVectorField, trace_fieldlines,
+                                     find_seed_points, from_local, from_local_batch,
+                                     from_pfsspack, synthetic_magnetogram)
+from synthesizAR.extrapolate.helpers import to_local
+from synthesizAR.extrapolate.extrapolators import (calculate_phi, calculate_phi_fft,
+                                                   calculate_phi_parallel)
+
+
+@pytest.fixture
+def magnetogram():
+    arr_shape = [20, 20] * u.pixel
+    obs = SkyCoord(lon=0.*u.deg, lat=0.*u.deg, radius=const.au, frame=HeliographicStonyhurst)
+    blc = SkyCoord(-150 * u.arcsec, -150 * u.arcsec, frame=Helioprojective(observer=obs))
+    trc = SkyCoord(150 * u.arcsec, 150 * u.arcsec, frame=Helioprojective(observer=obs))
+    centers = SkyCoord(Tx=[65, -65]*u.arcsec, Ty=[0, 0]*u.arcsec,
+                       frame=Helioprojective(observer=obs))
+    sigmas = u.Quantity([[15, 15], [15, 15]], 'arcsec')
+    amplitudes = u.Quantity([1e3, -1e3], 'Gauss')
+    return synthetic_magnetogram(blc, trc, arr_shape, centers, sigmas, amplitudes, observer=obs)
+
+
+def test_calculate_phi_fft_matches_direct_sum():
+    shape = SpatialPair(x=12, y=9, z=4)
+    delta = SpatialPair(x=1.5, y=2., z=1.)
+    z_depth = -delta.z / np.sqrt(2. * np.pi)
+    l_hat = np.array([0.1, -0.2, 1.])
+    l_hat /= np.sqrt((l_hat**2).sum())
+    boundary = np.random.normal(size=(shape.y, shape.x))
+    phi_direct = calculate_phi(np.zeros((shape.y, shape.x, shape.z)), boundary, delta, shape,
+                               z_depth, l_hat)
+    phi_fft = calculate_phi_fft(boundary, delta, shape, z_depth, l_hat)
+    assert phi_fft.shape == (shape.y, shape.x, shape.z)
+    assert np.allclose(phi_fft, phi_direct, rtol=1e-8, atol=1e-10)
+
+
+@pytest.mark.parametrize('tile_size', [1, 3, 4, 16])
+@pytest.mark.parametrize('num_threads', [1, 2])
+def test_calculate_phi_parallel_matches_direct_sum(tile_size, num_threads):
+    shape = SpatialPair(x=7, y=10, z=3)
+    delta = SpatialPair(x=1., y=0.5, z=2.)
+    z_depth = -delta.z / np.sqrt(2. * np.pi)
+    l_hat = np.array([0.1, -0.2, 1.])
+    l_hat /= np.sqrt((l_hat**2).sum())
+    boundary = np.random.normal(size=(shape.y, shape.x))
+    phi_direct = calculate_phi(np.zeros((shape.y, shape.x, shape.z)), boundary, delta, shape,
+                               z_depth, l_hat)
+    # NOTE: tiles that do not divide the grid and a tile larger than the grid are included
+    default_num_threads = numba.get_num_threads()
+    numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+    try:
+        phi_parallel = calculate_phi_parallel(boundary, delta, shape, z_depth, l_hat,
+                                              tile_size)
+    finally:
+        numba.set_num_threads(default_num_threads)
+    assert np.allclose(phi_parallel, phi_direct)
+
+
+def test_trace_fieldlines_uniform_grid_arcade():
+    # Potential arcade with field lines that are closed semicircle-like arcs above z=0
+    k = np.pi / 2e9
+    x = np.linspace(-2e9, 2e9, 41)
+    y = np.linspace(-1e9, 1e9, 11)
+    z = np.linspace(0, 2e9, 21)
+    y_grid, x_grid, z_grid = np.meshgrid(y, x, z, indexing='ij')
+    Bx = np.cos(k * x_grid) * np.exp(-k * z_grid) * u.G
+    Bz = -np.sin(k * x_grid) * np.exp(-k * z_grid) * u.G
+    dx, dy, dz = 1e8, 2e8, 1e8
+    ds = UniformVectorField(Bx, np.zeros(Bx.shape) * u.G, Bz,
+                            u.Quantity([x[0] - dx/2, x[-1] + dx/2], 'cm'),
+                            u.Quantity([y[0] - dy/2, y[-1] + dy/2], 'cm'),
+                            u.Quantity([z[0] - dz/2, z[-1] + dz/2], 'cm'))
+
+    def get_seed_points(ds, number_fieldlines, **kwargs):
+        return [[-5e8, 0., 0.]]
+
+    lines = trace_fieldlines(ds, 1, get_seed_points=get_seed_points, close_threshold=0.1,
+                             loop_length_range=[1e8, 1e10]*u.cm, step_size=0.2)
+    assert len(lines) == 1
+    line, magnitude = lines[0]
+    assert line.shape[0] == magnitude.shape[0]
+    assert line[:, 2].max() > 0
+    # The arc closes symmetrically about x=0
+    assert np.fabs(line[-1, 0] - 5e8) < 1e8
+
+
+def test_field_derivative_is_exact_for_quadratic():
+    x, y, z = np.meshgrid(np.arange(10.), np.arange(8.), np.arange(9.), indexing='ij')
+    h = 0.5
+    phi = (h * x)**2 + 2. * y - z**2
+    expected = -2. * h * x
+    stencil = PotentialField._derivative(phi, 0, h, 'stencil')
+    assert stencil.flags['C_CONTIGUOUS']
+    assert np.allclose(stencil[2:-2], expected[2:-2])
+    # Outermost layers are copied from the nearest interior layer
+    assert np.allclose(stencil[:2], stencil[2])
+    assert np.allclose(stencil[-2:], stencil[-3])
+    assert np.allclose(PotentialField._derivative(phi, 0, h, 'gradient'), expected)
+
+
+def test_from_local_batch_matches_from_local():
+    center = SkyCoord(lon=20*u.deg, lat=-10*u.deg, radius=const.R_sun,
+                      frame=HeliographicStonyhurst)
+    xyz = np.random.uniform(-1e9, 1e9, size=(12, 3)) * u.cm
+    offsets = [0, 5, 12]
+    coords = from_local_batch(xyz, offsets, center)
+    assert len(coords) == 2
+    for c, i, j in zip(coords, offsets[:-1], offsets[1:]):
+        expected = from_local(xyz[i:j, 0], xyz[i:j, 1], xyz[i:j, 2], center)
+        assert u.allclose(c.cartesian.xyz, expected.cartesian.xyz)
+
+
+def test_extrapolate_cache(magnetogram, tmpdir):
+    cache_dir = str(tmpdir.mkdir('extrapolation_cache'))
+    field = PotentialField(magnetogram, 1e10*u.cm, 10*u.pixel, cache_dir=cache_dir)
+    # Miss: the potential and field are computed and saved
+    B_field = field.extrapolate()
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 4
+    assert not [f for f in os.listdir(cache_dir) if f.endswith('.tmp')]
+    # Hit: the field is read from disk without computing the potential
+    field_cached = PotentialField(magnetogram, 1e10*u.cm, 10*u.pixel, cache_dir=cache_dir)
+
+    def calculate_phi(*args, **kwargs):
+        raise AssertionError('potential should not be recomputed')
+    field_cached.calculate_phi = calculate_phi
+    B_field_cached = field_cached.extrapolate()
+    for b, b_cached in zip(B_field, B_field_cached):
+        assert u.allclose(b, b_cached)
+    # A different grid is a miss
+    field_other = PotentialField(magnetogram, 1e10*u.cm, 12*u.pixel, cache_dir=cache_dir)
+    field_other.extrapolate()
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 8
+
+
+def test_extrapolate_dtype(magnetogram, tmpdir):
+    cache_dir = str(tmpdir.mkdir('extrapolation_cache'))
+    field = PotentialField(magnetogram, 1e10*u.cm, 10*u.pixel, cache_dir=cache_dir)
+    B_field = field.extrapolate()
+    # A field of different precision is a miss but reuses the cached potential
+    field_cached = PotentialField(magnetogram, 1e10*u.cm, 10*u.pixel, cache_dir=cache_dir)
+
+    def calculate_phi(*args, **kwargs):
+        raise AssertionError('potential should not be recomputed')
+    field_cached.calculate_phi = calculate_phi
+    B_field_single = field_cached.extrapolate(dtype=np.float32)
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 7
+    for b, b_single in zip(B_field, B_field_single):
+        assert b.dtype == np.float64
+        assert b_single.dtype == np.float32
+        assert u.allclose(b_single, b, rtol=1e-5, atol=1e-5*np.fabs(b).max())
+    # Each precision is then served from its own cached field
+    for dtype in [np.float32, np.float64]:
+        for b in field_cached.extrapolate(dtype=dtype):
+            assert b.dtype == dtype
+    # Without a cache, the field is computed in the requested precision
+    field_uncached = PotentialField(magnetogram, 1e10*u.cm, 10*u.pixel)
+    for b, b_single in zip(field_uncached.extrapolate(dtype=np.float32), B_field_single):
+        assert b.dtype == np.float32
+        assert u.allclose(b, b_single)
+
+
+def test_project_boundary_matches_griddata(magnetogram):
+    field = PotentialField(magnetogram, 1e10*u.cm, 10*u.pixel)
+    boundary = field.project_boundary(field.range.x, field.range.y)
+    # Reference is the original projection, which scatters every magnetogram pixel onto the
+    # plane and interpolates on the triangulation
+    p_y, p_x = np.indices(magnetogram.data.shape)
+    world_coords = magnetogram.pixel_to_world(p_x.flatten()*u.pixel, p_y.flatten()*u.pixel)
+    local_x, local_y, _ = to_local(world_coords, magnetogram.center)
+    points = np.stack([local_x.to(u.cm).value, local_y.to(u.cm).value], axis=1)
+    x_new = np.linspace(*field.range.x.to(u.cm).value, int(field.shape.x.value))
+    y_new = np.linspace(*field.range.y.to(u.cm).value, int(field.shape.y.value))
+    x_grid, y_grid = np.meshgrid(x_new, y_new)
+    expected = griddata(points, magnetogram.data.flatten(), (x_grid, y_grid), fill_value=0.)
+    assert boundary.shape == expected.shape
+    # NOTE: the grid on the plane falls on the pixel centers such that both interpolations
+    # reduce to the pixel values
+    assert np.allclose(boundary.to_value(magnetogram.meta['bunit']), expected, rtol=0,
+                       atol=1e-6 * np.fabs(expected).max())
+
+
+@pytest.fixture
+def uniform_field():
+    # Two unipolar regions of equal area, one ten times stronger than the other
+    Bz = np.ones((20, 40, 5))
+    Bz[:, 20:, :] = 10.
+    return UniformVectorField(np.zeros(Bz.shape) * u.G, np.zeros(Bz.shape) * u.G, Bz * u.G,
+                              [0, 4e9] * u.cm, [0, 2e9] * u.cm, [0, 1e9] * u.cm)
+
+
+def test_find_seed_points(uniform_field):
+    seeds = find_seed_points(uniform_field, 50, mask_threshold=0.05, seed=42)
+    assert len(seeds) == 50
+    assert len(set(map(tuple, seeds))) == 50
+    # Same seed gives the same points, a different seed does not
+    assert seeds == find_seed_points(uniform_field, 50, mask_threshold=0.05, seed=42)
+    assert seeds != find_seed_points(uniform_field, 50, mask_threshold=0.05, seed=43)
+    # Earlier seeds are never drawn again
+    more_seeds = find_seed_points(uniform_field, 50, mask_threshold=0.05, seed=42,
+                                  preexisting_seeds=seeds)
+    assert not set(map(tuple, seeds)) & set(map(tuple, more_seeds))
+
+
+def test_find_seed_points_max_failures_deprecated(uniform_field):
+    seeds = find_seed_points(uniform_field, 50, mask_threshold=0.05, seed=42)
+    with pytest.warns(DeprecationWarning, match='max_failures'):
+        deprecated = find_seed_points(uniform_field, 50, mask_threshold=0.05, seed=42,
+                                      max_failures=1000)
+    assert deprecated == seeds
+
+
+def test_find_seed_points_flux_weighted(uniform_field):
+    # NOTE: the strong region holds 10/11 of the flux but only half of the area
+    x_mid = 2e9
+    uniform = np.array(find_seed_points(uniform_field, 200, mask_threshold=0.05, seed=42,
+                                        safety=4))
+    weighted = np.array(find_seed_points(uniform_field, 200, mask_threshold=0.05, seed=42,
+                                         safety=4, flux_weighted=True))
+    assert (uniform[:, 0] > x_mid).mean() < 0.7
+    assert (weighted[:, 0] > x_mid).mean() > 0.8
+
+
+def test_from_pfsspack_matches_per_line():
+    n_r, n_theta, n_phi = 6, 10, 20
+    n_lines, n_points = 4, 15
+    # NOTE: theta decreases such that latitude increases
+    theta = np.linspace(0.9*np.pi, 0.1*np.pi, n_theta)
+    phi = np.linspace(0, 2*np.pi, n_phi, endpoint=False)
+    pfss_fieldlines = {
+        'nstep': np.array([15, 3, 9, 12]),
+        'ptr': np.random.uniform(1., 2., size=(n_lines, n_points)),
+        'ptth': np.random.uniform(0.2*np.pi, 0.8*np.pi, size=(n_lines, n_points)),
+        'ptph': np.random.uniform(0., 2*np.pi, size=(n_lines, n_points)),
+        'now': b'2011-02-15 00:00:00',
+        'rix': np.linspace(1., 2.5, n_r),
+        'theta': theta,
+        'phi': phi,
+        'br': np.random.normal(size=(n_r, n_theta, n_phi)),
+        'bth': np.random.normal(size=(n_r, n_theta, n_phi)),
+        'bph': np.random.normal(size=(n_r, n_theta, n_phi)),
+    }
+    fieldlines = from_pfsspack(pfss_fieldlines)
+    coords, field_strengths, offsets = from_pfsspack(pfss_fieldlines, ragged=True)
+    assert len(fieldlines) == n_lines
+    assert np.all(np.diff(offsets) == pfss_fieldlines['nstep'])
+    # Reference is the original conversion, one line and one interpolator per component at a time
+    grid = ((pfss_fieldlines['rix'] * const.R_sun).to_value(u.cm),
+            90. - np.rad2deg(theta), np.rad2deg(phi - np.pi))
+    interpolators = [RegularGridInterpolator(grid, pfss_fieldlines[b], bounds_error=False,
+                                             fill_value=None) for b in ['br', 'bth', 'bph']]
+    for i, (coord, field_strength) in enumerate(fieldlines):
+        n_valid = pfss_fieldlines['nstep'][i]
+        lon = np.rad2deg(pfss_fieldlines['ptph'][i, :n_valid]) * u.deg
+        lat = 90*u.deg - np.rad2deg(pfss_fieldlines['ptth'][i, :n_valid]) * u.deg
+        radius = pfss_fieldlines['ptr'][i, :n_valid] * const.R_sun.to(u.cm)
+        assert u.allclose(coord.lon, lon)
+        assert u.allclose(coord.lat, lat)
+        assert u.allclose(coord.radius, radius)
+        points = np.stack([radius.value, lat.value, lon.value], axis=1)
+        expected = np.sqrt(np.sum([f(points)**2 for f in interpolators], axis=0)) * u.Gauss
+        assert u.allclose(field_strength, expected)
+        assert u.allclose(field_strengths[offsets[i]:offsets[i+1]], expected)
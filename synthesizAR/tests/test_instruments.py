@@ -0,0 +1,622 @@
+"""
+Tests for emission model and instrument calculations with a synthetic emission model
+"""
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+import numpy as np
+from scipy.interpolate import splrep, RegularGridInterpolator
+import astropy.units as u
+import astropy.constants as const
+from astropy.coordinates import SkyCoord
+from sunpy.coordinates import HeliographicStonyhurst
+import h5py
+
+from synthesizAR.atomic import EmissionModel
+from synthesizAR.atomic import emission_models
+from synthesizAR.instruments import InstrumentSDOAIA, InstrumentHinodeEIS
+from synthesizAR.observe import Observer
+
+
+class SyntheticIon(object):
+
+    def __init__(self, element_name, charge_state, temperature, abundance):
+        self.element_name = element_name
+        self.charge_state = charge_state
+        self.ion_name = f'{element_name}_{charge_state + 1}'
+        self.atomic_symbol = {'iron': 'Fe', 'oxygen': 'O'}[element_name]
+        self.ionization_stage = charge_state + 1
+        self.temperature = temperature
+        self.abundance = abundance * u.dimensionless_unscaled
+
+
+class SyntheticPopulationIon(SyntheticIon):
+    """
+    Ion with made-up level populations and transitions such that emissivities can be computed
+    without an atomic database
+    """
+
+    def __init__(self, element_name, charge_state, temperature, abundance, available=True):
+        super().__init__(element_name, charge_state, temperature, abundance)
+        self.available = available
+        self.transitions = SimpleNamespace(
+            upper_level=np.array([2, 4, 3, 3]),
+            wavelength=u.Quantity([200., 150., 180. + charge_state, 90.], 'Angstrom'),
+            A=u.Quantity([1e9, 2e9, 3e9, 4e9], '1/s'),
+            is_twophoton=np.array([False, False, False, True]))
+        self._elvlc = {'level': np.arange(1, 5)}
+
+    def level_populations(self, density):
+        if not self.available:
+            return None
+        log_t = np.log10(self.temperature.value)[:, np.newaxis, np.newaxis]
+        log_n = np.log10(density.value)[np.newaxis, :, np.newaxis]
+        level = np.arange(4)
+        pop = np.exp(-(log_t - 5.5 - 0.1*self.charge_state - 0.3*level)**2) * (log_n / 9.)**level
+        return pop / pop.sum(axis=-1, keepdims=True)
+
+
+class SyntheticEmissionModel(EmissionModel):
+    """
+    Emission model with smooth, made-up emissivities and ionization fractions such that no
+    atomic database is needed
+    """
+    # NOTE: shadow the temperature property of the ion collection
+    temperature = None
+
+    def __init__(self, temperature, density, ions, emissivity_savefile):
+        self._ion_list = ions
+        self.temperature = temperature
+        self.density = density
+        self.resolved_wavelengths = {}
+        self._mesh_log_temperature = np.log10(self.temperature.value)
+        self._mesh_log_density = np.log10(self.density.value)
+        self._mesh_indices_memo = None
+        self.emissivity_cache_size = 2**30
+        self.clear_emissivity_cache()
+        self._ioneq_log_temperature = None
+        self._ioneq_tables = {}
+        self._ionization_fraction_index_memo = None
+        self.ionization_fraction_savefile = None
+        self.emissivity_savefile = emissivity_savefile
+        self.emissivity_reads = 0
+
+    def __iter__(self):
+        return iter(self._ion_list)
+
+    def __len__(self):
+        return len(self._ion_list)
+
+    def __getitem__(self, index):
+        return self._ion_list[index]
+
+    def get_emissivity(self, ion):
+        self.emissivity_reads += 1
+        return super().get_emissivity(ion)
+
+    def _equilibrium_ionization_table(self, element_name):
+        log_temperature = np.linspace(5., 8., 301)
+        charge_state = np.arange(27)
+        table = np.exp(-((log_temperature[:, np.newaxis] - 5.4 - 0.07*charge_state)/0.15)**2)
+        return log_temperature, table / table.sum(axis=1, keepdims=True)
+
+
+class SyntheticLoop(object):
+
+    def __init__(self, name, electron_temperature, density):
+        self.name = name
+        self.electron_temperature = electron_temperature
+        self.density = density
+        self.time = np.arange(density.shape[0]) * u.s
+        self.field_aligned_coordinate = np.arange(density.shape[1]) * u.cm
+
+
+@pytest.fixture
+def emission_model(tmpdir):
+    temperature = 10.**np.linspace(5.5, 7.5, 81) * u.K
+    density = 10.**np.linspace(8, 11, 13) * u.cm**(-3)
+    ions = [SyntheticIon('iron', q, temperature, 1e-4 * (1. + q/10.)) for q in [8, 11, 13, 15]]
+    savefile = str(tmpdir.join('emissivity.h5'))
+    log_t, log_n = np.meshgrid(np.log10(temperature.value), np.log10(density.value),
+                               indexing='ij')
+    with h5py.File(savefile, 'w') as hf:
+        for i, ion in enumerate(ions):
+            wavelength = np.array([168., 171.1, 193.5, 195.1, 211.3]) + i
+            emissivity = (np.exp(-(log_t - 5.8 - 0.2*i)**2 / 0.3)
+                          * (10.**log_n / 1e9)**0.2)[..., np.newaxis] * (1. + np.arange(5.))
+            grp = hf.create_group(ion.ion_name)
+            ds = grp.create_dataset('wavelength', data=wavelength)
+            ds.attrs['units'] = 'Angstrom'
+            ds = grp.create_dataset('emissivity', data=emissivity)
+            ds.attrs['units'] = 'ph / s'
+    return SyntheticEmissionModel(temperature, density, ions, savefile)
+
+
+@pytest.fixture
+def loop():
+    np.random.seed(42)
+    temperature = 10.**np.random.uniform(5.6, 7.4, size=(5, 30)) * u.K
+    density = 10.**np.random.uniform(8.5, 10.5, size=(5, 30)) * u.cm**(-3)
+    return SyntheticLoop('loop000000', temperature, density)
+
+
+@pytest.fixture
+def channels():
+    wavelength = np.linspace(150, 230, 161)
+    return [{'name': name,
+             'wavelength_response_spline': splrep(wavelength,
+                                                  np.exp(-((wavelength - w)/5.)**2))}
+            for name, w in [('171', 171.), ('193', 193.), ('211', 211.)]]
+
+
+@pytest.fixture
+def population_ions():
+    temperature = 10.**np.linspace(5.5, 7.5, 21) * u.K
+    return [SyntheticPopulationIon('iron', q, temperature, 1e-4) for q in [8, 11, 13]] + [
+        SyntheticPopulationIon('iron', 15, temperature, 1e-4, available=False)]
+
+
+def population_model(ions, density=10.**np.linspace(8, 11, 7) * u.cm**(-3)):
+    return SyntheticEmissionModel(ions[0].temperature, density, ions, None)
+
+
+def test_calculate_emissivity_parallel(population_ions, tmpdir):
+    serial = population_model(population_ions)
+    with pytest.warns(UserWarning, match='iron_16'):
+        serial.calculate_emissivity(str(tmpdir.join('serial.h5')), max_workers=1,
+                                    notebook=False)
+    parallel = population_model(population_ions)
+    # NOTE: a thread pool exercises the same out-of-order writer without forking a process
+    # that may already be running threaded numba kernels
+    with pytest.warns(UserWarning, match='iron_16'):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            parallel.calculate_emissivity(str(tmpdir.join('parallel.h5')), executor=executor,
+                                          notebook=False)
+    with h5py.File(serial.emissivity_savefile, 'r') as hf_serial:
+        with h5py.File(parallel.emissivity_savefile, 'r') as hf_parallel:
+            assert set(hf_serial.keys()) == set(hf_parallel.keys())
+            for ion in population_ions:
+                key = hf_serial[ion.ion_name].attrs['key']
+                assert hf_parallel[ion.ion_name].attrs['key'] == key
+    for ion in population_ions:
+        wavelength, emissivity = serial.get_emissivity(ion)
+        wavelength_parallel, emissivity_parallel = parallel.get_emissivity(ion)
+        if not ion.available:
+            assert wavelength is None and wavelength_parallel is None
+            continue
+        # Two-photon transitions are dropped and the rest are sorted by wavelength
+        assert u.allclose(wavelength, [150., 180. + ion.charge_state, 200.] * u.angstrom)
+        assert emissivity.shape == (21, 7, 3)
+        assert u.allclose(wavelength_parallel, wavelength)
+        assert u.allclose(emissivity_parallel, emissivity)
+
+
+def test_calculate_emissivity_incremental(population_ions, tmpdir, monkeypatch):
+    computed = []
+    calculate_ion_emissivity = emission_models._calculate_ion_emissivity
+
+    def counted(ion, density):
+        computed.append(ion.ion_name)
+        return calculate_ion_emissivity(ion, density)
+    monkeypatch.setattr(emission_models, '_calculate_ion_emissivity', counted)
+    savefile = str(tmpdir.join('emissivity.h5'))
+    model = population_model(population_ions[:2])
+    model.calculate_emissivity(savefile, max_workers=1, notebook=False)
+    assert computed == ['iron_9', 'iron_12']
+    _, emissivity = model.get_emissivity(population_ions[0])
+    # Ions already in the file, including those without populations, are skipped
+    computed.clear()
+    model = population_model(population_ions)
+    with pytest.warns(UserWarning, match='iron_16'):
+        model.calculate_emissivity(savefile, max_workers=1, notebook=False)
+    assert computed == ['iron_14', 'iron_16']
+    assert u.allclose(model.get_emissivity(population_ions[0])[1], emissivity)
+    computed.clear()
+    model.calculate_emissivity(savefile, max_workers=1, notebook=False)
+    assert computed == []
+    # A different density grid invalidates every ion
+    model = population_model(population_ions, density=10.**np.linspace(8, 11, 4) * u.cm**(-3))
+    with pytest.warns(UserWarning, match='iron_16'):
+        model.calculate_emissivity(savefile, max_workers=1, notebook=False)
+    assert sorted(computed) == sorted([ion.ion_name for ion in population_ions])
+    assert model.get_emissivity(population_ions[0])[1].shape == (21, 4, 3)
+
+
+def test_emissivity_cache_eviction(emission_model):
+    ions = list(emission_model)
+    nbytes = sum(q.nbytes for q in emission_model.get_emissivity(ions[0]))
+    emission_model.clear_emissivity_cache()
+    emission_model.emissivity_cache_size = 2*nbytes
+    emission_model.get_emissivity(ions[0])
+    emission_model.get_emissivity(ions[1])
+    assert list(emission_model._emissivity_cache) == ['iron_9', 'iron_12']
+    # A hit moves the ion to the back of the queue such that the other ion is evicted
+    emission_model.get_emissivity(ions[0])
+    emission_model.get_emissivity(ions[2])
+    assert list(emission_model._emissivity_cache) == ['iron_9', 'iron_14']
+    assert emission_model._emissivity_cache_nbytes == 2*nbytes
+    # Emissivities larger than the cache are returned but never cached
+    emission_model.clear_emissivity_cache()
+    emission_model.emissivity_cache_size = nbytes - 1
+    wavelength, emissivity = emission_model.get_emissivity(ions[0])
+    assert emissivity.shape == (81, 13, 5)
+    assert len(emission_model._emissivity_cache) == 0
+    assert emission_model._emissivity_cache_nbytes == 0
+
+
+@pytest.mark.parametrize('memmap', [True, False])
+def test_preload_emissivity(emission_model, memmap):
+    expected = [emission_model.get_emissivity(ion) for ion in emission_model]
+    emission_model.preload_emissivity(memmap=memmap)
+    root = f'{os.path.splitext(emission_model.emissivity_savefile)[0]}_preload'
+    assert os.path.exists(f'{root}_emissivity.npy') == memmap
+    assert os.path.exists(f'{root}_wavelength.npy') == memmap
+    assert len(emission_model._emissivity_cache) == 0
+    models = [emission_model, pickle.loads(pickle.dumps(emission_model))]
+    if memmap:
+        # Only the location of the buffer is pickled; it is reopened on first use
+        assert models[1]._emissivity_buffer['emissivity'] is None
+    for model in models:
+        for ion, (wavelength, emissivity) in zip(model, expected):
+            wavelength_preload, emissivity_preload = model.get_emissivity(ion)
+            assert u.allclose(wavelength_preload, wavelength)
+            assert u.allclose(emissivity_preload, emissivity)
+        assert len(model._emissivity_cache) == 0
+
+
+def test_pickle_warm_emissivity_cache(emission_model):
+    expected = [emission_model.get_emissivity(ion) for ion in emission_model]
+    assert len(emission_model._emissivity_cache) == len(expected)
+    restored = pickle.loads(pickle.dumps(emission_model))
+    assert len(restored._emissivity_cache) == 0
+    assert restored._emissivity_cache_nbytes == 0
+    # Pickling does not empty the cache of the original model
+    assert len(emission_model._emissivity_cache) == len(expected)
+    for ion, (wavelength, emissivity) in zip(restored, expected):
+        wavelength_restored, emissivity_restored = restored.get_emissivity(ion)
+        assert u.allclose(wavelength_restored, wavelength)
+        assert u.allclose(emissivity_restored, emissivity)
+    assert len(restored._emissivity_cache) == len(expected)
+
+
+def test_flatten_emissivities_cache(emission_model, channels):
+    channel = channels[0]
+    uncached = InstrumentSDOAIA.flatten_emissivities(channel, emission_model, cache=False)
+    assert uncached.filename is None
+    n_reads = emission_model.emissivity_reads
+    # Miss: the table is computed and written to the cache
+    table = InstrumentSDOAIA.flatten_emissivities(channel, emission_model)
+    assert emission_model.emissivity_reads == 2 * n_reads
+    assert os.path.isfile(table.filename)
+    assert np.all(table.valid == uncached.valid)
+    assert np.allclose(table.data, uncached.data)
+    # Hit: the table is memory-mapped without reading any emissivities
+    cached = InstrumentSDOAIA.flatten_emissivities(channel, emission_model)
+    assert emission_model.emissivity_reads == 2 * n_reads
+    assert cached.filename == table.filename
+    assert np.allclose(cached.data, uncached.data)
+    assert cached.unit == uncached.unit
+    # A different wavelength response is a different table
+    other = InstrumentSDOAIA.flatten_emissivities(channels[1], emission_model)
+    assert other.filename != table.filename
+    cache_dir = os.path.dirname(table.filename)
+    assert not [f for f in os.listdir(cache_dir) if f.endswith('.tmp')]
+
+
+def test_calculate_counts_full_channels(emission_model, channels, loop):
+    flattened_emissivities = [InstrumentSDOAIA.flatten_emissivities(c, emission_model)
+                              for c in channels]
+    ions, table, unit = InstrumentSDOAIA.stack_emissivities(emission_model,
+                                                            flattened_emissivities)
+    assert table.flags['C_CONTIGUOUS']
+    assert table.shape == (81, 13, len(ions), len(channels))
+    counts = InstrumentSDOAIA.calculate_counts_full_channels(loop, emission_model,
+                                                             (ions, table, unit))
+    assert counts.shape == loop.density.shape + (len(channels),)
+    # Compare against interpolating each ion separately
+    points = np.stack([np.log10(loop.electron_temperature.value),
+                       np.log10(loop.density.value)], axis=-1)
+    ioneq = emission_model.get_ionization_fractions(loop, ions).value
+    for j, (channel, fe) in enumerate(zip(channels, flattened_emissivities)):
+        expected = np.zeros(loop.density.shape)
+        for i, ion in enumerate(ions):
+            f = RegularGridInterpolator((np.log10(emission_model.temperature.value),
+                                         np.log10(emission_model.density.value)),
+                                        fe[i].to_value(unit))
+            expected += ion.abundance.value * ioneq[i] * f(points)
+        expected *= loop.density.value * 0.83 / (4. * np.pi)
+        assert np.allclose(counts[..., j].value, expected)
+        single = InstrumentSDOAIA.calculate_counts_full(channel, loop, emission_model, fe)
+        assert u.allclose(single, counts[..., j])
+
+
+def test_get_ionization_fractions(emission_model, loop, tmpdir):
+    # Mix spatially resolved and spatially uniform populations
+    savefile = str(tmpdir.join('ionization_fraction.h5'))
+    ions = emission_model._ion_list + [SyntheticIon('oxygen', 5, emission_model.temperature,
+                                                    1e-3)]
+    with h5py.File(savefile, 'w') as hf:
+        grp = hf.create_group(loop.name)
+        ds = grp.create_dataset('iron', data=np.random.uniform(size=loop.density.shape + (27,)))
+        ds.attrs['units'] = ''
+        ds = grp.create_dataset('oxygen', data=np.random.uniform(size=loop.density.shape[:1]
+                                                                 + (9,)))
+        ds.attrs['units'] = ''
+    emission_model.ionization_fraction_savefile = savefile
+    ionization_fraction = emission_model.get_ionization_fractions(loop, ions)
+    assert ionization_fraction.shape == (len(ions),) + loop.density.shape
+    for i, ion in enumerate(ions):
+        assert u.allclose(ionization_fraction[i],
+                          emission_model.get_ionization_fraction(loop, ion))
+    oxygen = emission_model.get_element_ionization_fraction(loop, 'oxygen')
+    assert oxygen.shape == loop.density.shape + (9,)
+    assert np.all(oxygen[:, 0, :] == oxygen[:, -1, :])
+
+
+def test_calculate_ionization_fraction_columnar(emission_model, loop, tmpdir):
+    loops = [SyntheticLoop(f'loop{i:06d}', loop.electron_temperature[:, i:],
+                           loop.density[:, i:]) for i in range(0, 20, 4)]
+    field = type('SyntheticField', (object,), {'loops': loops})
+    ions = emission_model._ion_list
+    expected = [emission_model.get_ionization_fractions(l, ions) for l in loops]
+    savefile = str(tmpdir.join('ionization_fraction.h5'))
+    # NOTE: small batches such that the columns are written in several pieces
+    emission_model.calculate_ionization_fraction(field, savefile, max_points=50,
+                                                 notebook=False)
+    assert emission_model.ionization_equilibrium
+    with h5py.File(savefile, 'r') as hf:
+        assert hf['columns/iron'].shape == (sum([l.density.size for l in loops]), 27)
+    for l, e in zip(loops, expected):
+        assert u.allclose(emission_model.get_ionization_fractions(l, ions), e)
+        assert u.allclose(emission_model.get_ionization_fraction(l, ions[1]), e[1])
+
+
+
+def test_calculate_ionization_fraction_batches(emission_model, loop, tmpdir):
+    loops = [SyntheticLoop(f'loop{i:06d}', loop.electron_temperature[:, i:],
+                           loop.density[:, i:]) for i in range(0, 20, 4)]
+    field = type('SyntheticField', (object,), {'loops': loops})
+    ions = emission_model._ion_list
+    calls = []
+    equilibrium_ionization_fraction = emission_model._equilibrium_ionization_fraction
+
+    def counted(element_name, temperature):
+        calls.append(temperature.shape[0])
+        return equilibrium_ionization_fraction(element_name, temperature)
+    emission_model._equilibrium_ionization_fraction = counted
+    # All loops at once
+    savefile = str(tmpdir.join('ionization_fraction_single.h5'))
+    emission_model.calculate_ionization_fraction(field, savefile, notebook=False)
+    assert calls == [sum([l.electron_temperature.size for l in loops])]
+    expected = [emission_model.get_ionization_fractions(l, ions) for l in loops]
+    # NOTE: the limit counts every time and every point such that the loops, with 150, 130,
+    # 110, 90 and 70 values, are split into three batches
+    calls.clear()
+    savefile = str(tmpdir.join('ionization_fraction_batched.h5'))
+    emission_model.calculate_ionization_fraction(field, savefile, max_points=250,
+                                                 notebook=False)
+    assert calls == [150, 130 + 110, 90 + 70]
+    for l, e in zip(loops, expected):
+        assert u.allclose(emission_model.get_ionization_fractions(l, ions), e)
+
+
+
+def test_mesh_indices_cache(emission_model, loop, tmpdir):
+    loops = [SyntheticLoop(f'loop{i:06d}', loop.electron_temperature[:, i:],
+                           loop.density[:, i:]) for i in range(0, 20, 4)]
+    field = type('SyntheticField', (object,), {'loops': loops})
+    expected = [emission_model.interpolate_to_mesh_indices(l) for l in loops]
+    emission_model.calculate_mesh_indices(field, str(tmpdir.join('mesh_indices.h5')),
+                                          notebook=False)
+    # Hit: the indices are read from disk rather than recomputed
+
+    def fractional_indices(*args):
+        raise AssertionError('mesh indices should not be recomputed')
+    emission_model._fractional_indices = fractional_indices
+    for l, e in zip(loops, expected):
+        emission_model._mesh_indices_memo = None
+        indices = emission_model.interpolate_to_mesh_indices(l, density=l.density)
+        assert np.all(indices[0] == e[0]) and np.all(indices[1] == e[1])
+        # Memoized indices are reused for the same loop
+        assert emission_model.interpolate_to_mesh_indices(l) is indices
+    del emission_model._fractional_indices
+
+
+def test_mesh_indices_invalidated(emission_model, loop, tmpdir):
+    emission_model.calculate_mesh_indices(
+        type('SyntheticField', (object,), {'loops': [loop]}),
+        str(tmpdir.join('mesh_indices.h5')), notebook=False)
+    old_indices = emission_model.interpolate_to_mesh_indices(loop)
+    # Loop held in memory: new hydrodynamic results are detected from the data
+    loop.electron_temperature = loop.electron_temperature * 2.
+    itemperature, idensity = emission_model.interpolate_to_mesh_indices(loop)
+    assert np.allclose(itemperature, old_indices[0] + 40 * np.log10(2.))
+    assert np.all(idensity == old_indices[1])
+    # Loop stored on disk: new hydrodynamic results are detected from the file
+    loop.parameters_savefile = str(tmpdir.join('loop_parameters.h5'))
+    with h5py.File(loop.parameters_savefile, 'w') as hf:
+        hf.create_dataset('version', data=1)
+    emission_model.calculate_mesh_indices(
+        type('SyntheticField', (object,), {'loops': [loop]}),
+        str(tmpdir.join('mesh_indices.h5')), notebook=False)
+    loop.electron_temperature = loop.electron_temperature / 2.
+    emission_model._mesh_indices_memo = None
+    # NOTE: the results are unchanged until the file is rewritten
+    assert np.all(emission_model.interpolate_to_mesh_indices(loop)[0] == itemperature)
+    with h5py.File(loop.parameters_savefile, 'w') as hf:
+        hf.create_dataset('version', data=[2, 2])
+    assert np.allclose(emission_model.interpolate_to_mesh_indices(loop)[0], old_indices[0])
+
+
+def test_calculate_counts_contribution_function(emission_model, channels, loop):
+    flattened_emissivities = [InstrumentSDOAIA.flatten_emissivities(c, emission_model)
+                              for c in channels]
+    table = InstrumentSDOAIA.stack_emissivities(emission_model, flattened_emissivities)
+    counts = InstrumentSDOAIA.calculate_counts_full_channels(loop, emission_model, table)
+    contribution_table = InstrumentSDOAIA.contribution_function_table(emission_model,
+                                                                      flattened_emissivities)
+    assert contribution_table.shape == (81, 13, len(channels))
+    counts_contribution = InstrumentSDOAIA.calculate_counts_contribution_function(
+        loop, emission_model, contribution_table)
+    assert counts_contribution.shape == counts.shape
+    # NOTE: the contribution function interpolates the product of the ionization fraction and
+    # emissivity rather than each separately. On this model, the largest difference is 0.2%
+    # of the peak counts in each channel.
+    peak = counts.max(axis=(0, 1))
+    assert np.all(np.fabs(counts_contribution - counts) < 1e-2 * peak)
+
+
+@pytest.fixture
+def aia(channels, loop, tmpdir):
+    observer_coordinate = SkyCoord(lon=0*u.deg, lat=0*u.deg, radius=const.au,
+                                   frame=HeliographicStonyhurst)
+    aia = InstrumentSDOAIA([0, 10]*u.s, observer_coordinate)
+    aia.channels = [dict(c, wavelength_range=None) for c in channels]
+    aia.observing_time = np.linspace(0, 4, 3) * u.s
+    aia.counts_file = str(tmpdir.join(f'{aia.name}_counts.h5'))
+    return aia
+
+
+@pytest.mark.parametrize('full', [True, False])
+def test_flatten_serial_matches_per_channel(emission_model, aia, loop, tmpdir, full):
+    temperature = 10.**np.linspace(5., 8., 61)
+    for i, channel in enumerate(aia.channels):
+        channel['temperature_response_spline'] = splrep(
+            temperature, 1e-25 * np.exp(-((np.log10(temperature) - 5.9 - 0.2*i)/0.2)**2))
+    aia._setup_temperature_response_table()
+    model = emission_model if full else None
+    loops = [loop, SyntheticLoop('loop000001', loop.electron_temperature[:, ::-1],
+                                 loop.density[:, ::-1])]
+    interpolated_loop_coordinates = [np.linspace(0, 29, 40), np.linspace(0, 29, 25)]
+    shape = (aia.observing_time.shape[0], 65)
+    with h5py.File(aia.counts_file, 'w') as hf:
+        for channel in aia.channels:
+            hf.create_dataset(channel['name'], shape)
+        aia.flatten_serial(loops, interpolated_loop_coordinates, hf, emission_model=model)
+    # Reference is the loop over channels, and then loops, computing one channel at a time
+    with h5py.File(str(tmpdir.join('per_channel.h5')), 'w') as hf:
+        for channel in aia.channels:
+            dset = hf.create_dataset(channel['name'], shape)
+            if full:
+                flattened_emissivities = aia.flatten_emissivities(channel, model)
+            start_index = 0
+            for l, interp_s in zip(loops, interpolated_loop_coordinates):
+                if full:
+                    c = aia.calculate_counts_full(channel, l, model, flattened_emissivities)
+                else:
+                    c = aia.calculate_counts_simple(channel, l)
+                aia.commit(aia.interpolate_and_store(c, l, interp_s), dset, start_index)
+                start_index += interp_s.shape[0]
+        expected = {channel['name']: hf[channel['name']][...] for channel in aia.channels}
+    with h5py.File(aia.counts_file, 'r') as hf:
+        for channel in aia.channels:
+            counts = hf[channel['name']][...]
+            assert np.any(counts > 0)
+            assert np.allclose(counts, expected[channel['name']])
+
+
+@pytest.mark.parametrize('use_contribution_function', [False, True])
+@pytest.mark.parametrize('parallel', [False, True])
+def test_flatten_detector_counts(emission_model, aia, loop, use_contribution_function,
+                                 parallel):
+    loops = [loop, SyntheticLoop('loop000001', loop.electron_temperature[:, ::-1],
+                                 loop.density[:, ::-1])]
+    field = type('SyntheticField', (object,), {'loops': loops})
+    observer = Observer(field, [aia], parallel=parallel)
+    observer._interpolated_loop_coordinates = [np.linspace(0, 29, 40), np.linspace(0, 29, 25)]
+    with h5py.File(aia.counts_file, 'w') as hf:
+        for channel in aia.channels:
+            hf.create_dataset(channel['name'], (aia.observing_time.shape[0], 65))
+    kwargs = {'emission_model': emission_model, 'interpolate_hydro_quantities': False,
+              'use_contribution_function': use_contribution_function,
+              'preload_emissivity': parallel}
+    if parallel:
+        distributed = pytest.importorskip('distributed')
+        with distributed.Client(processes=False, n_workers=1, threads_per_worker=2) as client:
+            futures = observer.flatten_detector_counts(**kwargs)
+            client.gather(list(futures.values()))
+        assert emission_model._emissivity_buffer is not None
+    else:
+        observer.flatten_detector_counts(**kwargs)
+    flattened_emissivities = [aia.flatten_emissivities(c, emission_model) for c in aia.channels]
+    if use_contribution_function:
+        table = aia.contribution_function_table(emission_model, flattened_emissivities)
+        calculate_counts = aia.calculate_counts_contribution_function
+    else:
+        table = aia.stack_emissivities(emission_model, flattened_emissivities)
+        calculate_counts = aia.calculate_counts_full_channels
+    with h5py.File(aia.counts_file, 'r') as hf:
+        start_index = 0
+        for l, interp_s in zip(loops, observer._interpolated_loop_coordinates):
+            expected = aia.interpolate_and_store(calculate_counts(l, emission_model, table), l,
+                                                 interp_s)
+            for i, channel in enumerate(aia.channels):
+                counts = hf[channel['name']][:, start_index:start_index + interp_s.shape[0]]
+                assert np.allclose(counts, expected[..., i].value)
+            start_index += interp_s.shape[0]
+
+
+def per_line_emission(emission_model, loop, energy_unit='photon'):
+    # Reference is the emission computed one transition at a time
+    points = np.stack([np.log10(loop.electron_temperature.value),
+                       np.log10(loop.density.value)], axis=-1)
+    emission = []
+    for ion, wavelength in emission_model.resolved_lines:
+        wavelength_all, emissivity = emission_model.get_emissivity(ion)
+        emissivity = emissivity[:, :, np.argmin(np.fabs(wavelength_all - wavelength))]
+        if energy_unit == 'erg':
+            emissivity = emissivity * (const.h * const.c / wavelength).to(u.erg) / u.photon
+        f = RegularGridInterpolator((np.log10(emission_model.temperature.value),
+                                     np.log10(emission_model.density.value)), emissivity.value)
+        ionization_fraction = emission_model.get_ionization_fraction(loop, ion)
+        emission.append(ion.abundance * ionization_fraction * loop.density * f(points)
+                        * emissivity.unit * 0.83 / (4 * np.pi * u.steradian))
+    return u.Quantity(emission)
+
+
+@pytest.mark.parametrize('energy_unit', ['photon', 'erg'])
+def test_calculate_emission(emission_model, loop, energy_unit):
+    emission_model.resolved_wavelengths = {'iron_12': [195.1, 169.] * u.angstrom,
+                                           'iron_14': 213.3 * u.angstrom}
+    emission, lines = emission_model.calculate_emission(loop, energy_unit=energy_unit)
+    assert [(ion.ion_name, w.value) for ion, w in lines] == [
+        ('iron_12', 169.), ('iron_12', 195.1), ('iron_14', 213.3)]
+    assert emission.shape == loop.density.shape + (3,)
+    expected = per_line_emission(emission_model, loop, energy_unit=energy_unit)
+    for i in range(len(lines)):
+        assert u.allclose(emission[..., i], expected[i])
+    # The table of resolved transitions is built once and reused for every loop
+    n_reads = emission_model.emissivity_reads
+    emission_model.clear_emissivity_cache()
+    emission_model.calculate_emission(loop, energy_unit=energy_unit)
+    n_reads_table = emission_model.emissivity_reads - n_reads
+    emission_model.calculate_emission(loop, energy_unit=energy_unit)
+    assert emission_model.emissivity_reads - n_reads == n_reads_table
+
+
+def test_eis_flatten_serial(emission_model, loop, tmpdir):
+    observer_coordinate = SkyCoord(lon=0*u.deg, lat=0*u.deg, radius=const.au,
+                                   frame=HeliographicStonyhurst)
+    eis = InstrumentHinodeEIS([0, 10]*u.s, observer_coordinate)
+    eis.observing_time = np.linspace(0, 4, 3) * u.s
+    file_template = str(tmpdir.join('{}_counts.h5'))
+    with pytest.raises(ValueError, match='emission model'):
+        eis.build_detector_file(file_template, (3, 40), None)
+    emission_model.resolved_wavelengths = {'iron_12': [195.1, 169.] * u.angstrom,
+                                           'iron_14': 213.3 * u.angstrom}
+    eis.build_detector_file(file_template, (3, 40), None, emission_model=emission_model)
+    assert u.allclose(u.Quantity([c['model_wavelengths'] for c in eis.channels
+                                  if len(c['model_wavelengths'])]).flatten(), 195.1*u.angstrom)
+    interp_s = np.linspace(0, 29, 40)
+    with h5py.File(eis.counts_file, 'a') as hf:
+        eis.flatten_serial([loop], [interp_s], hf, emission_model=emission_model)
+    expected = per_line_emission(emission_model, loop)
+    with h5py.File(eis.counts_file, 'r') as hf:
+        for (ion, wavelength), e in zip(emission_model.resolved_lines, expected):
+            dset = hf[f'{wavelength.value}']
+            assert dset.attrs['ion_name'] == f'Fe {ion.ionization_stage}'
+            assert u.allclose(u.Quantity(dset[:], dset.attrs['units']),
+                              eis.interpolate_and_store(e, loop, interp_s))
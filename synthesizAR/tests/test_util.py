@@ -0,0 +1,94 @@
+"""
+Tests for utility functions
+"""
+import os
+
+import numpy as np
+import astropy.units as u
+import h5py
+
+from synthesizAR.util import (linear_lookup, bilinear_lookup, memmap_dataset, write_sidecar,
+                              read_frame)
+
+
+def test_linear_lookup_matches_interp():
+    x_grid = np.linspace(4, 8, 41)
+    table = np.stack([x_grid**2, np.sin(x_grid)], axis=1)
+    x = np.random.uniform(4, 8, size=(10, 5))
+    y = linear_lookup(x, x_grid, table)
+    assert y.shape == (10, 5, 2)
+    for i in range(table.shape[1]):
+        assert np.allclose(y[..., i], np.interp(x, x_grid, table[:, i]))
+
+
+def test_linear_lookup_out_of_bounds():
+    x_grid = np.linspace(0, 1, 11)
+    table = 2. * x_grid
+    y = linear_lookup([-1., 0.5, 2.], x_grid, table)
+    assert np.allclose(y, [0., 1., 0.])
+    y = linear_lookup([-1., 0.5, 2.], x_grid, table, fill_value=None)
+    assert np.allclose(y, [-2., 1., 4.])
+
+
+def test_bilinear_lookup_matches_linear_function():
+    # Bilinear interpolation is exact for a function that is linear in each index
+    i_0, i_1 = np.meshgrid(np.arange(5), np.arange(4), indexing='ij')
+    table = np.stack([1. + 2.*i_0 + 3.*i_1, 4.*i_0 - i_1], axis=-1)
+    index_0 = np.random.uniform(0, 4, size=100)
+    index_1 = np.random.uniform(0, 3, size=100)
+    values = bilinear_lookup(table, index_0, index_1, chunk_size=7)
+    assert values.shape == (100, 2)
+    assert np.allclose(values[:, 0], 1. + 2.*index_0 + 3.*index_1)
+    assert np.allclose(values[:, 1], 4.*index_0 - index_1)
+    coefficients = np.random.uniform(size=(100, 2))
+    summed = bilinear_lookup(table[..., np.newaxis], index_0, index_1, coefficients=coefficients)
+    assert np.allclose(summed[:, 0], (values * coefficients).sum(axis=1))
+    # Coefficients can be a strided view and the result can be scaled at each point
+    scale = np.random.uniform(size=100)
+    scaled = bilinear_lookup(table[..., np.newaxis], index_0, index_1,
+                             coefficients=np.ascontiguousarray(coefficients.T).T, scale=scale,
+                             chunk_size=7)
+    assert np.allclose(scaled, summed * scale[:, np.newaxis])
+
+
+def test_bilinear_lookup_outside_is_zero():
+    table = np.ones((3, 3))
+    values = bilinear_lookup(table, np.array([-0.5, 1., 2.5, np.nan]), np.array([1., 1., 1., 1.]))
+    assert np.all(values == [0., 1., 0., 0.])
+
+
+def _write_counts(filename, data):
+    with h5py.File(filename, 'w') as hf:
+        for name, chunks in [('contiguous', None), ('chunked', (2, 5))]:
+            dset = hf.create_dataset(name, data=data, chunks=chunks)
+            dset.attrs['units'] = 'ct / s'
+
+
+def test_read_frame_matches_h5py(tmpdir):
+    filename = str(tmpdir.join('counts.h5'))
+    data = np.random.uniform(size=(4, 20))
+    _write_counts(filename, data)
+    mmap, unit = memmap_dataset(filename, 'contiguous')
+    assert isinstance(mmap, np.memmap)
+    assert unit == u.Unit('ct / s')
+    # Chunked datasets can only be memory-mapped through a sidecar file
+    assert memmap_dataset(filename, 'chunked')[0] is None
+    write_sidecar(filename, 'chunked')
+    assert memmap_dataset(filename, 'chunked')[0] is not None
+    with h5py.File(filename, 'r') as hf:
+        for name in ['contiguous', 'chunked']:
+            for i in range(data.shape[0]):
+                frame, unit = read_frame(filename, name, i)
+                assert np.all(frame == hf[name][i, :])
+                assert unit == u.Unit(hf[name].attrs['units'])
+                frame, _ = read_frame(filename, name, i, use_memmap=False)
+                assert np.all(frame == hf[name][i, :])
+
+
+def test_read_frame_rebuilt_file(tmpdir):
+    filename = str(tmpdir.join('counts.h5'))
+    _write_counts(filename, np.zeros((4, 20)))
+    assert np.all(read_frame(filename, 'contiguous', 0)[0] == 0.)
+    os.remove(filename)
+    _write_counts(filename, np.ones((4, 20)))
+    assert np.all(read_frame(filename, 'contiguous', 0)[0] == 1.)
@@ -4,3 +4,4 @@ Basic utilities needed by all parts of the package
 
 from .util import *
 from .xml_io import *
+from .readers import *
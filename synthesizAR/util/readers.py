@@ -0,0 +1,126 @@
+"""
+Zero-copy readers for flattened counts and hydrodynamic quantities stored on disk
+"""
+import os
+
+import numpy as np
+import astropy.units as u
+import h5py
+
+__all__ = ['memmap_dataset', 'write_sidecar', 'read_frame']
+
+# NOTE: resolved readers are kept per process so that the file offset is only looked up once.
+# Each entry is tagged with the inode and modification time of the file such that a file that
+# is rebuilt in place is never read through a stale mapping.
+_READER_CACHE = {}
+
+
+def _sidecar_path(filename, dset_name):
+    root, _ = os.path.splitext(filename)
+    return f'{root}_{dset_name}.npy'
+
+
+def memmap_dataset(filename, dset_name):
+    """
+    Return a read-only, memory-mapped view of a dataset and its units.
+
+    For an uncompressed, contiguous HDF5 dataset, the file offset of the dataset is resolved
+    once and the raw bytes are exposed as a `~numpy.memmap`. If the dataset is chunked or
+    compressed, a raw sidecar file created by `write_sidecar` is used instead, if it exists.
+    If ``filename`` points to a Zarr store, the corresponding Zarr array is returned.
+
+    Parameters
+    ----------
+    filename : `str`
+        Path to an HDF5 file or Zarr store
+    dset_name : `str`
+
+    Returns
+    -------
+    data : array-like or `None`
+        `None` if the dataset cannot be read without going through h5py
+    unit : `~astropy.units.Unit` or `None`
+    """
+    key = (os.path.abspath(filename), dset_name)
+    stat = os.stat(filename)
+    signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if key in _READER_CACHE and _READER_CACHE[key][0] == signature:
+        return _READER_CACHE[key][1:]
+    _READER_CACHE.pop(key, None)
+    if os.path.isdir(filename) or filename.endswith('.zarr'):
+        import zarr
+        data = zarr.open(filename, mode='r')[dset_name]
+        unit = u.Unit(data.attrs['units']) if 'units' in data.attrs else None
+        if unit is not None:
+            _READER_CACHE[key] = (signature, data, unit)
+        return data, unit
+    with h5py.File(filename, 'r') as hf:
+        dset = hf[dset_name]
+        unit = u.Unit(dset.attrs['units']) if 'units' in dset.attrs else None
+        # NOTE: the offset is None if the dataset is chunked or has not yet been written to
+        offset = dset.id.get_offset()
+        if dset.compression is None and dset.chunks is None and offset is not None:
+            data = np.memmap(filename, mode='r', dtype=dset.dtype, shape=dset.shape,
+                             offset=offset)
+        elif os.path.isfile(_sidecar_path(filename, dset_name)):
+            data = np.load(_sidecar_path(filename, dset_name), mmap_mode='r')
+        else:
+            return None, unit
+    # NOTE: units are only attached once the dataset has been written to
+    if unit is not None:
+        _READER_CACHE[key] = (signature, data, unit)
+    return data, unit
+
+
+def write_sidecar(filename, dset_name):
+    """
+    Dump a chunked or compressed HDF5 dataset to a raw ``.npy`` file next to ``filename`` such
+    that it can be memory-mapped by `memmap_dataset`.
+
+    Parameters
+    ----------
+    filename : `str`
+    dset_name : `str`
+
+    Returns
+    -------
+    sidecar_filename : `str`
+    """
+    sidecar_filename = _sidecar_path(filename, dset_name)
+    with h5py.File(filename, 'r') as hf:
+        dset = hf[dset_name]
+        sidecar = np.lib.format.open_memmap(sidecar_filename, mode='w+', dtype=dset.dtype,
+                                            shape=dset.shape)
+        # Copy one row at a time to keep memory usage low
+        for i in range(dset.shape[0]):
+            sidecar[i] = dset[i]
+        sidecar.flush()
+    _READER_CACHE.pop((os.path.abspath(filename), dset_name), None)
+    return sidecar_filename
+
+
+def read_frame(filename, dset_name, i_time, use_memmap=True):
+    """
+    Read a single timestep of a flattened dataset.
+
+    If possible, the returned array is a view into the page cache rather than a fresh copy.
+    Otherwise, this falls back to reading the row through h5py.
+
+    Parameters
+    ----------
+    filename : `str`
+    dset_name : `str`
+    i_time : `int`
+    use_memmap : `bool`, optional
+        If False, always read through h5py
+
+    Returns
+    -------
+    data : `~numpy.ndarray`
+    unit : `~astropy.units.Unit`
+    """
+    data, unit = memmap_dataset(filename, dset_name) if use_memmap else (None, None)
+    if data is not None and unit is not None:
+        return data[i_time, :], unit
+    with h5py.File(filename, 'r') as hf:
+        return np.array(hf[dset_name][i_time, :]), u.Unit(hf[dset_name].attrs['units'])
@@ -8,7 +8,7 @@ import numpy as np
 import astropy.units as u
 from sunpy.sun import constants
 
-__all__ = ['SpatialPair', 'is_visible']
+__all__ = ['SpatialPair', 'is_visible', 'linear_lookup', 'bilinear_lookup']
 
 
 SpatialPair = namedtuple('SpatialPair', 'x y z')
@@ -34,3 +34,105 @@ def is_visible(coords, observer):
     in_front_of_disk = distance - observer.radius < 0.
 
     return np.any(np.stack([off_disk, in_front_of_disk], axis=1), axis=1)
+
+
+def linear_lookup(x, x_grid, table, fill_value=0.):
+    """
+    Linearly interpolate a tabulated function with a single vectorized lookup.
+
+    This is considerably cheaper than evaluating a spline and can be used to evaluate several
+    tabulated functions sharing the same grid at once.
+
+    Parameters
+    ----------
+    x : array-like
+        Points at which to evaluate the table
+    x_grid : `~numpy.ndarray`
+        Monotonically increasing grid with shape `(N,)`
+    table : `~numpy.ndarray`
+        Tabulated values with shape `(N,)` or `(N, M)`
+    fill_value : `float` or `None`, optional
+        Value to use outside of the grid. If None, linearly extrapolate.
+
+    Returns
+    -------
+    y : `~numpy.ndarray`
+        Interpolated values with shape ``x.shape + table.shape[1:]``
+    """
+    x = np.asarray(x)
+    x_flat = x.ravel()
+    i = np.clip(np.searchsorted(x_grid, x_flat, side='right') - 1, 0, x_grid.shape[0] - 2)
+    weight = (x_flat - x_grid[i]) / (x_grid[i + 1] - x_grid[i])
+    weight = weight.reshape(weight.shape + (1,)*(table.ndim - 1))
+    y = (1. - weight) * table[i] + weight * table[i + 1]
+    if fill_value is not None:
+        y[(x_flat < x_grid[0]) | (x_flat > x_grid[-1])] = fill_value
+    return y.reshape(x.shape + table.shape[1:])
+
+
+def bilinear_lookup(table, index_0, index_1, coefficients=None, scale=None, chunk_size=2**14):
+    """
+    Bilinearly interpolate a stack of 2D tables at fractional mesh indices.
+
+    Optionally, the interpolated tables are contracted against a set of per-point
+    coefficients such that weighted sums over many tables can be computed in a single pass
+    without allocating an intermediate array for each table. The points are processed in
+    chunks to bound memory usage.
+
+    Parameters
+    ----------
+    table : `~numpy.ndarray`
+        Tables with shape `(N0, N1, ...)`. If ``coefficients`` is given, the shape must be
+        `(N0, N1, K, ...)`.
+    index_0 : `~numpy.ndarray`
+        Fractional indices along the first axis with shape `(M,)`
+    index_1 : `~numpy.ndarray`
+        Fractional indices along the second axis with shape `(M,)`
+    coefficients : `~numpy.ndarray`, optional
+        Weights with shape `(M, K)` used to sum over the third axis of the table. This can be
+        a strided view, e.g. the transpose of a `(K, M)` array, as it is only read one chunk
+        at a time.
+    scale : `~numpy.ndarray`, optional
+        Factor with shape `(M,)` by which the interpolated values at each point are multiplied
+    chunk_size : `int`, optional
+        Number of points to process at once
+
+    Returns
+    -------
+    values : `~numpy.ndarray`
+        Interpolated values with shape ``(M,) + table.shape[2:]`` or, if ``coefficients``
+        is given, ``(M,) + table.shape[3:]``. Points outside the mesh are set to zero.
+    """
+    n_0, n_1 = table.shape[:2]
+    rows = np.ascontiguousarray(table).reshape((n_0 * n_1,) + table.shape[2:])
+    index_0 = np.ravel(index_0)
+    index_1 = np.ravel(index_1)
+    outside = ~(np.isfinite(index_0) & np.isfinite(index_1))
+    outside |= (index_0 < 0) | (index_0 > n_0 - 1) | (index_1 < 0) | (index_1 > n_1 - 1)
+    index_0 = np.where(outside, 0., index_0)
+    index_1 = np.where(outside, 0., index_1)
+    i_0 = np.clip(np.floor(index_0).astype(int), 0, max(n_0 - 2, 0))
+    i_1 = np.clip(np.floor(index_1).astype(int), 0, max(n_1 - 2, 0))
+    w_0 = index_0 - i_0
+    w_1 = index_1 - i_1
+    j_0 = np.minimum(i_0 + 1, n_0 - 1)
+    j_1 = np.minimum(i_1 + 1, n_1 - 1)
+    corners = [(i_0*n_1 + i_1, (1. - w_0)*(1. - w_1)),
+               (j_0*n_1 + i_1, w_0*(1. - w_1)),
+               (i_0*n_1 + j_1, (1. - w_0)*w_1),
+               (j_0*n_1 + j_1, w_0*w_1)]
+    out_shape = rows.shape[1:] if coefficients is None else rows.shape[2:]
+    values = np.zeros(index_0.shape + out_shape)
+    expand = (1,)*(rows.ndim - 1)
+    for start in range(0, index_0.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        tmp = sum([w[chunk].reshape((-1,) + expand) * rows[i[chunk]] for i, w in corners])
+        tmp[outside[chunk]] = 0.
+        if coefficients is None:
+            values[chunk] = tmp
+        else:
+            values[chunk] = np.einsum('mk...,mk->m...', tmp, coefficients[chunk])
+        if scale is not None:
+            values[chunk] *= scale[chunk].reshape((-1,) + (1,)*(values.ndim - 1))
+
+    return values